@@ -0,0 +1,123 @@
+"""
+A TF Object Detection API frozen graph, loaded once and kept ready for inference.
+
+DetectionEngine imports the graph, looks up the input/output tensors and opens a single session up front, and
+optionally runs a dummy batch through the model so that graph optimization, memory allocation and cuDNN autotuning
+happen before the first real image rather than during it. Every subsequent detect() call is then just a sess.run.
+
+The session can be configured with intra-op and inter-op thread counts, which matters on CPU nodes where TF's
+defaults oversubscribe the cores when several processes share a machine.
+
+score.py runs with aml_scripts as its working directory and imports this file as a top-level module; the synchronous
+API keeps a copy of this file in its Docker build context (animal_detection_api/detection_engine.py).
+"""
+
+import numpy as np
+import tensorflow as tf
+
+
+class DetectionEngine:
+
+    def __init__(self, model_path=None, graph=None, batch_size=1, intra_op_threads=0, inter_op_threads=0,
+                 warmup_image_size=None):
+        """
+        Args:
+            model_path: .pb file of the model; either this or graph needs to be provided
+            graph: optional, an already-loaded detection graph (see load_graph())
+            batch_size: maximum number of images stacked into one sess.run call by detect()
+            intra_op_threads: number of threads used within an op; 0 lets TF choose
+            inter_op_threads: number of ops that can run in parallel; 0 lets TF choose
+            warmup_image_size: optional, (width, height) of a dummy batch of batch_size black images to run through
+                the model before returning
+        """
+        assert (model_path is None) != (graph is None), 'Exactly one of model_path and graph should be provided'
+        if graph is None:
+            graph = DetectionEngine.load_graph(model_path)
+        self.graph = graph
+        self.batch_size = max(1, batch_size)
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        self.session = tf.Session(graph=self.graph, config=config)
+
+        self.image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
+        self.box_tensor = self.graph.get_tensor_by_name('detection_boxes:0')
+        self.score_tensor = self.graph.get_tensor_by_name('detection_scores:0')
+        self.class_tensor = self.graph.get_tensor_by_name('detection_classes:0')
+
+        if warmup_image_size is not None:
+            self.warm_up(warmup_image_size)
+
+    @staticmethod
+    def load_graph(model_path):
+        """Loads a detection model (i.e., create a graph) from a .pb file.
+
+        Args:
+            model_path: .pb file of the model.
+
+        Returns: the loaded graph.
+        """
+        print('detection_engine.py: Loading graph...')
+        detection_graph = tf.Graph()
+        with detection_graph.as_default():
+            od_graph_def = tf.GraphDef()
+            with tf.gfile.GFile(model_path, 'rb') as fid:
+                serialized_graph = fid.read()
+                od_graph_def.ParseFromString(serialized_graph)
+                tf.import_graph_def(od_graph_def, name='')
+        print('detection_engine.py: Detection graph loaded.')
+
+        return detection_graph
+
+    def warm_up(self, image_size):
+        """Runs a batch of batch_size black images of image_size (width, height) through the model."""
+        width, height = image_size
+        self.run(np.zeros((self.batch_size, height, width, 3), dtype=np.uint8))
+        print('detection_engine.py: Warmed up on a batch of {} images of size {}x{}.'.format(
+            self.batch_size, width, height))
+
+    def run(self, images_np):
+        """Runs the model once on a uint8 array of shape (n_images, height, width, 3).
+
+        Returns:
+            boxes: array of shape (n_images, n_detections, 4), relative coordinates [y1, x1, y2, x2]
+            scores: array of shape (n_images, n_detections)
+            classes: array of shape (n_images, n_detections), class labels as floats
+        """
+        return self.session.run([self.box_tensor, self.score_tensor, self.class_tensor],
+                                feed_dict={self.image_tensor: images_np})
+
+    def detect(self, images):
+        """Runs the model on a sequence of images in batches of at most batch_size.
+
+        Args:
+            images: uint8 array of shape (n_images, height, width, 3), or a list of uint8 arrays of shape
+                (height, width, 3); a batch of images that don't all have the same size is run one image at a time
+
+        Returns: boxes, scores, classes for all images, see run()
+        """
+        assert len(images) > 0, 'No images to run the detector on'
+        boxes, scores, classes = [], [], []
+        for i_start in range(0, len(images), self.batch_size):
+            batch = images[i_start:i_start + self.batch_size]
+            if isinstance(batch, np.ndarray) or all(image.shape == batch[0].shape for image in batch):
+                batch_outputs = [self.run(np.stack(batch, axis=0))]
+            else:
+                batch_outputs = [self.run(np.expand_dims(image, axis=0)) for image in batch]
+            for b_box, b_score, b_class in batch_outputs:
+                boxes.append(b_box)
+                scores.append(b_score)
+                classes.append(b_class)
+        return np.concatenate(boxes, axis=0), np.concatenate(scores, axis=0), np.concatenate(classes, axis=0)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,107 @@
+"""
+Image loading and resizing for the detector.
+
+Our detectors' pipeline.config uses a keep_aspect_ratio_resizer (min_dimension 600, max_dimension 1024), so
+stretching every image to a fixed 1024x600 distorts objects by an amount that depends on the camera's aspect ratio.
+Instead, we resize each image to fit in a fixed canvas without changing its aspect ratio, and pad the bottom and right
+of the canvas with zeros (the same layout as the TF Object Detection API's pad_to_max_dimension), so images of any
+shape can still be stacked into one batch.  Boxes predicted relative to the canvas are then mapped back to be relative
+to the original image with unletterbox_boxes().
+
+JPEGs are decoded with PIL's draft mode, which uses DCT scaling to decode directly at 1/2, 1/4 or 1/8 of the full
+resolution, as long as the result is still at least as large as the size we're going to resize to.  For 12-20MP
+camera trap images this is several times faster than decoding at full resolution.
+
+score.py runs with aml_scripts as its working directory and imports this file as a top-level module; the synchronous
+API keeps a copy of this file in its Docker build context (animal_detection_api/image_preprocessing.py).
+"""
+
+import numpy as np
+from PIL import Image
+
+
+def fit_size(width, height, max_width, max_height):
+    """Computes the largest size with the same aspect ratio as (width, height) that fits in (max_width, max_height).
+
+    Returns: (width, height) as ints
+    """
+    scale = min(max_width / width, max_height / height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def open_image(input_file, canvas_size=None):
+    """Opens an image with PIL; if canvas_size is provided, JPEGs will be decoded at the smallest DCT-scaled size that
+    is still large enough to be resized to fit in canvas_size.
+
+    Like all PIL images, the returned image is lazy; pixels are decoded on first use.
+
+    Args:
+        input_file: an image in binary format or path to an image file (anything that PIL can open)
+        canvas_size: optional, (width, height) of the canvas the image will be resized to fit in
+
+    Returns:
+        a PIL image object
+    """
+    image = Image.open(input_file)
+    if canvas_size is not None:
+        # draft() is a no-op for formats other than JPEG
+        image.draft('RGB', fit_size(image.width, image.height, canvas_size[0], canvas_size[1]))
+    return image
+
+
+def resize_to_fit(image, canvas_size):
+    """Resizes a PIL image, preserving its aspect ratio, to the largest size that fits in canvas_size (width, height).
+    """
+    return image.resize(fit_size(image.width, image.height, canvas_size[0], canvas_size[1]))
+
+
+def pad_to_canvas(image, canvas_size):
+    """Pastes an image into the upper-left corner of a black canvas.
+
+    Args:
+        image: a PIL image in RGB mode, no larger than canvas_size
+        canvas_size: (width, height) of the canvas
+
+    Returns:
+        canvas: uint8 numpy array of shape (height, width, 3)
+        image_extent: (width fraction, height fraction) of the canvas occupied by the image, used to map boxes back
+            with unletterbox_boxes()
+    """
+    canvas_width, canvas_height = canvas_size
+    image_np = np.asarray(image, np.uint8)
+    if image_np.ndim == 3 and image_np.shape[2] > 3:
+        image_np = image_np[:, :, 0:3]
+
+    height, width = image_np.shape[0], image_np.shape[1]
+    assert width <= canvas_width and height <= canvas_height, 'Image is larger than the canvas'
+
+    canvas = np.zeros((canvas_height, canvas_width, 3), dtype=np.uint8)
+    canvas[0:height, 0:width, :] = image_np
+    return canvas, (width / canvas_width, height / canvas_height)
+
+
+def letterbox_image(image, canvas_size):
+    """Resizes an image to fit in canvas_size (width, height) without changing its aspect ratio, and pads it to
+    exactly canvas_size.
+
+    Returns:
+        canvas: uint8 numpy array of shape (height, width, 3)
+        image_extent: see pad_to_canvas()
+    """
+    if image.mode != 'RGB':
+        image = image.convert(mode='RGB')
+    return pad_to_canvas(resize_to_fit(image, canvas_size), canvas_size)
+
+
+def unletterbox_boxes(boxes, image_extent):
+    """Maps boxes predicted on a letterboxed canvas back to relative coordinates in the original image.
+
+    Args:
+        boxes: numpy array of shape (..., 4), relative coordinates [y1, x1, y2, x2] on the canvas
+        image_extent: (width fraction, height fraction) returned by letterbox_image() or pad_to_canvas()
+
+    Returns: numpy array of the same shape as boxes, clipped to [0, 1]
+    """
+    width_fraction, height_fraction = image_extent
+    scale = np.array([height_fraction, width_fraction, height_fraction, width_fraction], dtype=np.float32)
+    return np.clip(np.asarray(boxes, dtype=np.float32) / scale, 0.0, 1.0)
@@ -3,6 +3,9 @@ import io
 import json
 import os
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib import parse, request
 
@@ -15,19 +18,23 @@ from tf_detector import TFDetector
 
 print('score.py, beginning, using AML version {}'.format(azureml.core.__version__))
 
+# number of threads downloading, decoding and resizing images while the detector runs
+DEFAULT_NUM_DOWNLOAD_THREADS = 16
+
+# how often to report progress, in number of images scored
+PROGRESS_INTERVAL = 200
+
 
 class BatchScorer:
     """
     Coordinates scoring a batch of images using model at model_path.
-    The images are first downloaded and all loaded before scoring is performed.
+    Images are downloaded, decoded and resized on a pool of threads while earlier batches are scored, and at most
+    max_images_in_flight loaded images are held in memory at a time.
     """
 
     def __init__(self, **kwargs):
         print('BatchScorer, __init__()')
 
-        model_path = kwargs.get('model_path')
-        self.detector = TFDetector(model_path)
-
         self.job_id = kwargs.get('job_id')
 
         self.input_container_sas = kwargs.get('input_container_sas')
@@ -36,16 +43,25 @@ class BatchScorer:
         self.detection_threshold = kwargs.get('detection_threshold')
         self.batch_size = kwargs.get('batch_size')
 
+        model_path = kwargs.get('model_path')
+        self.detector = TFDetector(model_path, batch_size=self.batch_size)
+
         self.image_ids_to_score = kwargs.get('image_ids_to_score')
         self.use_url = kwargs.get('use_url')
-        self.images = []
+
+        self.num_download_threads = kwargs.get('num_download_threads', DEFAULT_NUM_DOWNLOAD_THREADS)
+        # keep the next two batches loading while one is being scored
+        self.max_images_in_flight = max(2 * self.num_download_threads, 2 * self.batch_size)
+
+        # BlockBlobService objects are created per download thread
+        self.thread_local = threading.local()
+        if not self.use_url:
+            self.container_name = BatchScorer.get_container_from_uri(self.input_container_sas)
 
         # determine if there is metadata attached to each image_id
         self.metadata_available = True if isinstance(self.image_ids_to_score[0], list) else False
 
         self.detections = []
-        self.image_ids = []  # all the IDs of the images that PIL successfully opened
-        self.image_metas = []  # if metadata came with the list of image_ids, keep them here
         self.failed_images = []  # list of image_ids that failed to open or be processed
         self.failed_metas = []  # their corresponding metadata
 
@@ -77,58 +93,98 @@ class BatchScorer:
 
         return container
 
-    def download_images(self):
-
-        print('BatchScorer, download_images(), use_url is {}, metadata_available is {}'.format(
-            self.use_url, self.metadata_available))
-
-        if not self.use_url:
-            print('blob_service created')
+    def _get_blob_service(self):
+        blob_service = getattr(self.thread_local, 'blob_service', None)
+        if blob_service is None:
             blob_service = BlockBlobService(
                 account_name=BatchScorer.get_account_from_uri(self.input_container_sas),
                 sas_token=BatchScorer.get_sas_key_from_uri(self.input_container_sas))
-            container_name = BatchScorer.get_container_from_uri(self.input_container_sas)
-
-        for i in self.image_ids_to_score:
-            if self.metadata_available:
-                image_id = i[0]
-                image_meta = i[1]
-            else:
-                image_id = i
-                image_meta = None
-
-            try:
-                if self.use_url:
-                    # local_filename will be a tempfile with a generated name
-                    local_filename, headers = request.urlretrieve(image_id)  # TODO do not save to disk
-                    image = TFDetector.open_image(local_filename)
-                    image = TFDetector.resize_image(image)
-                else:
-                    stream = io.BytesIO()
-                    _ = blob_service.get_blob_to_stream(container_name, image_id, stream)
-                    image = TFDetector.open_image(stream)
-                    image = TFDetector.resize_image(image)  # image loaded here
-
-                self.images.append(image)
-                self.image_ids.append(image_id)
-                self.image_metas.append(image_meta)
-            except Exception as e:
-                print('score.py, failed to download or open image {}: {}'.format(image_id, str(e)))
-                self.failed_images.append(image_id)
-                self.failed_metas.append(image_meta)
-                continue
-
-
-    def score(self):
-        print('BatchScorer, score()')
-        # self.image_ids does not include any failed images; self.image_ids is overwritten here
-        self.detections, failed_images, failed_metas = self.detector.generate_detections_batch(
-            images=self.images, image_ids=self.image_ids,
-            batch_size=self.batch_size, detection_threshold=self.detection_threshold,
-            image_metas=self.image_metas, metadata_available=self.metadata_available)
-
-        self.failed_images.extend(failed_images)
-        self.failed_metas.extend(failed_metas)
+            self.thread_local.blob_service = blob_service
+        return blob_service
+
+    def load_image(self, image_id):
+        """Downloads an image into memory, then decodes and resizes it for the detector.
+
+        Returns:
+            image: uint8 numpy array returned by TFDetector.resize_image()
+            image_extent: see TFDetector.resize_image()
+        """
+        if self.use_url:
+            with request.urlopen(image_id) as response:
+                stream = io.BytesIO(response.read())
+        else:
+            blob = self._get_blob_service().get_blob_to_bytes(self.container_name, image_id)
+            stream = io.BytesIO(blob.content)
+        image = TFDetector.open_image(stream)
+        return TFDetector.resize_image(image)  # image loaded here
+
+    def _load_image_or_none(self, image_id):
+        try:
+            return self.load_image(image_id)
+        except Exception as e:
+            print('score.py, failed to download or open image {}: {}'.format(image_id, str(e)))
+            return None
+
+    def iterate_loaded_images(self):
+        """Loads images on a thread pool, at most max_images_in_flight ahead of the consumer.
+
+        Yields: (image, image_id, image_meta, image_extent) for each image that loaded successfully, in the order of
+            image_ids_to_score; images that fail to load are added to failed_images
+        """
+        print('BatchScorer, iterate_loaded_images(), use_url is {}, metadata_available is {}'.format(
+            self.use_url, self.metadata_available))
+
+        with ThreadPoolExecutor(max_workers=self.num_download_threads) as executor:
+            pending = deque()
+            i_next = 0
+            while i_next < len(self.image_ids_to_score) or len(pending) > 0:
+
+                while i_next < len(self.image_ids_to_score) and len(pending) < self.max_images_in_flight:
+                    i = self.image_ids_to_score[i_next]
+                    if self.metadata_available:
+                        image_id = i[0]
+                        image_meta = i[1]
+                    else:
+                        image_id = i
+                        image_meta = None
+                    pending.append((image_id, image_meta, executor.submit(self._load_image_or_none, image_id)))
+                    i_next += 1
+
+                image_id, image_meta, future = pending.popleft()
+                result = future.result()
+                if result is None:
+                    self.failed_images.append(image_id)
+                    self.failed_metas.append(image_meta)
+                    continue
+                image, image_extent = result
+                yield image, image_id, image_meta, image_extent
+
+    def iterate_batches(self):
+        """Groups loaded images into batches of batch_size for TFDetector.generate_detections_for_batches()."""
+        batch = []
+        for loaded_image in self.iterate_loaded_images():
+            batch.append(loaded_image)
+            if len(batch) == self.batch_size:
+                yield tuple(list(items) for items in zip(*batch))
+                batch = []
+        if len(batch) > 0:
+            yield tuple(list(items) for items in zip(*batch))
+
+    def download_and_score(self):
+        print('BatchScorer, download_and_score()')
+
+        num_scored = 0
+        for detections, failed_images, failed_metas in self.detector.generate_detections_for_batches(
+                self.iterate_batches(), self.detection_threshold, metadata_available=self.metadata_available):
+            self.detections.extend(detections)
+            self.failed_images.extend(failed_images)
+            self.failed_metas.extend(failed_metas)
+
+            num_scored_before = num_scored
+            num_scored += len(detections) + len(failed_images)
+            if num_scored // PROGRESS_INTERVAL > num_scored_before // PROGRESS_INTERVAL:
+                print('score.py, {} images scored, {} failed so far, out of {}'.format(
+                    len(self.detections), len(self.failed_images), len(self.image_ids_to_score)))
 
     def write_output(self):
         """Uploads a json containing all the detections (a subset of the "images" field of the final
@@ -174,6 +230,7 @@ if __name__ == '__main__':
 
     parser.add_argument('--detection_threshold', type=float, default=0.05)
     parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_download_threads', type=int, default=DEFAULT_NUM_DOWNLOAD_THREADS)
 
     args = parser.parse_args()
 
@@ -238,17 +295,13 @@ if __name__ == '__main__':
                          use_url=args.use_url,
                          output_dir=args.output_dir,
                          detection_threshold=args.detection_threshold,
-                         batch_size=args.batch_size)
-
-    try:
-        scorer.download_images()
-    except Exception as e:
-        raise RuntimeError('Exception in scorer.download_images(): {}'.format(str(e)))
+                         batch_size=args.batch_size,
+                         num_download_threads=args.num_download_threads)
 
     try:
-        scorer.score()
+        scorer.download_and_score()
     except Exception as e:
-        raise RuntimeError('Exception in scorer.score(): {}'.format(str(e)))
+        raise RuntimeError('Exception in scorer.download_and_score(): {}'.format(str(e)))
 
     try:
         scorer.write_output()  # write the results obtained thus far
@@ -1,49 +1,105 @@
-import PIL.Image as Image
 import numpy as np
 import tensorflow as tf
 
+# score.py runs with aml_scripts as its working directory; other tools (e.g. run_tf_detector_batch.py) import this
+# module from the root of the repo
+try:
+    import image_preprocessing
+    from detection_engine import DetectionEngine
+except ImportError:
+    from api.batch_processing.api_core.orchestrator_api.aml_scripts import image_preprocessing
+    from api.batch_processing.api_core.orchestrator_api.aml_scripts.detection_engine import DetectionEngine
+
 print('tensorflow tf version:', tf.__version__)
 print('tf_detector.py, tf.test.is_gpu_available:', tf.test.is_gpu_available())
 
 MIN_DIM = 600
 MAX_DIM = 1024
 
+# Images are resized to fit in a canvas of this (width, height), preserving their aspect ratio
+CANVAS_SIZE = (MAX_DIM, MIN_DIM)
+
 # Number of decimal places to round to for confidence and bbox coordinates
 CONF_DIGITS = 3
 COORD_DIGITS = 4
 
 
+def detections_to_api_entries(image_ids, boxes, scores, classes, detection_threshold):
+    """Applies the confidence threshold to the detector output for a batch of images and formats it as entries in the
+    'images' field of the API output. Thresholding, coordinate conversion and rounding are done with array operations
+    over the whole batch, so only the detections above the threshold are visited in Python.
+
+    Args:
+        image_ids: list of n_images strings, the 'file' field of each entry
+        boxes: array of shape (n_images, n_detections, 4), relative coordinates [y1, x1, y2, x2] in the original images
+        scores: array of shape (n_images, n_detections)
+        classes: array of shape (n_images, n_detections), numerical class labels as floats
+        detection_threshold: detection confidence above which to record the detection result
+
+    Returns:
+        list of n_images dicts with fields
+            'file': the image ID
+            'max_detection_conf': float rounded to CONF_DIGITS decimal places, 0.0 if there are no detections
+            'detections': list of detection entries with fields
+                'category': str, numerical class label
+                'conf': float rounded to CONF_DIGITS decimal places, score/confidence of the detection
+                'bbox': list of floats rounded to COORD_DIGITS decimal places, relative coordinates
+                        [x, y, width_box, height_box]
+    """
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+    classes = np.asarray(classes)
+
+    above_threshold = scores > detection_threshold
+
+    # np.nonzero returns indices in row-major order, i.e. grouped by image and in the detector's order within images
+    i_images, i_detections = np.nonzero(above_threshold)
+    kept_boxes = boxes[i_images, i_detections]
+
+    # change from [y1, x1, y2, x2] to [x1, y1, width_box, height_box], in the boxes' dtype as before rounding
+    xywh = np.stack([kept_boxes[:, 1], kept_boxes[:, 0],
+                     kept_boxes[:, 3] - kept_boxes[:, 1], kept_boxes[:, 2] - kept_boxes[:, 0]], axis=1)
+    bboxes = np.round(xywh.astype(np.float64), COORD_DIGITS).tolist()
+    confs = np.round(scores[i_images, i_detections].astype(np.float64), CONF_DIGITS).tolist()
+    categories = [str(c) for c in classes[i_images, i_detections].astype(np.int64).tolist()]
+
+    max_confs = np.where(above_threshold, scores, 0.0).max(axis=1, initial=0.0)
+    max_confs = np.round(max_confs.astype(np.float64), CONF_DIGITS).tolist()
+    num_detections = above_threshold.sum(axis=1).tolist()
+
+    entries = []
+    i_start = 0
+    for image_id, max_conf, n in zip(image_ids, max_confs, num_detections):
+        entries.append({
+            'file': image_id,
+            'max_detection_conf': max_conf,
+            'detections': [{'category': categories[i], 'conf': confs[i], 'bbox': bboxes[i]}
+                           for i in range(i_start, i_start + n)]
+        })
+        i_start += n
+    return entries
+
+
 class TFDetector:
 
     detection_graph = None
-    
-    def __init__(self, model_path):
-        self.detection_graph = self.load_model(model_path)
 
-    def load_model(self, model_path):
-        """Loads a detection model (i.e., create a graph) from a .pb file.
+    def __init__(self, model_path, batch_size=1, intra_op_threads=0, inter_op_threads=0):
+        """Loads the model and warms it up on a batch of batch_size images of CANVAS_SIZE.
 
         Args:
             model_path: .pb file of the model.
-
-        Returns: the loaded graph.
-
+            batch_size: number of images per batch that the model will be warmed up with
+            intra_op_threads, inter_op_threads: TF session thread counts, see DetectionEngine
         """
-        print('tf_detector.py: Loading graph...')
-        detection_graph = tf.Graph()
-        with detection_graph.as_default():
-            od_graph_def = tf.GraphDef()
-            with tf.gfile.GFile(model_path, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
-        print('tf_detector.py: Detection graph loaded.')
-
-        return detection_graph
+        self.engine = DetectionEngine(model_path, batch_size=batch_size, intra_op_threads=intra_op_threads,
+                                      inter_op_threads=inter_op_threads, warmup_image_size=CANVAS_SIZE)
+        self.detection_graph = self.engine.graph
 
     @staticmethod
     def open_image(input_file):
-        """Opens an image in binary format using PIL.Image and convert to RGB mode.
+        """Opens an image in binary format using PIL.Image and convert to RGB mode. JPEGs will be decoded at reduced
+        resolution if they are much larger than CANVAS_SIZE.
 
         Args:
             input_file: an image in binary format read from the POST request's body or
@@ -52,7 +108,7 @@ class TFDetector:
         Returns:
             an PIL image object in RGB mode
         """
-        image = Image.open(input_file)
+        image = image_preprocessing.open_image(input_file, CANVAS_SIZE)
         if image.mode not in ('RGBA', 'RGB'):
             raise AttributeError('Input image not in RGBA or RGB mode and cannot be processed.')
         if image.mode == 'RGBA':
@@ -62,52 +118,68 @@ class TFDetector:
 
     @staticmethod
     def resize_image(image):
-        # resize the images since the client side renders them as small images too
-        height, width = MIN_DIM, MAX_DIM
-        return image.resize((width, height))  # PIL is lazy, so image only loaded here, not in open_image()
-
-    @staticmethod
-    def round_and_make_float(d):
-        return round(float(d), COORD_DIGITS)
-
-    @staticmethod
-    def convert_coords(np_array):
-        """ Two functionalities: convert the numpy floats to Python floats, and also change the coordinates from
-        [y1, x1, y2, x2] to [x1, y1, width_box, height_box] (in relative coordinates still).
+        """Resizes an image to fit in CANVAS_SIZE without changing its aspect ratio, padding the rest of the canvas.
 
         Args:
-            np_array: array of predicted bounding box coordinates from the TF detector
-
-        Returns: array of predicted bounding box coordinates as Python floats and in [x1, y1, width_box, height_box]
+            image: PIL image returned by open_image()
 
+        Returns:
+            image_np: uint8 numpy array of shape (MIN_DIM, MAX_DIM, 3)
+            image_extent: fraction of the canvas width and height occupied by the image; pass these to
+                generate_detections_batch() so boxes are relative to the original image
         """
-        # change from [y1, x1, y2, x2] to [x1, y1, width_box, height_box]
-        width_box = np_array[3] - np_array[1]
-        height_box = np_array[2] - np_array[0]
-
-        new = [np_array[1], np_array[0], width_box, height_box]  # cannot be a numpy array; needs to be a list
-
-        # convert numpy floats to Python floats
-        for i, d in enumerate(new):
-            new[i] = TFDetector.round_and_make_float(d)
-        return new
+        # PIL is lazy, so image only loaded here, not in open_image()
+        return image_preprocessing.letterbox_image(image, CANVAS_SIZE)
 
-    def _generate_detections_batch(self, images, sess, image_tensor, box_tensor, score_tensor, class_tensor):
+    def _generate_detections_batch(self, images):
         print('_generate_detections_batch')
         np_images = [np.asarray(image, np.uint8) for image in images]
-        images_stacked = np.stack(np_images, axis=0) if len(images) > 1 else np.expand_dims(np_images[0], axis=0)
+        images_stacked = np.stack(np_images, axis=0)
         print('images_stacked shape: ', images_stacked.shape)
 
         # performs inference
-        (box_tensor, score_tensor, class_tensor) = sess.run(
-            [box_tensor, score_tensor, class_tensor],
-            feed_dict={image_tensor: images_stacked})
+        box_tensor, score_tensor, class_tensor = self.engine.run(images_stacked)
 
         print('box_tensor shape: ', box_tensor.shape)
         return box_tensor, score_tensor, class_tensor
 
+    def generate_detections_for_batches(self, batches, detection_threshold, metadata_available=False):
+        """Runs the detector on batches of images, consuming the batches as they become available, so that images can
+        still be loading while earlier batches are being scored.
+
+        Args:
+            batches: iterable of (images, image_ids, image_metas, image_extents) tuples of lists of the same length,
+                one batch each; see generate_detections_batch() for the items. image_metas and image_extents can be
+                lists of None.
+            detection_threshold: detection confidence above which to record the detection result
+            metadata_available: is image_metas actually available
+
+        Yields: (detections, failed_images, failed_metas) for each batch, see generate_detections_batch()
+        """
+        for i_batch, (image_batch, image_id_batch, image_meta_batch, image_extent_batch) in enumerate(batches):
+            try:
+                print('tf_detector.py, processing batch {}.'.format(i_batch + 1))
+
+                b_box, b_score, b_class = self._generate_detections_batch(image_batch)
+
+                # map boxes from the padded canvas back to the original images
+                for i, image_extent in enumerate(image_extent_batch):
+                    if image_extent is not None:
+                        b_box[i] = image_preprocessing.unletterbox_boxes(b_box[i], image_extent)
+
+                detections = detections_to_api_entries(image_id_batch, b_box, b_score, b_class, detection_threshold)
+                if metadata_available:
+                    for detection, image_meta in zip(detections, image_meta_batch):
+                        detection['meta'] = image_meta
+            except Exception as e:
+                print('tf_detector.py, one batch of images failed, exception: {}'.format(str(e)))
+                yield [], list(image_id_batch), list(image_meta_batch)
+                continue
+
+            yield detections, [], []
+
     def generate_detections_batch(self, images, image_ids, batch_size, detection_threshold,
-                                  image_metas=None, metadata_available=False):
+                                  image_metas=None, metadata_available=False, image_extents=None):
         """
         Args:
             images: resized images to be processed by the detector
@@ -116,6 +188,8 @@ class TFDetector:
             detection_threshold: detection confidence above which to record the detection result
             image_metas: list of strings, same length as image_ids
             metadata_available: is image_metas actually available (if not, image_metas can be a list of None)
+            image_extents: optional, list of image extents returned by resize_image(), same length as image_ids;
+                if provided, boxes are mapped from the padded canvas back to the original images
 
         Returns:
             detections: list of detection entries with fields
@@ -128,68 +202,27 @@ class TFDetector:
             failed_metas: list of image_metas for images that failed to process
         """
 
-        # number of images should be small - all are loaded at once and a copy of resized version exists at one point
-        # 2000 images are okay on a NC6s_v3
+        # all images are passed in at once; use generate_detections_for_batches() to score images as they load
         print('tf_detector.py: generate_detections_batch...')
 
-        # group the images into batches; image_batches is a list of lists
-        image_batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
-
-        # we keep track of the image_ids (and image_metas when available) to be able to output the list of failed images
-        image_id_batches = [image_ids[i:i + batch_size] for i in range(0, len(images), batch_size)]
         if image_metas is None:
             image_metas = [None] * len(images)
-        image_meta_batches = [image_metas[i:i + batch_size] for i in range(0, len(images), batch_size)]
+        if image_extents is None:
+            image_extents = [None] * len(images)
+
+        # group the images into batches, keeping track of the image_ids (and image_metas when available) to be able
+        # to output the list of failed images
+        batches = [(images[i:i + batch_size], image_ids[i:i + batch_size], image_metas[i:i + batch_size],
+                    image_extents[i:i + batch_size]) for i in range(0, len(images), batch_size)]
 
         detections = []
         failed_images = []
         failed_metas = []
 
-        # start the TF session to process all images
-        with tf.Session(graph=self.detection_graph) as sess:
-            # get the operators
-            image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
-            box_tensor = self.detection_graph.get_tensor_by_name('detection_boxes:0')
-            score_tensor = self.detection_graph.get_tensor_by_name('detection_scores:0')
-            class_tensor = self.detection_graph.get_tensor_by_name('detection_classes:0')
-
-            for i_batch, (image_batch, image_id_batch, image_meta_batch) in enumerate(zip(
-                    image_batches, image_id_batches, image_meta_batches)):
-                try:
-                    print('tf_detector.py, processing batch {} out of {}.'.format(i_batch + 1, len(image_batches)))
-
-                    b_box, b_score, b_class = self._generate_detections_batch(image_batch,
-                                                                              sess, image_tensor,
-                                                                              box_tensor, score_tensor, class_tensor)
-                    for i, (image_id, image_meta) in enumerate(zip(image_id_batch, image_meta_batch)):
-                        # apply the confidence threshold
-                        boxes, scores, classes = b_box[i], b_score[i], b_class[i]
-                        detections_cur_image = []  # will be empty for an image with no confident detections
-                        max_detection_conf = 0.0
-                        for b, s, c in zip(boxes, scores, classes):
-                            if s > detection_threshold:
-                                detection_entry = {
-                                    'category': str(int(c)),  # use string type for the numerical class label, not int
-                                    'conf': round(float(s), CONF_DIGITS),  # cast to float for json serialization
-                                    'bbox': TFDetector.convert_coords(b)
-                                }
-                                detections_cur_image.append(detection_entry)
-                                if s > max_detection_conf:
-                                    max_detection_conf = s
-
-                        detection = {
-                            'file': image_id,
-                            'max_detection_conf': round(float(max_detection_conf), CONF_DIGITS),
-                            'detections': detections_cur_image
-                        }
-                        if metadata_available:
-                            detection['meta'] = image_meta
-                        detections.append(detection)
-
-                except Exception as e:
-                    failed_images.extend(image_id_batch)
-                    failed_metas.extend(image_meta_batch)
-                    print('tf_detector.py, one batch of images failed, exception: {}'.format(str(e)))
-                    continue
+        for batch_detections, batch_failed_images, batch_failed_metas in self.generate_detections_for_batches(
+                batches, detection_threshold, metadata_available=metadata_available):
+            detections.extend(batch_detections)
+            failed_images.extend(batch_failed_images)
+            failed_metas.extend(batch_failed_metas)
 
         return detections, failed_images, failed_metas
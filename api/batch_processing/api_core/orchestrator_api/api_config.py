@@ -58,8 +58,12 @@ WHITELIST = []
 # version of the detector model in use
 SUPPORTED_MODEL_VERSIONS = sorted([k for k in AML_CONFIG['models']])
 
-# max number of blobs to list in the output blob container
-MAX_BLOBS_IN_OUTPUT_CONTAINER = 1000 * 1000
+# only blobs under this prefix in the output blob container are listed when aggregating results;
+# AML writes job outputs to azureml/<run_id>/<output name>/
+AML_OUTPUT_BLOB_PREFIX = 'azureml/'
+
+# number of result shards to download in parallel when aggregating results
+NUM_AGGREGATION_THREADS = 8
 
 # URLs to the 3 output files expires after this many days
 EXPIRATION_DAYS = 90
@@ -1,9 +1,7 @@
 import copy
-import io
 import os
 from collections import defaultdict
 from datetime import datetime, timedelta
-import json
 
 import azureml.core
 from azure.storage.blob import BlockBlobService, BlobPermissions
@@ -18,6 +16,7 @@ from azureml.pipeline.core.graph import PipelineParameter
 from azureml.pipeline.steps import PythonScriptStep
 
 import api_config
+from result_aggregation import AzureBlobStore, aggregate_request_results
 from sas_blob_utils import SasBlob
 
 print('Version of AML: {}'.format(azureml.core.__version__))
@@ -313,12 +312,6 @@ class AMLMonitor:
 
         return all_jobs_finished, status_tally
 
-    def _download_read_json(self, blob_path):
-        blob = self.internal_storage_service.get_blob_to_text(self.aml_output_container, blob_path)
-        stream = io.StringIO(blob.content)
-        result = json.load(stream)
-        return result
-
     def _generate_urls_for_outputs(self):
         try:
             request_id = self.request_id
@@ -353,58 +346,32 @@ class AMLMonitor:
 
         # The more efficient method is to know the run_id which is the folder name that the result is written to.
         # Since we can't reliably get the run_id after submitting the run, resort to listing all blobs in the output
-        # container and match by the request_id
-
-        # listing all (up to a large limit) because don't want to worry about generator next_marker
-        datastore_aml_container = copy.deepcopy(self.internal_datastore)
-        datastore_aml_container['container_name'] = self.aml_output_container
-        list_blobs = SasBlob.list_blobs_in_container(api_config.MAX_BLOBS_IN_OUTPUT_CONTAINER,
-                                                     datastore=datastore_aml_container,
-                                                     blob_suffix='.json')
-        all_detections = []
-        failures = []
-        num_aggregated = 0
-        for blob_path in list_blobs:
-            if blob_path.endswith('.json'):
-                # blob_path is azureml/run_id/output_requestID/out_file_name.json
-                out_file_name = blob_path.split('/')[-1]
-                # "request" is part of the AML job_id
-                if out_file_name.startswith('detections_request{}_'.format(self.request_id)):
-                    all_detections.extend(self._download_read_json(blob_path))
-                    num_aggregated += 1
-                    print('Number of results aggregated: ', num_aggregated)
-                elif out_file_name.startswith('failures_request{}_'.format(self.request_id)):
-                    failures.extend(self._download_read_json(blob_path))
-
-        print('aggregate_results(), length of all_detections: {}'.format(len(all_detections)))
-
-        detection_output_content = {
+        # container and match by the request_id. Shards are streamed into the output blobs so that memory use
+        # doesn't grow with the size of the request.
+        header_fields = {
             'info': {
                 'detector': 'megadetector_v{}'.format(self.model_version),
                 'detection_completion_time': get_utc_time(),
                 'format_version': api_config.OUTPUT_FORMAT_VERSION
             },
-            'detection_categories': api_config.DETECTION_CATEGORIES,
-            'images': all_detections
+            'detection_categories': api_config.DETECTION_CATEGORIES
         }
-        detection_output_str = json.dumps(detection_output_content, indent=1)
-
-        # upload aggregated results to output_store
-        self.internal_storage_service.create_blob_from_text(self.internal_container,
-                                                            '{}/{}_detections_{}_{}.json'.format(
-                                                                self.request_id, self.request_id,
-                                                                self.request_name, self.request_submission_timestamp),
-                                                            detection_output_str, max_connections=4)
-        print('aggregate_results(), detections uploaded')
-
-        print('aggregate_results(), number of failed images: {}'.format(len(failures)))
-        failures_str = json.dumps(failures, indent=1)
-        self.internal_storage_service.create_blob_from_text(self.internal_container,
-                                                            '{}/{}_failed_images_{}_{}.json'.format(
-                                                                self.request_id, self.request_id,
-                                                                self.request_name, self.request_submission_timestamp),
-                                                            failures_str)
-        print('aggregate_results(), failures uploaded')
+
+        num_images, num_failures = aggregate_request_results(
+            AzureBlobStore(self.internal_storage_service),
+            self.aml_output_container,
+            self.internal_container,
+            self.request_id,
+            header_fields,
+            detections_blob_name='{}/{}_detections_{}_{}.json'.format(
+                self.request_id, self.request_id, self.request_name, self.request_submission_timestamp),
+            failures_blob_name='{}/{}_failed_images_{}_{}.json'.format(
+                self.request_id, self.request_id, self.request_name, self.request_submission_timestamp),
+            blob_prefix=api_config.AML_OUTPUT_BLOB_PREFIX,
+            num_threads=api_config.NUM_AGGREGATION_THREADS)
+
+        print('aggregate_results(), detections uploaded, number of images: {}'.format(num_images))
+        print('aggregate_results(), failures uploaded, number of failed images: {}'.format(num_failures))
 
         output_file_urls = self._generate_urls_for_outputs()
         return output_file_urls
@@ -0,0 +1,273 @@
+"""
+Streaming aggregation of the result shards that score.py writes for each AML job into the two output files of a
+request (detections and failed images).
+
+Shards are listed lazily, downloaded and parsed a few at a time on a thread pool, and written out in listing order to
+a block blob through StagedBlockBlobWriter, which stages a block every few MB and only commits the block list at the
+end. Memory use is therefore bounded by the number of shards in flight rather than by the size of the request, and
+the output only becomes visible once it is complete.
+
+The output is byte-compatible with json.dumps(output, indent=1).
+
+Blob storage is accessed through a small store interface (list_blob_names, get_blob_text, put_block, put_block_list)
+implemented by AzureBlobStore for a BlockBlobService and by LocalBlobStore for a local folder, which can be used to
+test the aggregation without a storage account.
+"""
+
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Azure allows up to 50,000 blocks of up to 100MB per block blob
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_NUM_DOWNLOAD_THREADS = 8
+
+# the Blob Service returns at most 5000 blobs per listing call
+LIST_PAGE_SIZE = 4000
+
+JSON_INDENT = 1
+
+
+# %% Blob stores
+
+class AzureBlobStore:
+    def __init__(self, block_blob_service):
+        self.service = block_blob_service
+
+    def list_blob_names(self, container_name, prefix=None):
+        """Yields the names of blobs in the container, in lexicographic order, one listing page at a time."""
+        marker = None
+        while True:
+            generator = self.service.list_blobs(container_name, prefix=prefix, num_results=LIST_PAGE_SIZE,
+                                                marker=marker)
+            for blob in generator:
+                yield blob.name
+            marker = generator.next_marker
+            if not marker:
+                return
+
+    def get_blob_text(self, container_name, blob_name):
+        return self.service.get_blob_to_text(container_name, blob_name).content
+
+    def put_block(self, container_name, blob_name, block_id, data):
+        self.service.put_block(container_name, blob_name, data, block_id)
+
+    def put_block_list(self, container_name, blob_name, block_ids):
+        # imported here so that LocalBlobStore can be used without the Azure SDK
+        from azure.storage.blob import BlobBlock
+        self.service.put_block_list(container_name, blob_name, [BlobBlock(id=block_id) for block_id in block_ids])
+
+
+class LocalBlobStore:
+    """Stand-in for AzureBlobStore backed by a local folder, with one subfolder per container.
+
+    Staged blocks are kept under root_dir/.staged_blocks until put_block_list() concatenates them into the blob.
+    """
+
+    STAGING_DIR = '.staged_blocks'
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _blob_path(self, container_name, blob_name):
+        return os.path.join(self.root_dir, container_name, *blob_name.split('/'))
+
+    def _staging_path(self, container_name, blob_name):
+        return os.path.join(self.root_dir, LocalBlobStore.STAGING_DIR, container_name, *blob_name.split('/'))
+
+    def list_blob_names(self, container_name, prefix=None):
+        container_dir = os.path.join(self.root_dir, container_name)
+        blob_names = []
+        for dir_path, _, file_names in os.walk(container_dir):
+            for file_name in file_names:
+                path = os.path.relpath(os.path.join(dir_path, file_name), container_dir)
+                blob_names.append(path.replace(os.sep, '/'))
+        for blob_name in sorted(blob_names):
+            if prefix is None or blob_name.startswith(prefix):
+                yield blob_name
+
+    def get_blob_text(self, container_name, blob_name):
+        with open(self._blob_path(container_name, blob_name), encoding='utf-8') as f:
+            return f.read()
+
+    def put_block(self, container_name, blob_name, block_id, data):
+        staging_dir = self._staging_path(container_name, blob_name)
+        os.makedirs(staging_dir, exist_ok=True)
+        with open(os.path.join(staging_dir, block_id), 'wb') as f:
+            f.write(data)
+
+    def put_block_list(self, container_name, blob_name, block_ids):
+        staging_dir = self._staging_path(container_name, blob_name)
+        blob_path = self._blob_path(container_name, blob_name)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        temp_path = blob_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for block_id in block_ids:
+                with open(os.path.join(staging_dir, block_id), 'rb') as block_file:
+                    f.write(block_file.read())
+        os.replace(temp_path, blob_path)
+
+        for block_id in block_ids:
+            os.remove(os.path.join(staging_dir, block_id))
+        if len(block_ids) > 0:
+            os.rmdir(staging_dir)
+
+
+# %% Block blob writer
+
+class StagedBlockBlobWriter:
+    """File-like object that uploads text to a block blob as it is written.
+
+    A block is staged every block_size bytes; close() stages the remainder and commits the block list, so nothing is
+    visible at blob_name until the whole blob has been written.
+    """
+
+    def __init__(self, store, container_name, blob_name, block_size=DEFAULT_BLOCK_SIZE):
+        self.store = store
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.block_ids = []
+
+    def write(self, text):
+        self.buffer.extend(text.encode('utf-8'))
+        while len(self.buffer) >= self.block_size:
+            self._stage_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def _stage_block(self, data):
+        # block IDs within a blob need to have the same length
+        block_id = '{:08d}'.format(len(self.block_ids))
+        self.store.put_block(self.container_name, self.blob_name, block_id, data)
+        self.block_ids.append(block_id)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self._stage_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.store.put_block_list(self.container_name, self.blob_name, self.block_ids)
+
+
+# %% Aggregation
+
+def find_result_shards(store, container_name, request_id, blob_prefix=None):
+    """Lists the detection and failure shards that score.py wrote for a request.
+
+    AML writes each job's output to azureml/<run_id>/output_<request_id>/, and we can't reliably get the run_id of a
+    job, so the shards are recognized by their file names.
+
+    Returns:
+        detection_shards: list of blob names of detections_request<request_id>_*.json shards
+        failure_shards: list of blob names of failures_request<request_id>_*.json shards
+    """
+    detection_shards = []
+    failure_shards = []
+    for blob_name in store.list_blob_names(container_name, prefix=blob_prefix):
+        if not blob_name.lower().endswith('.json'):
+            continue
+        out_file_name = blob_name.split('/')[-1]
+        # "request" is part of the AML job_id
+        if out_file_name.startswith('detections_request{}_'.format(request_id)):
+            detection_shards.append(blob_name)
+        elif out_file_name.startswith('failures_request{}_'.format(request_id)):
+            failure_shards.append(blob_name)
+    return detection_shards, failure_shards
+
+
+def iterate_shards(store, container_name, blob_names, num_threads=DEFAULT_NUM_DOWNLOAD_THREADS):
+    """Downloads and parses JSON shards on a thread pool, yielding them in the order of blob_names with at most
+    2 * num_threads shards in memory at a time.
+    """
+    def download(blob_name):
+        return json.loads(store.get_blob_text(container_name, blob_name))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for blob_name in blob_names:
+            pending.append(executor.submit(download, blob_name))
+            if len(pending) >= 2 * num_threads:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def _indented_json(obj, level):
+    """Serializes obj the way json.dumps(..., indent=JSON_INDENT) would if obj were nested level levels deep."""
+    return json.dumps(obj, indent=JSON_INDENT).replace('\n', '\n' + ' ' * (JSON_INDENT * level))
+
+
+def write_json_array(writer, shards, level=0):
+    """Writes the concatenation of the lists in shards as one JSON array nested level levels deep.
+
+    Returns: number of items written
+    """
+    writer.write('[')
+    num_items = 0
+    for shard in shards:
+        for item in shard:
+            if num_items > 0:
+                writer.write(',')
+            writer.write('\n' + ' ' * (JSON_INDENT * (level + 1)) + _indented_json(item, level + 1))
+            num_items += 1
+    if num_items > 0:
+        writer.write('\n' + ' ' * (JSON_INDENT * level))
+    writer.write(']')
+    return num_items
+
+
+def write_detection_output(writer, header_fields, shards):
+    """Writes the detection output file: the fields in header_fields followed by an 'images' array made of the
+    entries in shards.
+
+    Returns: number of images written
+    """
+    writer.write('{')
+    for k, v in header_fields.items():
+        assert k != 'images', 'Images should be provided as shards'
+        writer.write('\n' + ' ' * JSON_INDENT + json.dumps(k) + ': ' + _indented_json(v, 1) + ',')
+    writer.write('\n' + ' ' * JSON_INDENT + json.dumps('images') + ': ')
+    num_images = write_json_array(writer, shards, level=1)
+    writer.write('\n}')
+    return num_images
+
+
+def aggregate_request_results(store, aml_output_container, output_container, request_id, header_fields,
+                              detections_blob_name, failures_blob_name, blob_prefix=None,
+                              num_threads=DEFAULT_NUM_DOWNLOAD_THREADS, block_size=DEFAULT_BLOCK_SIZE):
+    """Combines the shards of a request into its detections and failed images output files.
+
+    Args:
+        store: AzureBlobStore or LocalBlobStore
+        aml_output_container: container that score.py writes its shards to
+        output_container: container to write the output files to
+        request_id: ID of the request
+        header_fields: dict of fields to write before 'images' in the detections file, e.g. 'info' and
+            'detection_categories'
+        detections_blob_name: blob name of the detections file in output_container
+        failures_blob_name: blob name of the failed images file in output_container
+        blob_prefix: optional, only shards whose blob names start with this are considered
+        num_threads: number of shards to download in parallel
+        block_size: size in bytes of the blocks the output files are uploaded in
+
+    Returns:
+        num_images: number of image entries in the detections file
+        num_failures: number of entries in the failed images file
+    """
+    detection_shards, failure_shards = find_result_shards(store, aml_output_container, request_id,
+                                                          blob_prefix=blob_prefix)
+    print('aggregate_request_results(), found {} detection shards and {} failure shards'.format(
+        len(detection_shards), len(failure_shards)))
+
+    writer = StagedBlockBlobWriter(store, output_container, detections_blob_name, block_size=block_size)
+    num_images = write_detection_output(writer, header_fields,
+                                        iterate_shards(store, aml_output_container, detection_shards, num_threads))
+    writer.close()
+
+    writer = StagedBlockBlobWriter(store, output_container, failures_blob_name, block_size=block_size)
+    num_failures = write_json_array(writer, iterate_shards(store, aml_output_container, failure_shards, num_threads))
+    writer.close()
+
+    return num_images, num_failures
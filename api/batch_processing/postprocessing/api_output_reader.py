@@ -0,0 +1,213 @@
+#
+# api_output_reader.py
+#
+# Reads batch processing API output (json) incrementally, one 'images' entry at a time,
+# so callers never need to hold the full set of results in memory.  This is the reading
+# counterpart of api_output_writer.py.
+#
+# Only the 'images' array is streamed; other top-level fields (info, detection_categories,
+# etc.) are small and are parsed as a whole.  They can appear before or after 'images'.
+#
+# Also reads the intermediate shard files written by the API, which are a bare list of
+# 'images' entries rather than an object.
+#
+# Uses only the standard library json module: each value is parsed with
+# json.JSONDecoder.raw_decode() out of a buffer that is refilled from the file as needed.
+#
+# Format spec:
+#
+# https://github.com/microsoft/CameraTraps/tree/master/api/batch_processing
+#
+
+#%% Imports
+
+import json
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+#%% Classes
+
+class ApiOutputReader:
+    """
+    Incremental reader for the API output format.  Typical use:
+
+        with ApiOutputReader(input_path) as reader:
+            for im in reader.iterate_images():
+                ...
+            fields = reader.fields
+
+    fields_before_images is available as soon as the reader is created; fields (all
+    top-level fields other than 'images', in file order) and fields_after_images are
+    complete once iterate_images() has been exhausted.
+    """
+
+    def __init__(self, input_path, chunk_size=DEFAULT_CHUNK_SIZE):
+
+        self.input_path = input_path
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+        self.f = open(input_path, encoding='utf-8')
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+        self.fields_before_images = {}
+        self.fields_after_images = {}
+        self.has_images = False
+        self.is_image_list = False
+        self.n_images = 0
+        self._images_started = False
+
+        if self._peek() == '[':
+            self.is_image_list = True
+            self.has_images = True
+        else:
+            self._expect('{')
+            self.has_images = self._read_fields(self.fields_before_images)
+
+    @property
+    def fields(self):
+
+        fields = dict(self.fields_before_images)
+        fields.update(self.fields_after_images)
+        return fields
+
+    #%% Low-level parsing
+
+    def _fill(self):
+        """
+        Reads another chunk from the file; returns False at the end of the file.
+        """
+
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character, or '' at the end of the file.
+        """
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, c):
+
+        next_c = self._peek()
+        if next_c != c:
+            raise ValueError('Error reading {}: expected {}, found {}'.format(
+                self.input_path, repr(c), repr(next_c) if next_c else 'end of file'))
+        self.pos += 1
+
+    def _decode_value(self):
+        """
+        Parses the next complete JSON value, reading more of the file until it's complete.
+        """
+
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value may be incomplete; try again with more data
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _read_fields(self, fields):
+        """
+        Reads "key": value pairs of the top-level object into [fields], until the 'images'
+        key (returns True, positioned at the start of the array) or the end of the object
+        (returns False).
+        """
+
+        while True:
+            c = self._peek()
+            if c == '}':
+                self.pos += 1
+                return False
+            if c == ',':
+                self.pos += 1
+                continue
+            key = self._decode_value()
+            self._expect(':')
+            if key == 'images':
+                return True
+            fields[key] = self._decode_value()
+
+    #%% Public interface
+
+    def iterate_images(self):
+        """
+        Yields the entries of the 'images' array one at a time; can only be called once.
+        """
+
+        assert not self._images_started, 'iterate_images() can only be called once'
+        self._images_started = True
+
+        if self.has_images:
+            self._expect('[')
+            if self._peek() == ']':
+                self.pos += 1
+            else:
+                while True:
+                    yield self._decode_value()
+                    self.n_images += 1
+                    c = self._peek()
+                    self.pos += 1
+                    if c == ']':
+                        break
+                    if c != ',':
+                        raise ValueError('Error reading {}: unexpected {} in images array'.format(
+                            self.input_path, repr(c) if c else 'end of file'))
+            if not self.is_image_list:
+                self._read_fields(self.fields_after_images)
+
+        self.close()
+
+    def close(self):
+
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+        return False
+
+
+#%% Functions
+
+def iterate_api_output_images(input_path):
+    """
+    Yields the 'images' entries of an API output file one at a time.
+    """
+
+    with ApiOutputReader(input_path) as reader:
+        for im in reader.iterate_images():
+            yield im
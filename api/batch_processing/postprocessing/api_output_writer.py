@@ -0,0 +1,267 @@
+#
+# api_output_writer.py
+#
+# Writes batch processing API output (json) incrementally, one 'images' entry at a time,
+# so callers never need to hold the full set of results in memory.
+#
+# The output is byte-compatible with json.dump(results, f, indent=1), i.e. what
+# write_api_results() and convert_output_format.py produce.  Optionally also writes
+# a JSON-lines sidecar with one 'images' entry per line, which is handy for tailing a
+# running job or for line-oriented tools.
+#
+# Format spec:
+#
+# https://github.com/microsoft/CameraTraps/tree/master/api/batch_processing
+#
+
+#%% Imports
+
+import json
+import os
+
+INDENT = 1
+
+
+#%% Helper functions
+
+def _indented_json(obj, level):
+    """
+    Serializes [obj] the way json.dump(..., indent=INDENT) would if [obj] were nested
+    [level] levels deep.
+    """
+
+    s = json.dumps(obj, indent=INDENT)
+    return s.replace('\n', '\n' + ' ' * (INDENT * level))
+
+
+def default_jsonl_path(output_path):
+
+    return os.path.splitext(output_path)[0] + '.jsonl'
+
+
+#%% Classes
+
+class ApiOutputWriter:
+    """
+    Incremental writer for the API output format.  Typical use:
+
+        with ApiOutputWriter(output_path, info, detection_categories) as writer:
+            for im in results:
+                writer.write_image(im)
+
+    Output goes to a temporary file that is renamed to [output_path] by close(), so
+    a partially-written file is never mistaken for a complete result set.  If the
+    'with' block exits with an exception, the temporary file is left in place and
+    [output_path] is not touched.
+
+    Fields other than 'images' are written before the 'images' array, except for
+    trailing_fields passed to close().
+
+    To write many files at once without running out of file handles, suspend() closes
+    the file handle of a writer until the next write_image().
+    """
+
+    def __init__(self, output_path, info, detection_categories, classification_categories=None,
+                 other_fields=None, jsonl_path=None):
+        """
+        Args:
+            output_path: path of the .json file to write
+            info: the 'info' dict
+            detection_categories: dict mapping category IDs to names; int keys are written as
+                strings, as in the API output
+            classification_categories: optional, dict mapping classification IDs to names;
+                written as an empty dict if None
+            other_fields: optional, dict of additional top-level fields
+            jsonl_path: optional, path of a JSON-lines sidecar file to which each image entry
+                is also written
+        """
+
+        if classification_categories is None:
+            classification_categories = {}
+
+        fields = {
+            'info': info,
+            'detection_categories': {str(k): v for k, v in detection_categories.items()},
+            'classification_categories': {str(k): v for k, v in classification_categories.items()}
+        }
+        if other_fields is not None:
+            for k, v in other_fields.items():
+                assert k != 'images', 'Images should be written with write_image()'
+                fields[k] = v
+
+        self._start(output_path, fields, jsonl_path)
+
+    @classmethod
+    def from_fields(cls, output_path, fields, jsonl_path=None):
+        """
+        Creates a writer that writes the top-level fields in [fields] (a dict that doesn't
+        contain 'images') exactly as given, in order, e.g. to preserve the fields of an
+        input file.
+        """
+
+        writer = cls.__new__(cls)
+        assert 'images' not in fields, 'Images should be written with write_image()'
+        writer._start(output_path, fields, jsonl_path)
+        return writer
+
+    def _start(self, output_path, fields, jsonl_path):
+
+        self.output_path = output_path
+        self.temp_path = output_path + '.tmp'
+        self.jsonl_path = jsonl_path
+        self.n_images = 0
+
+        self.f = open(self.temp_path, 'w')
+        self.f.write('{')
+        for k, v in fields.items():
+            self.f.write('\n' + ' ' * INDENT + json.dumps(k) + ': ' + _indented_json(v, 1) + ',')
+        self.f.write('\n' + ' ' * INDENT + '"images": [')
+        self.suspended = False
+
+        self.jsonl_file = None
+        if jsonl_path is not None:
+            self.jsonl_file = open(jsonl_path, 'w')
+
+    def suspend(self):
+        """
+        Closes the file handle(s) until the next write_image() or close().
+        """
+
+        if self.suspended or self.f is None:
+            return
+        for f in [self.f, self.jsonl_file]:
+            if f is not None:
+                f.close()
+        self.suspended = True
+
+    def _resume(self):
+
+        if not self.suspended:
+            return
+        self.f = open(self.temp_path, 'a')
+        if self.jsonl_path is not None:
+            self.jsonl_file = open(self.jsonl_path, 'a')
+        self.suspended = False
+
+    def write_image(self, image_entry):
+        """
+        Appends one entry to the 'images' array.
+        """
+
+        self._resume()
+        if self.n_images > 0:
+            self.f.write(',')
+        self.f.write('\n' + ' ' * (2 * INDENT) + _indented_json(image_entry, 2))
+
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(image_entry) + '\n')
+
+        self.n_images += 1
+
+    def close(self, trailing_fields=None):
+        """
+        Terminates the 'images' array, writes [trailing_fields] (an optional dict of
+        top-level fields to write after 'images'), and moves the output file into place.
+        """
+
+        if self.f is None:
+            return
+
+        self._resume()
+        if self.n_images > 0:
+            self.f.write('\n' + ' ' * INDENT + ']')
+        else:
+            self.f.write(']')
+        if trailing_fields is not None:
+            for k, v in trailing_fields.items():
+                assert k != 'images', 'Images should be written with write_image()'
+                self.f.write(',\n' + ' ' * INDENT + json.dumps(k) + ': ' + _indented_json(v, 1))
+        self.f.write('\n}')
+        self.f.close()
+        self.f = None
+        os.replace(self.temp_path, self.output_path)
+
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+        print('Finished writing {} images to {}'.format(self.n_images, self.output_path))
+
+    def abort(self):
+        """
+        Closes file handles without finalizing the output file.
+        """
+
+        if not self.suspended:
+            for f in [self.f, self.jsonl_file]:
+                if f is not None:
+                    f.close()
+        self.f = None
+        self.jsonl_file = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class ImageListWriter:
+    """
+    Incremental writer for a bare list of 'images' entries, i.e. the intermediate shard
+    files written by the API; byte-compatible with json.dump(images, f, indent=1).
+
+    Like ApiOutputWriter, writes to a temporary file that close() renames to [output_path].
+    """
+
+    def __init__(self, output_path):
+
+        self.output_path = output_path
+        self.temp_path = output_path + '.tmp'
+        self.n_images = 0
+        self.f = open(self.temp_path, 'w')
+        self.f.write('[')
+
+    def write_image(self, image_entry):
+
+        if self.n_images > 0:
+            self.f.write(',')
+        self.f.write('\n' + ' ' * INDENT + _indented_json(image_entry, 1))
+        self.n_images += 1
+
+    def close(self):
+
+        if self.f is None:
+            return
+        if self.n_images > 0:
+            self.f.write('\n')
+        self.f.write(']')
+        self.f.close()
+        self.f = None
+        os.replace(self.temp_path, self.output_path)
+
+        print('Finished writing {} images to {}'.format(self.n_images, self.output_path))
+
+    def abort(self):
+
+        if self.f is not None:
+            self.f.close()
+        self.f = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
@@ -18,12 +18,85 @@
 # Also see combine_api_shard_files (not exposed via the command line yet) to combine the
 # intermediate files created by the API.
 #
+# With --streaming, input files are never loaded into memory as a whole: each input is
+# read one image at a time, inputs that aren't sorted by filename are sorted externally
+# (in sorted runs of at most --max_images_in_memory images, written to temporary files),
+# and the sorted inputs are k-way merged by filename, writing the combined file as we go.
+# If there are more than MAX_MERGE_FAN_IN sorted inputs and runs, they're first merged in
+# passes into larger runs, so we never have more than that many files open at once.
+# The output is identical to the non-streaming output.
+#
 ####
 
 #%% Constants and imports
 
 import json
 import argparse
+import heapq
+import tempfile
+
+from tqdm import tqdm
+
+from api.batch_processing.postprocessing.api_output_reader import ApiOutputReader
+from api.batch_processing.postprocessing.api_output_reader import iterate_api_output_images
+from api.batch_processing.postprocessing.api_output_writer import ApiOutputWriter
+from api.batch_processing.postprocessing.api_output_writer import ImageListWriter
+
+KNOWN_FIELDS = ['info','detection_categories','classification_categories','images']
+
+# Maximum number of images we sort in memory at once when sorting an input externally
+DEFAULT_MAX_IMAGES_IN_MEMORY = 100000
+
+# Maximum number of sorted inputs and runs we merge at once (each is an open file), well
+# below the common limit of 1024 open files per process
+MAX_MERGE_FAN_IN = 256
+
+
+#%% Merge rules
+
+def check_fields(input_dict):
+    """
+    Raises if the top-level fields of *input_dict* contain fields we don't know how to merge.
+    """
+    
+    for k in input_dict:
+        if k not in KNOWN_FIELDS:
+            raise ValueError('Unrecognized API output field in merging: {}'.format(k))
+
+
+def merge_categories(categories,input_categories,category_type='Detection'):
+    """
+    Adds the categories in *input_categories* to *categories* (modified in place), 
+    erroring if a category ID maps to different names.
+    """
+    
+    for cat_id in input_categories:
+        cat_name = input_categories[cat_id]
+        if cat_id in categories:
+            assert categories[cat_id] == cat_name, '{} category mismatch'.format(category_type)
+        else:
+            categories[cat_id] = cat_name
+    
+    
+def merge_info(info,info_compare):
+    """
+    Merges the info dict *info_compare* into *info*, within reason; returns the merged
+    info dict.  *info* is modified in place unless it's empty.
+    """
+    
+    if len(info) == 0:
+        return info_compare
+    
+    assert info_compare['detector'] == info['detector'], 'Incompatible detection versions in merging'
+    assert info_compare['format_version'] == info['format_version'], 'Incompatible API output versions in merging'
+    if 'classifier' in info_compare:
+        if 'classifier' in info:
+            assert info['classifier'] == info_compare['classifier']
+        else:
+            info['classifier'] = info_compare['classifier']
+    # Don't check completion time fields
+    
+    return info
 
 
 #%% Merge functions
@@ -66,27 +139,15 @@ def combine_api_output_dictionaries(input_dicts,require_uniqueness=True):
     
     for input_dict in input_dicts:
         
-        known_fields = ['info','detection_categories','classification_categories','images']
-        for k in input_dict:
-            if k not in known_fields:
-                raise ValueError('Unrecognized API output field in merging: {}'.format(k))
+        check_fields(input_dict)
                 
         # Check compatibility of detection categories
-        for cat_id in input_dict['detection_categories']:
-            cat_name = input_dict['detection_categories'][cat_id]
-            if cat_id in detection_categories:
-                assert detection_categories[cat_id] == cat_name, 'Detection category mismatch'
-            else:
-                detection_categories[cat_id] = cat_name
+        merge_categories(detection_categories,input_dict['detection_categories'],'Detection')
         
         # Check compatibility of classification categories
         if 'classification_categories' in input_dict:
-            for cat_id in input_dict['classification_categories']:
-                cat_name = input_dict['classification_categories'][cat_id]
-                if cat_id in classification_categories:
-                    assert classification_categories[cat_id] == cat_name, 'Classification category mismatch'
-                else:
-                    classification_categories[cat_id] = cat_name
+            merge_categories(classification_categories,input_dict['classification_categories'],
+                             'Classification')
         
         # Merge image lists, checking uniqueness
         for im in input_dict['images']:
@@ -99,18 +160,7 @@ def combine_api_output_dictionaries(input_dicts,require_uniqueness=True):
             n_images += 1
         
         # Merge info dicts, within reason
-        if len(info) == 0:
-            info = input_dict['info']
-        else:
-            info_compare = input_dict['info']
-            assert info_compare['detector'] == info['detector'], 'Incompatible detection versions in merging'
-            assert info_compare['format_version'] == info['format_version'], 'Incompatible API output versions in merging'
-            if 'classifier' in info_compare:
-                if 'classifier' in info:
-                    assert info['classifier'] == info_compare['classifier']
-                else:
-                    info['classifier'] = info_compare['classifier']
-            # Don't check completion time fields
+        info = merge_info(info,input_dict['info'])
                     
     # ...for each dictionary
 
@@ -158,6 +208,248 @@ def combine_api_shard_files(input_files,output_file=None):
     return detections
 
 
+#%% Streaming merge
+
+def check_shard_image(im):
+    
+    assert 'file' in im
+    assert 'max_detection_conf' in im
+    assert 'detections' in im
+    
+    
+def scan_input_file(input_file,check_image=None):
+    """
+    Reads through *input_file* one image at a time, without keeping images in memory.
+    
+    Returns the top-level fields other than 'images' (an empty dict for shard files), and 
+    whether the images are sorted by filename.
+    """
+    
+    is_sorted = True
+    previous_fn = None
+    with ApiOutputReader(input_file) as reader:
+        for im in reader.iterate_images():
+            if check_image is not None:
+                check_image(im)
+            fn = im['file']
+            if previous_fn is not None and fn < previous_fn:
+                is_sorted = False
+            previous_fn = fn
+        return reader.fields, is_sorted
+    
+
+def iterate_jsonl_images(run_file):
+    
+    with open(run_file) as f:
+        for line in f:
+            yield json.loads(line)
+            
+            
+def write_sorted_runs(input_file,temp_dir,max_images_in_memory=DEFAULT_MAX_IMAGES_IN_MEMORY):
+    """
+    Sorts the images in *input_file* by filename in chunks of *max_images_in_memory* images,
+    writing each sorted chunk ("run") to a .jsonl file in *temp_dir*.
+    
+    Returns the list of run files, in order.  Sorting is stable, so images with the same 
+    filename stay in the order they appear in *input_file*.
+    """
+    
+    run_files = []
+    
+    def write_run(images):
+        images.sort(key=lambda im: im['file'])
+        with tempfile.NamedTemporaryFile('w',dir=temp_dir,suffix='.jsonl',delete=False) as f:
+            for im in images:
+                f.write(json.dumps(im) + '\n')
+        run_files.append(f.name)
+        
+    images = []
+    for im in iterate_api_output_images(input_file):
+        images.append(im)
+        if len(images) >= max_images_in_memory:
+            write_run(images)
+            images = []
+    if len(images) > 0:
+        write_run(images)
+        
+    return run_files
+
+
+def merge_sorted_image_streams(streams,require_uniqueness=True):
+    """
+    K-way merges *streams*, a list of iterables of images that are each sorted by filename,
+    yielding images sorted by filename.
+    
+    If several images have the same filename, only the one from the last stream (or the 
+    last one within a stream) is yielded, as in combine_api_output_dictionaries; if 
+    *require_uniqueness* is True, errors instead.
+    
+    Returns (via StopIteration.value) the number of redundant images that were dropped.
+    """
+    
+    n_redundant_images = 0
+    pending_im = None
+    
+    # heapq.merge breaks ties by stream order, and streams are each stably sorted, so images 
+    # with the same filename come out in input order
+    for im in heapq.merge(*streams,key=lambda im: im['file']):
+        if pending_im is not None:
+            if pending_im['file'] == im['file']:
+                if require_uniqueness:
+                    raise AssertionError('Duplicate image: {}'.format(im['file']))
+                n_redundant_images += 1
+            else:
+                yield pending_im
+        pending_im = im
+        
+    if pending_im is not None:
+        yield pending_im
+        
+    return n_redundant_images
+
+
+def merge_streams_to_runs(streams,temp_dir,max_fan_in=MAX_MERGE_FAN_IN):
+    """
+    While there are more than *max_fan_in* of *streams* (sorted image streams, none of 
+    which have been started), merges consecutive groups of at most *max_fan_in* streams
+    into runs in *temp_dir*.
+    
+    Returns the list of at most *max_fan_in* streams.  All images are kept, and since
+    groups are consecutive and heapq.merge is stable, images with the same filename stay
+    in stream order.
+    """
+    
+    while len(streams) > max_fan_in:
+        print('Merging {} sorted runs in groups of {}'.format(len(streams),max_fan_in))
+        merged_streams = []
+        for i_start in range(0,len(streams),max_fan_in):
+            group = streams[i_start:i_start+max_fan_in]
+            if len(group) == 1:
+                merged_streams.append(group[0])
+                continue
+            with tempfile.NamedTemporaryFile('w',dir=temp_dir,suffix='.jsonl',delete=False) as f:
+                for im in heapq.merge(*group,key=lambda im: im['file']):
+                    f.write(json.dumps(im) + '\n')
+            merged_streams.append(iterate_jsonl_images(f.name))
+        streams = merged_streams
+        
+    return streams
+
+
+def sorted_image_streams(input_files,input_is_sorted,temp_dir,max_images_in_memory,
+                         max_fan_in=MAX_MERGE_FAN_IN):
+    """
+    Returns at most *max_fan_in* image streams, each sorted by filename, in input file 
+    order; unsorted inputs are sorted into runs in *temp_dir* first, and runs are merged
+    into larger runs if there are too many to merge at once.
+    """
+    
+    streams = []
+    for input_file,is_sorted in zip(input_files,input_is_sorted):
+        if is_sorted:
+            streams.append(iterate_api_output_images(input_file))
+        else:
+            print('Sorting {}'.format(input_file))
+            run_files = write_sorted_runs(input_file,temp_dir,max_images_in_memory)
+            streams.extend(iterate_jsonl_images(run_file) for run_file in run_files)
+    return merge_streams_to_runs(streams,temp_dir,max_fan_in)
+
+
+def write_merged_images(writer,streams,require_uniqueness):
+    """
+    Writes the k-way merge of *streams* to *writer*; returns the number of redundant images.
+    """
+    
+    merged = merge_sorted_image_streams(streams,require_uniqueness)
+    progress = tqdm()
+    try:
+        while True:
+            writer.write_image(next(merged))
+            progress.update()
+    except StopIteration as e:
+        return e.value
+    finally:
+        progress.close()
+        
+        
+def combine_api_output_files_streaming(input_files,output_file,require_uniqueness=True,
+                                       max_images_in_memory=DEFAULT_MAX_IMAGES_IN_MEMORY,
+                                       temp_dir=None):
+    """
+    Merges the list of .json-formatted API output files *input_files* into *output_file*,
+    following the same rules (and writing the same output) as combine_api_output_files, 
+    but without loading the input files into memory.
+    
+    *temp_dir* is where inputs that aren't sorted by filename are sorted; defaults to the
+    system temporary folder.
+    
+    Returns the number of images written.
+    """
+    
+    info = {}
+    detection_categories = {}
+    classification_categories = {}
+    input_is_sorted = []
+    
+    # Merge and check the top-level fields first, since they're written before 'images'
+    print('Reading input files')
+    for fn in input_files:
+        fields, is_sorted = scan_input_file(fn)
+        check_fields(fields)
+        merge_categories(detection_categories,fields['detection_categories'],'Detection')
+        if 'classification_categories' in fields:
+            merge_categories(classification_categories,fields['classification_categories'],
+                             'Classification')
+        info = merge_info(info,fields['info'])
+        input_is_sorted.append(is_sorted)
+    
+    print('Merging results')
+    with tempfile.TemporaryDirectory(dir=temp_dir) as run_dir:
+        streams = sorted_image_streams(input_files,input_is_sorted,run_dir,max_images_in_memory)
+        with ApiOutputWriter(output_file,info,detection_categories,classification_categories) as writer:
+            n_redundant_images = write_merged_images(writer,streams,require_uniqueness)
+            
+    if n_redundant_images > 0:
+        print('Warning: found {} redundant images (of {}) during merge'.format(
+            n_redundant_images,writer.n_images + n_redundant_images))
+        
+    return writer.n_images
+
+
+def combine_api_shard_files_streaming(input_files,output_file,require_uniqueness=False,
+                                      max_images_in_memory=DEFAULT_MAX_IMAGES_IN_MEMORY,
+                                      temp_dir=None):
+    """
+    Merges the list of .json-formatted API shard files *input_files* into a single list of
+    image entries in *output_file*, without loading the input files into memory.
+    
+    Unlike combine_api_shard_files, which concatenates shards, the output is sorted by 
+    filename, and images that appear in more than one shard are only written once (or
+    cause an error if *require_uniqueness* is True).
+    
+    Returns the number of images written.
+    """
+    
+    input_is_sorted = []
+    print('Reading input files')
+    for fn in input_files:
+        fields, is_sorted = scan_input_file(fn,check_shard_image)
+        assert len(fields) == 0, '{} is not a shard file'.format(fn)
+        input_is_sorted.append(is_sorted)
+        
+    print('Merging results')
+    with tempfile.TemporaryDirectory(dir=temp_dir) as run_dir:
+        streams = sorted_image_streams(input_files,input_is_sorted,run_dir,max_images_in_memory)
+        with ImageListWriter(output_file) as writer:
+            n_redundant_images = write_merged_images(writer,streams,require_uniqueness)
+    
+    if n_redundant_images > 0:
+        print('Warning: found {} redundant images (of {}) during merge'.format(
+            n_redundant_images,writer.n_images + n_redundant_images))
+        
+    return writer.n_images
+
+
 #%% Driver
     
 def main():
@@ -165,8 +457,19 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_paths', nargs='+', help='List of input .json files')
     parser.add_argument('output_path', help='Output .json file')
+    parser.add_argument('--streaming', action='store_true', 
+                        help='Merge without loading input files into memory')
+    parser.add_argument('--max_images_in_memory', type=int, default=DEFAULT_MAX_IMAGES_IN_MEMORY,
+                        help='In streaming mode, the maximum number of images to sort in memory at once')
+    parser.add_argument('--temp_dir', default=None,
+                        help='In streaming mode, where to sort input files that aren\'t sorted by filename')
     args = parser.parse_args()
-    combine_api_output_files(args.input_paths,args.output_path)
+    if args.streaming:
+        combine_api_output_files_streaming(args.input_paths,args.output_path,
+                                           max_images_in_memory=args.max_images_in_memory,
+                                           temp_dir=args.temp_dir)
+    else:
+        combine_api_output_files(args.input_paths,args.output_path)
     
 if __name__ == '__main__':
     main()
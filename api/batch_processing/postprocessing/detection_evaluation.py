@@ -0,0 +1,955 @@
+########
+#
+# detection_evaluation.py
+#
+# Evaluates one or more batch API output files against ground truth in the COCO Camera Traps
+# format, using NumPy arrays rather than per-image dicts:
+#
+# * The ground truth is reduced once to arrays sorted by file name: each image's detection status
+#   (positive/negative/ambiguous/unknown), its categories, and its unambiguous category.  These
+#   can be cached next to the ground truth file, so evaluating another detector on the same
+#   benchmark doesn't pay for parsing and indexing the database again.
+#
+# * Detector results are matched to ground truth with a binary search over the sorted file names.
+#
+# * Precision/recall, confusion counts and per-class recall are computed for any number of
+#   thresholds in one pass over the sorted confidences, rather than once per threshold.
+#
+# * Besides image-level metrics, detectors are evaluated at sequence level (a sequence's
+#   confidence is the highest max_detection_conf of its images, and a sequence is positive if
+#   any of its images is) and for each location.
+#
+# postprocess_batch_results.py uses this module for its precision/recall analysis; it can also
+# be run from the command line to compare several detectors on the same ground truth, and to
+# fail when a detector's average precision drops below a baseline's (see
+# benchmark/run_benchmark.py).
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from enum import IntEnum
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import precision_recall_curve, average_precision_score
+
+from api.batch_processing.postprocessing.load_api_results import load_api_results_columnar
+from api.batch_processing.postprocessing.sequence_aggregation import SequenceIndex
+from api.batch_processing.postprocessing.sequence_aggregation import aggregate_sequences
+
+DEFAULT_NEGATIVE_CLASSES = ['empty']
+DEFAULT_UNKNOWN_CLASSES = ['unknown', 'unlabeled', 'ambiguous']
+
+GROUND_TRUTH_CACHE_VERSION = 2
+GROUND_TRUTH_CACHE_SUFFIX = '.eval_cache.npz'
+
+
+# Flags used to mark images as positive or negative for P/R analysis (according
+# to ground truth and/or detector output)
+class DetectionStatus(IntEnum):
+
+    # This image is a negative
+    DS_NEGATIVE = 0
+
+    # This image is a positive
+    DS_POSITIVE = 1
+
+    # Anything greater than this isn't clearly positive or negative
+    DS_MAX_DEFINITIVE_VALUE = DS_POSITIVE
+
+    # This image has annotations suggesting both negative and positive
+    DS_AMBIGUOUS = 2
+
+    # This image is not annotated or is annotated with 'unknown', 'unlabeled', ETC.
+    DS_UNKNOWN = 3
+
+    # This image has not yet been assigned a state
+    DS_UNASSIGNED = 4
+
+    # In some analyses, we add an additional class that lets us look at detections just below
+    # our main confidence threshold
+    DS_ALMOST = 5
+
+
+#%% Ground truth
+
+def image_detection_status(image_category_names, negative_classes, unknown_classes):
+    """
+    Decides whether to treat an image with the set of category names image_category_names as
+    positive, negative, ambiguous, or unknown.
+
+    Returns a DetectionStatus
+    """
+
+    # Check if image has unassigned-type labels
+    image_has_unknown_labels = len(image_category_names & unknown_classes) > 0
+    assert image_has_unknown_labels is False, '{} has unknown labels'.format(image_category_names)
+    # Check if image has negative-type labels
+    image_has_negative_labels = len(image_category_names & negative_classes) > 0
+    # Check if image has positive labels
+    # i.e. if we remove negative and unknown labels from image_category_names, then
+    # there are still labels left
+    image_has_positive_labels = 0 < len(image_category_names - unknown_classes - negative_classes)
+
+    # If there are no image annotations, we treat the image as negative
+    if len(image_category_names) == 0:
+        return DetectionStatus.DS_NEGATIVE
+
+    # If the image has more than one type of labels, it's ambiguous
+    # note: booleans get automatically converted to 0/1, hence we can use the sum
+    if image_has_unknown_labels + image_has_negative_labels + image_has_positive_labels > 1:
+        return DetectionStatus.DS_AMBIGUOUS
+
+    if image_has_unknown_labels:
+        return DetectionStatus.DS_UNKNOWN
+
+    if image_has_negative_labels:
+        return DetectionStatus.DS_NEGATIVE
+
+    if image_has_positive_labels:
+        return DetectionStatus.DS_POSITIVE
+
+    raise Exception('Invalid state, please check the code for bugs')
+
+
+class GroundTruthArrays:
+    """
+    Per-image ground truth for a COCO Camera Traps database, sorted by file name.
+
+    The categories of image i are category_names[image_category_index[j]] for j in
+    image_category_start[i] ... image_category_start[i] + image_category_count[i] - 1, sorted
+    by name.
+    """
+
+    # Unicode arrays of length n_images; file names are sorted and unique
+    file_names = None
+    image_ids = None
+
+    # int8 array of DetectionStatus values
+    detection_status = None
+
+    # Sorted list of all category names
+    category_names = None
+
+    # int64 arrays of length n_images, int32 array of length n_image_categories
+    image_category_start = None
+    image_category_count = None
+    image_category_index = None
+
+    # int32 array, index into category_names of the single category of positive images that
+    # have exactly one category, -1 for all other images
+    unambiguous_category = None
+
+    # Unicode arrays of each image's location and seq_id ('' if missing)
+    locations = None
+    seq_ids = None
+
+    @property
+    def n_images(self):
+        return len(self.file_names)
+
+    def find(self, file_names):
+        """
+        Looks up file names (a sequence of strings) in the ground truth.
+
+        Returns an int64 array with the index of each file in this object, or -1 for files that
+        are not in the ground truth.
+        """
+
+        file_names = np.asarray(file_names, dtype=str)
+        if self.n_images == 0:
+            return np.full(len(file_names), -1, dtype=np.int64)
+        indices = np.searchsorted(self.file_names, file_names)
+        indices = np.minimum(indices, self.n_images - 1)
+        b_found = self.file_names[indices] == file_names
+        return np.where(b_found, indices, -1).astype(np.int64)
+
+    def image_category_names(self, i_image):
+        """
+        Returns the sorted list of category names of image i_image.
+        """
+
+        start = self.image_category_start[i_image]
+        indices = self.image_category_index[start:start + self.image_category_count[i_image]]
+        return [self.category_names[i] for i in indices]
+
+    def status_counts(self):
+        """
+        Returns (n_negative, n_positive, n_unknown, n_ambiguous)
+        """
+
+        counts = np.bincount(self.detection_status, minlength=len(DetectionStatus))
+        return (counts[DetectionStatus.DS_NEGATIVE], counts[DetectionStatus.DS_POSITIVE],
+                counts[DetectionStatus.DS_UNKNOWN], counts[DetectionStatus.DS_AMBIGUOUS])
+
+
+def ground_truth_arrays_from_db(db, normalize_paths=True, filename_replacements={},
+                                negative_classes=DEFAULT_NEGATIVE_CLASSES,
+                                unknown_classes=DEFAULT_UNKNOWN_CLASSES):
+    """
+    Builds a GroundTruthArrays object from a COCO Camera Traps database (a dict).  File names
+    are normalized and replaced the same way IndexedJsonDb does it.
+    """
+
+    negative_classes = set(negative_classes)
+    unknown_classes = set(unknown_classes)
+
+    cat_id_to_name = {cat['id']: cat['name'] for cat in db['categories']}
+    image_id_to_category_names = defaultdict(set)
+    for ann in db['annotations']:
+        image_id_to_category_names[ann['image_id']].add(cat_id_to_name[ann['category_id']])
+
+    images = db['images']
+    file_names = []
+    for im in images:
+        fn = im['file_name']
+        if normalize_paths:
+            fn = os.path.normpath(fn)
+        for s in filename_replacements:
+            fn = fn.replace(s, filename_replacements[s])
+        file_names.append(fn)
+
+    # If a file name appears more than once, the last image wins, as in IndexedJsonDb.filename_to_id
+    file_names = np.array(file_names, dtype=str)
+    _, i_last_reversed = np.unique(file_names[::-1], return_index=True)
+    i_images = len(images) - 1 - i_last_reversed
+
+    category_names = sorted(set(cat_id_to_name.values()))
+    category_name_to_index = {name: i for i, name in enumerate(category_names)}
+
+    n_images = len(i_images)
+    detection_status = np.zeros(n_images, dtype=np.int8)
+    image_category_count = np.zeros(n_images, dtype=np.int64)
+    unambiguous_category = np.full(n_images, -1, dtype=np.int32)
+    image_category_index = []
+
+    for i_out, i_image in enumerate(i_images):
+
+        image_category_names = image_id_to_category_names.get(images[i_image]['id'], set())
+        status = image_detection_status(image_category_names, negative_classes, unknown_classes)
+        detection_status[i_out] = status
+
+        category_indices = sorted(category_name_to_index[name] for name in image_category_names)
+        image_category_count[i_out] = len(category_indices)
+        image_category_index.extend(category_indices)
+        if status == DetectionStatus.DS_POSITIVE and len(category_indices) == 1:
+            unambiguous_category[i_out] = category_indices[0]
+
+    gt = GroundTruthArrays()
+    gt.file_names = file_names[i_images]
+    gt.image_ids = np.array([str(images[i]['id']) for i in i_images], dtype=str)
+    gt.detection_status = detection_status
+    gt.category_names = category_names
+    gt.image_category_count = image_category_count
+    gt.image_category_start = np.zeros(n_images, dtype=np.int64)
+    gt.image_category_start[1:] = np.cumsum(image_category_count)[:-1]
+    gt.image_category_index = np.array(image_category_index, dtype=np.int32)
+    gt.unambiguous_category = unambiguous_category
+    gt.locations = np.array([str(images[i].get('location', '')) for i in i_images], dtype=str)
+    gt.seq_ids = np.array([str(images[i].get('seq_id', '')) for i in i_images], dtype=str)
+    return gt
+
+
+def ground_truth_cache_path(ground_truth_json_file):
+
+    return ground_truth_json_file + GROUND_TRUTH_CACHE_SUFFIX
+
+
+_GROUND_TRUTH_ARRAY_FIELDS = ['file_names', 'image_ids', 'detection_status', 'image_category_start',
+                              'image_category_count', 'image_category_index', 'unambiguous_category',
+                              'locations', 'seq_ids']
+
+
+def _ground_truth_cache_metadata(ground_truth_json_file, normalize_paths, filename_replacements,
+                                 negative_classes, unknown_classes):
+
+    st = os.stat(ground_truth_json_file)
+    return {'version': GROUND_TRUTH_CACHE_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'normalize_paths': normalize_paths, 'filename_replacements': filename_replacements,
+            'negative_classes': sorted(negative_classes), 'unknown_classes': sorted(unknown_classes)}
+
+
+def _write_ground_truth_cache(gt, cache_path, metadata):
+
+    arrays = {field: getattr(gt, field) for field in _GROUND_TRUTH_ARRAY_FIELDS}
+    arrays['category_names'] = np.array(gt.category_names, dtype=str)
+    arrays['metadata'] = np.array(json.dumps(metadata))
+
+    # Write to a temporary file first, so a partially-written cache is never picked up
+    temp_path = cache_path + '.tmp.npz'
+    try:
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print('Warning: could not write ground truth cache {}: {}'.format(cache_path, e))
+
+
+def _read_ground_truth_cache(cache_path, metadata):
+    """
+    Returns a GroundTruthArrays object, or None if there is no up-to-date cache.
+    """
+
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if json.loads(str(cache['metadata'])) != metadata:
+                return None
+            gt = GroundTruthArrays()
+            for field in _GROUND_TRUTH_ARRAY_FIELDS:
+                setattr(gt, field, cache[field])
+            gt.category_names = cache['category_names'].tolist()
+    except (OSError, ValueError, KeyError) as e:
+        print('Warning: ignoring unreadable ground truth cache {}: {}'.format(cache_path, e))
+        return None
+    return gt
+
+
+def load_ground_truth_arrays(ground_truth_json_file, normalize_paths=True, filename_replacements={},
+                             negative_classes=DEFAULT_NEGATIVE_CLASSES, unknown_classes=DEFAULT_UNKNOWN_CLASSES,
+                             use_cache=False):
+    """
+    Loads a COCO Camera Traps .json file as a GroundTruthArrays object.
+
+    If use_cache is True, reads the arrays from <ground_truth_json_file>.eval_cache.npz if it
+    was written for the current version of the .json file with the same options, and
+    (re-)writes it otherwise.
+    """
+
+    metadata = None
+    if use_cache:
+        metadata = _ground_truth_cache_metadata(ground_truth_json_file, normalize_paths, filename_replacements,
+                                                negative_classes, unknown_classes)
+        cache_path = ground_truth_cache_path(ground_truth_json_file)
+        gt = _read_ground_truth_cache(cache_path, metadata)
+        if gt is not None:
+            print('Loaded ground truth for {} images from cache {}'.format(gt.n_images, cache_path))
+            return gt
+
+    print('Loading ground truth from {}'.format(ground_truth_json_file))
+    with open(ground_truth_json_file) as f:
+        db = json.load(f)
+    gt = ground_truth_arrays_from_db(db, normalize_paths=normalize_paths,
+                                     filename_replacements=filename_replacements,
+                                     negative_classes=negative_classes, unknown_classes=unknown_classes)
+    del db
+
+    if use_cache:
+        _write_ground_truth_cache(gt, cache_path, metadata)
+
+    return gt
+
+
+#%% Matching detector output to ground truth
+
+class EvaluationArrays:
+    """
+    Detector results for the images that could be matched to ground truth, one element per
+    image, in the order of the detector results.
+    """
+
+    # int64 index of each image in the detector results
+    result_index = None
+
+    # int64 index of each image in the GroundTruthArrays
+    gt_index = None
+
+    # float64 maximum detection confidence (0 for images without a confidence)
+    max_conf = None
+
+    # float64 ground truth label for detection: 1.0 (positive), 0.0 (negative), or -1.0 for
+    # ambiguous/unknown images, which are excluded from precision/recall
+    gt_label = None
+
+    # int32 unambiguous ground truth category (index into GroundTruthArrays.category_names), or -1
+    gt_category = None
+
+    # Predicted top-1 classes: one element per unique (image, class) pair, where image is an
+    # index into the arrays above and class is an index into class_names
+    prediction_image_index = None
+    prediction_class = None
+    class_names = None
+
+    @property
+    def n_images(self):
+        return len(self.gt_index)
+
+
+def match_to_ground_truth(gt, file_names, max_conf, predicted_classes=None):
+    """
+    Aligns detector results with ground truth.
+
+    Args:
+        gt: a GroundTruthArrays object
+        file_names: sequence of detector result file names, normalized like the ground truth
+        max_conf: sequence of maximum detection confidences, aligned with file_names
+        predicted_classes: optional, (image index, class name) pairs of predicted top-1
+            classifications, where image index is an index into file_names
+
+    Returns:
+        an EvaluationArrays object
+    """
+
+    gt_index = gt.find(file_names)
+    b_match = gt_index >= 0
+
+    ev = EvaluationArrays()
+    ev.result_index = np.nonzero(b_match)[0]
+    ev.gt_index = gt_index[b_match]
+    ev.max_conf = np.nan_to_num(np.asarray(max_conf, dtype=np.float64)[b_match], nan=0.0)
+
+    status = gt.detection_status[ev.gt_index]
+    ev.gt_label = np.where(status == DetectionStatus.DS_POSITIVE, 1.0,
+                           np.where(status == DetectionStatus.DS_NEGATIVE, 0.0, -1.0))
+    gt_category = gt.unambiguous_category[ev.gt_index]
+
+    # Predicted and ground truth classes share one index
+    predicted_classes = [] if predicted_classes is None else list(predicted_classes)
+    ev.class_names = sorted(set(gt.category_names) | set(name for _, name in predicted_classes))
+    class_name_to_index = {name: i for i, name in enumerate(ev.class_names)}
+    gt_to_class = np.array([class_name_to_index[name] for name in gt.category_names] + [-1], dtype=np.int32)
+    ev.gt_category = gt_to_class[gt_category]
+
+    # Map detector result indices to indices into the matched images
+    result_to_matched = np.full(len(gt_index), -1, dtype=np.int64)
+    result_to_matched[ev.result_index] = np.arange(len(ev.result_index))
+    pairs = set()
+    for i_result, name in predicted_classes:
+        i_matched = result_to_matched[i_result]
+        if i_matched >= 0:
+            pairs.add((i_matched, class_name_to_index[name]))
+    pairs = np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+    ev.prediction_image_index = pairs[:, 0]
+    ev.prediction_class = pairs[:, 1].astype(np.int32)
+
+    return ev
+
+
+def predicted_classes_from_detections(detections_per_image, classification_categories_map):
+    """
+    Collects the top-1 classification of each detection that has one.
+
+    Args:
+        detections_per_image: sequence of lists of detections in the API output format
+        classification_categories_map: dict mapping classification category IDs to names
+
+    Returns: list of (image index, class name) tuples
+    """
+
+    predicted_classes = []
+    for i_image, detections in enumerate(detections_per_image):
+        for det in detections:
+            if 'classifications' in det:
+                predicted_classes.append((i_image, classification_categories_map[det['classifications'][0][0]]))
+    return predicted_classes
+
+
+def predicted_classes_from_columnar_results(results):
+    """
+    Same as predicted_classes_from_detections(), for a ColumnarApiResults object.
+    """
+
+    classification_categories_map = results.other_fields.get('classification_categories', {})
+    predicted_classes = []
+    for i_detection, extra_fields in results.detection_extra_fields.items():
+        if 'classifications' in extra_fields:
+            predicted_classes.append((int(results.detection_image_index[i_detection]),
+                                      classification_categories_map[extra_fields['classifications'][0][0]]))
+    return predicted_classes
+
+
+#%% Sequences
+
+def sequence_labels(gt):
+    """
+    Computes the ground truth label of each sequence in a GroundTruthArrays object: 1.0
+    (positive) if any of its images is positive, 0.0 (negative) if all of them are negative,
+    and -1.0 otherwise.  Images without a seq_id are left out.
+
+    Returns:
+        seq_ids: unicode array of seq_ids
+        labels: float64 array aligned with seq_ids
+    """
+
+    b_has_seq = gt.seq_ids != ''
+    seq_codes, seq_ids = pd.factorize(gt.seq_ids[b_has_seq])
+    status = gt.detection_status[b_has_seq]
+    n_seqs = len(seq_ids)
+
+    n_images = np.bincount(seq_codes, minlength=n_seqs)
+    n_positive = np.bincount(seq_codes, weights=(status == DetectionStatus.DS_POSITIVE), minlength=n_seqs)
+    n_negative = np.bincount(seq_codes, weights=(status == DetectionStatus.DS_NEGATIVE), minlength=n_seqs)
+
+    labels = np.where(n_positive > 0, 1.0, np.where(n_negative == n_images, 0.0, -1.0))
+    return np.asarray(seq_ids, dtype=str), labels
+
+
+def sequence_index_from_ground_truth(gt):
+    """
+    Builds a sequence_aggregation.SequenceIndex that matches detector results to sequences by
+    file name, from a GroundTruthArrays object.
+    """
+
+    b_has_seq = gt.seq_ids != ''
+    index = SequenceIndex()
+    index.keys = gt.file_names[b_has_seq]
+    index.seq_ids = gt.seq_ids[b_has_seq].astype(object)
+    index.frame_nums = np.full(len(index.keys), np.nan)
+    return index
+
+
+#%% Metrics
+
+def _counts_above_thresholds(conf, thresholds, groups, n_groups):
+    """
+    For each group and each threshold t (in the given order), counts the elements of conf in
+    that group that are > t, in one pass over conf.  groups is an int array of group indices
+    aligned with conf.
+
+    Confidences are loaded as float32 (see load_api_results_columnar()), so confidences and
+    thresholds are both compared at float32 precision; otherwise a confidence of exactly 0.05
+    would count as > 0.05.
+
+    Returns: an int64 array of shape (n_groups, len(thresholds))
+    """
+
+    thresholds = np.asarray(thresholds, dtype=np.float32).astype(np.float64)
+    conf = np.asarray(conf, dtype=np.float32).astype(np.float64)
+    n_thresholds = len(thresholds)
+    order = np.argsort(thresholds, kind='stable')
+
+    # The number of (sorted) thresholds below each confidence, i.e. an element counts
+    # for sorted thresholds 0 ... k - 1
+    k = np.searchsorted(thresholds[order], conf, side='left')
+    counts = np.bincount(groups * (n_thresholds + 1) + k,
+                         minlength=n_groups * (n_thresholds + 1)).reshape(n_groups, n_thresholds + 1)
+
+    # counts_above[:, j] = number of elements with k > j
+    counts_above = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+    result = np.empty_like(counts_above)
+    result[:, order] = counts_above
+    return result
+
+
+def confusion_counts(conf, gt_label, thresholds):
+    """
+    Counts true/false positives/negatives at each threshold, predicting positive when
+    conf > threshold.  Elements with gt_label < 0 are ignored.
+
+    Returns: tp, fp, fn, tn, int64 arrays aligned with thresholds
+    """
+
+    tp, fp, fn, tn = grouped_confusion_counts(conf, gt_label, np.zeros(len(conf), dtype=np.int64), 1, thresholds)
+    return tp[0], fp[0], fn[0], tn[0]
+
+
+def grouped_confusion_counts(conf, gt_label, groups, n_groups, thresholds):
+    """
+    Same as confusion_counts(), separately for each group (e.g. location) in one pass; groups
+    is an int array of group indices aligned with conf.
+
+    Returns: tp, fp, fn, tn, int64 arrays of shape (n_groups, len(thresholds))
+    """
+
+    conf = np.asarray(conf, dtype=np.float64)
+    gt_label = np.asarray(gt_label)
+    b_valid = gt_label >= 0
+    b_positive = (gt_label[b_valid] > 0).astype(np.int64)
+    groups = np.asarray(groups, dtype=np.int64)[b_valid] * 2 + b_positive
+    counts_above = _counts_above_thresholds(conf[b_valid], thresholds, groups, n_groups=n_groups * 2)
+    counts = np.bincount(groups, minlength=n_groups * 2).reshape(n_groups, 2)
+
+    fp = counts_above[0::2]
+    tp = counts_above[1::2]
+    return tp, fp, counts[:, [1]] - tp, counts[:, [0]] - fp
+
+
+def _confusion_metrics(tp, fp, fn, tn, thresholds):
+    """
+    Converts confusion counts (arrays aligned with thresholds) to a DataFrame with columns
+    confidence_threshold, tp, fp, fn, tn, precision, recall, f1, accuracy.
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        f1 = 2.0 * precision * recall / (precision + recall)
+        accuracy = (tp + tn) / (tp + fp + fn + tn)
+    return pd.DataFrame(data={
+        'confidence_threshold': np.asarray(thresholds, dtype=np.float64),
+        'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+        'precision': precision, 'recall': recall, 'f1': f1, 'accuracy': accuracy
+    })
+
+
+def threshold_metrics(conf, gt_label, thresholds):
+    """
+    Computes precision, recall, F1 and accuracy at each threshold.
+
+    Returns: a DataFrame with columns confidence_threshold, tp, fp, fn, tn, precision, recall,
+        f1, accuracy
+    """
+
+    tp, fp, fn, tn = confusion_counts(conf, gt_label, thresholds)
+    return _confusion_metrics(tp, fp, fn, tn, thresholds)
+
+
+def location_metrics(conf, gt_label, locations, thresholds):
+    """
+    Computes image-level metrics for each location, with the confusion counts for all
+    locations and thresholds in one pass.
+
+    Returns: a DataFrame with columns location, n_positive, n_negative, average_precision,
+        and the columns of threshold_metrics(), one row per (location, threshold)
+    """
+
+    location_codes, location_names = pd.factorize(np.asarray(locations))
+    n_locations = len(location_names)
+    tp, fp, fn, tn = grouped_confusion_counts(conf, gt_label, location_codes, n_locations, thresholds)
+
+    all_metrics = []
+    for i_location, location in enumerate(location_names):
+        b_location = location_codes == i_location
+        location_labels = gt_label[b_location]
+        metrics = _confusion_metrics(tp[i_location], fp[i_location], fn[i_location], tn[i_location],
+                                     thresholds)
+        metrics.insert(0, 'location', location)
+        metrics.insert(1, 'n_positive', int(np.sum(location_labels > 0)))
+        metrics.insert(2, 'n_negative', int(np.sum(location_labels == 0)))
+        metrics.insert(3, 'average_precision',
+                       average_precision_at_recall(conf[b_location], location_labels, 1.0)[0])
+        all_metrics.append(metrics)
+
+    if len(all_metrics) == 0:
+        return pd.DataFrame()
+    return pd.concat(all_metrics, ignore_index=True)
+
+
+def per_class_recall(conf, gt_label, gt_category, class_names, thresholds):
+    """
+    Computes, for each ground truth class, the fraction of positive images with that
+    (unambiguous) class for which conf > threshold, at each threshold.
+
+    Returns: a DataFrame with columns class, n_images, confidence_threshold, recall
+    """
+
+    b_valid = (np.asarray(gt_label) > 0) & (np.asarray(gt_category) >= 0)
+    categories = np.asarray(gt_category)[b_valid].astype(np.int64)
+    n_classes = len(class_names)
+    counts_above = _counts_above_thresholds(np.asarray(conf, dtype=np.float64)[b_valid], thresholds,
+                                            categories, n_groups=n_classes)
+    n_images = np.bincount(categories, minlength=n_classes)
+
+    i_classes = np.nonzero(n_images)[0]
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    return pd.DataFrame(data={
+        'class': np.repeat(np.array(class_names, dtype=object)[i_classes], len(thresholds)),
+        'n_images': np.repeat(n_images[i_classes], len(thresholds)),
+        'confidence_threshold': np.tile(thresholds, len(i_classes)),
+        'recall': (counts_above[i_classes] / n_images[i_classes, np.newaxis]).ravel()
+    })
+
+
+def precision_recall(conf, gt_label):
+    """
+    Computes the full precision/recall curve over images with a definitive ground truth label.
+
+    Returns:
+        precisions_recalls: a DataFrame with columns confidence_threshold, precision, recall,
+            including a final row at a confidence threshold of 1.0
+        average_precision: a float
+    """
+
+    b_valid = np.asarray(gt_label) >= 0.0
+    conf = np.asarray(conf)[b_valid]
+    gt_label = np.asarray(gt_label)[b_valid]
+
+    precisions, recalls, thresholds = precision_recall_curve(gt_label, conf)
+
+    # For completeness, include the result at a confidence threshold of 1.0
+    thresholds = np.append(thresholds, [1.0])
+
+    precisions_recalls = pd.DataFrame(data={
+            'confidence_threshold': thresholds,
+            'precision': precisions,
+            'recall': recalls
+        })
+    return precisions_recalls, average_precision_score(gt_label, conf)
+
+
+def precision_at_recall(precisions_recalls, target_recall):
+    """
+    Thresholds go up throughout precisions_recalls; finds the last row where recall is at
+    or above target_recall, and returns its precision, or 0.0 if there is no such row.
+    """
+
+    i_above_target_recall = np.nonzero(precisions_recalls['recall'].values >= target_recall)[0]
+    if len(i_above_target_recall) == 0:
+        return 0.0
+    return precisions_recalls['precision'].values[i_above_target_recall[-1]]
+
+
+def average_precision_at_recall(conf, gt_label, target_recall):
+    """
+    Returns (average precision, precision at target_recall), or (NaN, NaN) if there aren't
+    both positives and negatives among the elements with a definitive ground truth label.
+    """
+
+    gt_label = np.asarray(gt_label)
+    if not (np.any(gt_label > 0) and np.any(gt_label == 0)):
+        return np.nan, np.nan
+    precisions_recalls, average_precision = precision_recall(conf, gt_label)
+    return average_precision, precision_at_recall(precisions_recalls, target_recall)
+
+
+def classification_metrics(ev):
+    """
+    Evaluates top-1 classifications on positive images with an unambiguous ground truth class
+    and at least one predicted class.
+
+    An image's accuracy is the intersection over union of its ground truth class and its set of
+    predicted classes, i.e. 1/(number of predicted classes) if the ground truth class is one of
+    them, and 0 otherwise.  Each predicted class counts once towards the confusion matrix.
+
+    Returns:
+        image_accuracy: float64 array aligned with the images in ev, NaN for images that were
+            not evaluated
+        confusion: float64 array of shape (n_classes, n_classes), counts of (ground truth class,
+            predicted class), rows and columns ordered like ev.class_names
+    """
+
+    n_classes = len(ev.class_names)
+    image_accuracy = np.full(ev.n_images, np.nan)
+    confusion = np.zeros((n_classes, n_classes), dtype=np.float64)
+
+    gt_category = ev.gt_category[ev.prediction_image_index]
+    b_evaluated = (ev.gt_label[ev.prediction_image_index] > 0) & (gt_category >= 0)
+    image_index = ev.prediction_image_index[b_evaluated]
+    predicted = ev.prediction_class[b_evaluated]
+    gt_category = gt_category[b_evaluated]
+    if len(image_index) == 0:
+        return image_accuracy, confusion
+
+    n_predicted = np.bincount(image_index, minlength=ev.n_images)
+    n_correct = np.bincount(image_index, weights=(predicted == gt_category), minlength=ev.n_images)
+    b_image_evaluated = n_predicted > 0
+    image_accuracy[b_image_evaluated] = n_correct[b_image_evaluated] / \
+        (n_predicted[b_image_evaluated] + 1 - n_correct[b_image_evaluated])
+
+    np.add.at(confusion, (gt_category, predicted), 1)
+    return image_accuracy, confusion
+
+
+def per_class_classification_accuracy(ev, image_accuracy):
+    """
+    Returns a DataFrame with columns class, n_images, accuracy: the mean accuracy of the
+    evaluated images of each ground truth class.
+    """
+
+    b_evaluated = ~np.isnan(image_accuracy)
+    categories = ev.gt_category[b_evaluated].astype(np.int64)
+    n_classes = len(ev.class_names)
+    n_images = np.bincount(categories, minlength=n_classes)
+    accuracy_sum = np.bincount(categories, weights=image_accuracy[b_evaluated], minlength=n_classes)
+    i_classes = np.nonzero(n_images)[0]
+    return pd.DataFrame(data={
+        'class': np.array(ev.class_names, dtype=object)[i_classes],
+        'n_images': n_images[i_classes],
+        'accuracy': accuracy_sum[i_classes] / n_images[i_classes]
+    })
+
+
+#%% Evaluating many detectors
+
+def evaluate_api_outputs(gt, api_output_files, thresholds, target_recall=0.9,
+                         filename_replacements={}, use_cache=False):
+    """
+    Evaluates several batch API output files against the same ground truth, at image level,
+    at sequence level and for each location.
+
+    Args:
+        gt: a GroundTruthArrays object
+        api_output_files: dict mapping model names to API output .json files
+        thresholds: confidence thresholds to compute precision/recall/F1 and per-class recall at
+        target_recall: recall at which to report precision
+        filename_replacements: replacements applied to file names in the API output files
+        use_cache: whether to use binary caches of the API output files (see
+            load_api_results_columnar())
+
+    Returns:
+        summary: DataFrame with one row per model
+        metrics: DataFrame with one row per (model, level, threshold), where level is 'image'
+            or 'sequence', see threshold_metrics()
+        class_metrics: DataFrame with one row per (model, class, threshold), see per_class_recall()
+        location_metrics: DataFrame with one row per (model, location, threshold), see
+            location_metrics()
+    """
+
+    # These only depend on the ground truth
+    gt_seq_ids, gt_seq_labels = sequence_labels(gt)
+    gt_seq_ids = pd.Index(gt_seq_ids)
+    sequence_index = sequence_index_from_ground_truth(gt)
+
+    summaries = []
+    all_metrics = []
+    all_class_metrics = []
+    all_location_metrics = []
+
+    for model_name, api_output_file in api_output_files.items():
+
+        results = load_api_results_columnar(api_output_file, normalize_paths=True,
+                                            filename_replacements=filename_replacements, use_cache=use_cache)
+        ev = match_to_ground_truth(gt, results.images['file'].values,
+                                   results.images['max_detection_conf'].values,
+                                   predicted_classes_from_columnar_results(results))
+        print('{}: matched {} of {} images to ground truth'.format(model_name, ev.n_images, results.n_images))
+
+        average_precision, precision_at_target_recall = average_precision_at_recall(
+            ev.max_conf, ev.gt_label, target_recall)
+        image_accuracy, _ = classification_metrics(ev)
+
+        summary = {
+            'model': model_name,
+            'n_images': ev.n_images,
+            'n_positive': int(np.sum(ev.gt_label > 0)),
+            'n_negative': int(np.sum(ev.gt_label == 0)),
+            'average_precision': average_precision,
+            'precision_at_target_recall': precision_at_target_recall,
+            'n_classified_images': int(np.sum(~np.isnan(image_accuracy))),
+            'classification_accuracy': np.nanmean(image_accuracy) if np.any(~np.isnan(image_accuracy)) else np.nan,
+            'n_sequences': 0,
+            'sequence_average_precision': np.nan,
+            'sequence_precision_at_target_recall': np.nan
+        }
+
+        metrics = threshold_metrics(ev.max_conf, ev.gt_label, thresholds)
+        metrics.insert(0, 'model', model_name)
+        metrics.insert(1, 'level', 'image')
+        all_metrics.append(metrics)
+
+        # A sequence's confidence is the highest max_detection_conf of its images (0 if they
+        # all failed)
+        if len(gt_seq_ids) > 0:
+            aggregates = aggregate_sequences(results, sequence_index)
+            seq_conf = np.nan_to_num(aggregates.max_detection_conf, nan=0.0)
+            seq_label = gt_seq_labels[gt_seq_ids.get_indexer(aggregates.seq_ids.astype(str))]
+            summary['n_sequences'] = aggregates.n_sequences
+            summary['sequence_average_precision'], summary['sequence_precision_at_target_recall'] = \
+                average_precision_at_recall(seq_conf, seq_label, target_recall)
+
+            metrics = threshold_metrics(seq_conf, seq_label, thresholds)
+            metrics.insert(0, 'model', model_name)
+            metrics.insert(1, 'level', 'sequence')
+            all_metrics.append(metrics)
+
+        summaries.append(summary)
+
+        class_metrics = per_class_recall(ev.max_conf, ev.gt_label, ev.gt_category, ev.class_names, thresholds)
+        class_metrics.insert(0, 'model', model_name)
+        all_class_metrics.append(class_metrics)
+
+        model_location_metrics = location_metrics(ev.max_conf, ev.gt_label, gt.locations[ev.gt_index], thresholds)
+        model_location_metrics.insert(0, 'model', model_name)
+        all_location_metrics.append(model_location_metrics)
+
+    # ...for each model
+
+    return pd.DataFrame(summaries), pd.concat(all_metrics, ignore_index=True), \
+        pd.concat(all_class_metrics, ignore_index=True), pd.concat(all_location_metrics, ignore_index=True)
+
+
+def check_regressions(summary, baseline_model, max_ap_drop):
+    """
+    Compares the image- and sequence-level average precision of each model in summary (see
+    evaluate_api_outputs()) to baseline_model's.
+
+    Returns a list of strings describing the models whose AP is more than max_ap_drop below the
+    baseline's (empty if there are none).
+    """
+
+    summary = summary.set_index('model')
+    assert baseline_model in summary.index, 'Baseline model {} was not evaluated'.format(baseline_model)
+    baseline = summary.loc[baseline_model]
+
+    regressions = []
+    for model_name, row in summary.iterrows():
+        if model_name == baseline_model:
+            continue
+        for level, column in [('image', 'average_precision'), ('sequence', 'sequence_average_precision')]:
+            if np.isnan(baseline[column]) or np.isnan(row[column]):
+                continue
+            if row[column] < baseline[column] - max_ap_drop:
+                regressions.append('{} {}-level AP is {:.4f}, baseline {} is {:.4f}'.format(
+                    model_name, level, row[column], baseline_model, baseline[column]))
+    return regressions
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Evaluate one or more batch API output files against COCO Camera Traps ground truth')
+    parser.add_argument('ground_truth_json_file', type=str, help='Ground truth .json file')
+    parser.add_argument('api_output_files', type=str, nargs='+',
+                        help='API output .json files; models are named after the file names')
+    parser.add_argument('--output_dir', type=str, default='.',
+                        help='Folder to write summary.csv, threshold_metrics.csv, class_metrics.csv and '
+                             'location_metrics.csv to')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=None,
+                        help='Confidence thresholds (defaults to 0.05, 0.10, ..., 0.95)')
+    parser.add_argument('--target_recall', type=float, default=0.9)
+    parser.add_argument('--negative_classes', type=str, nargs='+', default=DEFAULT_NEGATIVE_CLASSES)
+    parser.add_argument('--unknown_classes', type=str, nargs='+', default=DEFAULT_UNKNOWN_CLASSES)
+    parser.add_argument('--use_cache', action='store_true',
+                        help='Cache the parsed ground truth and API output files next to them')
+    parser.add_argument('--baseline_model', type=str, default=None,
+                        help='Model (file name without extension) to compare the other models to')
+    parser.add_argument('--max_ap_drop', type=float, default=0.0,
+                        help='Exit with an error if a model\'s image- or sequence-level AP is more than this '
+                             'below the baseline\'s')
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    thresholds = args.thresholds
+    if thresholds is None:
+        thresholds = np.round(np.arange(0.05, 1.0, 0.05), 2)
+
+    gt = load_ground_truth_arrays(args.ground_truth_json_file, negative_classes=args.negative_classes,
+                                  unknown_classes=args.unknown_classes, use_cache=args.use_cache)
+    api_output_files = {os.path.splitext(os.path.basename(fn))[0]: fn for fn in args.api_output_files}
+    assert len(api_output_files) == len(args.api_output_files), 'API output file names need to be unique'
+
+    summary, metrics, class_metrics, locations = evaluate_api_outputs(gt, api_output_files, thresholds,
+                                                                      target_recall=args.target_recall,
+                                                                      use_cache=args.use_cache)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary.to_csv(os.path.join(args.output_dir, 'summary.csv'), index=False)
+    metrics.to_csv(os.path.join(args.output_dir, 'threshold_metrics.csv'), index=False)
+    class_metrics.to_csv(os.path.join(args.output_dir, 'class_metrics.csv'), index=False)
+    locations.to_csv(os.path.join(args.output_dir, 'location_metrics.csv'), index=False)
+    print(summary.to_string(index=False))
+
+    if args.baseline_model is not None:
+        regressions = check_regressions(summary, args.baseline_model, args.max_ap_drop)
+        if len(regressions) > 0:
+            for regression in regressions:
+                print('Regression: ' + regression)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
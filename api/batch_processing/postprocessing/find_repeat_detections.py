@@ -113,10 +113,16 @@ def main():
     parser.add_argument('--nWorkers', action='store', type=int,
                         default=defaultOptions.nWorkers,
                         help='Level of parallelism for rendering and IOU computation')
+    parser.add_argument('--parallelizationBackend', action='store', type=str,
+                        default=defaultOptions.parallelizationBackend, choices=['threads', 'processes'],
+                        help='Use threads or processes for rendering and IOU computation')
     parser.add_argument('--maxSuspiciousDetectionSize', action='store', type=float,
                         default=defaultOptions.maxSuspiciousDetectionSize,
                         help='Detections larger than this fraction of image area are not considered suspicious')
 
+    parser.add_argument('--useInputCache', action='store_true',
+                        dest='bUseInputCache', help='Cache the parsed input file next to it for faster re-runs')
+
     parser.add_argument('--renderHtml', action='store_true',
                         dest='bRenderHtml', help='Should we render HTML output?')
     parser.add_argument('--omitFilteringFolder', action='store_false',
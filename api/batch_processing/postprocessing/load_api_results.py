@@ -4,18 +4,44 @@
 # Loads the output of the batch processing API (json).
 # Also functions to group entries by seq_id.
 #
+# load_api_results() returns a DataFrame with one row per image, where each row holds a list
+# of detection dicts; load_api_results_columnar() returns a ColumnarApiResults object with
+# an image table and a flat table of detections stored as numpy arrays, which is much smaller
+# for large result files and lets callers filter and aggregate detections with numpy.
+#
+# Both loaders can optionally keep a binary cache of the parsed results next to the .json
+# file (<api_output_path>.cache.npz), so repeated postprocessing runs over the same (often
+# multi-GB) output file skip json parsing.  The cache is invalidated when the json file's
+# size or content (sha1) changes; a matching size and mtime is trusted without hashing
+# unless verify_hash is True.
+#
 # Includes the deprecated functions that worked with the old CSV API output format.
 #
 
 #%% Constants and imports
 
+import numpy as np
 import pandas as pd
+import hashlib
 import json
 import os
+import zipfile
 from collections import defaultdict
 
 headers = ['image_path', 'max_confidence', 'detections']
 
+# Number of decimal places to round to for confidence and bbox coordinates when converting
+# columnar results back to the API format
+CONF_DIGITS = 3
+COORD_DIGITS = 4
+
+# Bump when the layout of the .npz cache changes, so old caches are ignored
+API_RESULTS_CACHE_VERSION = 1
+API_RESULTS_CACHE_SUFFIX = '.cache.npz'
+
+# Paths that os.path.normpath would change on posix systems
+_POSIX_UNNORMALIZED_PATH_PATTERN = r'//|/\./|/\.\./|^\./|^\.\./|/\.$|/\.\.$|^\.$|^\.\.$|/$|^$'
+
 
 #%% Functions for grouping by sequence_id
 
@@ -43,6 +69,9 @@ def api_results_groupby(api_output_path, gt_db_indexed, file_to_image_id, field=
     Returns:
     A dict where the keys are of the field requested, each points to an array
     containing entries in the 'images' section of the output file
+
+    For per-sequence confidences and detection counts, sequence_aggregation.py computes them
+    without building per-image dicts.
     """
 
     with open(api_output_path) as f:
@@ -58,7 +87,8 @@ def api_results_groupby(api_output_path, gt_db_indexed, file_to_image_id, field=
 
 #%% Functions for loading the result as a Pandas DataFrame
 
-def load_api_results(api_output_path, normalize_paths=True, filename_replacements={}):
+def load_api_results(api_output_path, normalize_paths=True, filename_replacements={}, use_cache=False,
+                     verify_hash=False):
     """
     Loads the json formatted results from the batch processing API to a Pandas DataFrame, mainly useful for
     various postprocessing functions.
@@ -67,6 +97,11 @@ def load_api_results(api_output_path, normalize_paths=True, filename_replacement
         api_output_path: path to the API output json file
         normalize_paths: whether to apply os.path.normpath to the 'file' field in each image entry in the output file
         filename_replacements: replace some path tokens to match local paths to the original blob structure
+        use_cache: whether to read and write a binary cache of the parsed results next to the json file (see
+            load_api_results_columnar()).  Results loaded via the cache have confidence values and coordinates
+            rounded to CONF_DIGITS and COORD_DIGITS, i.e. the precision the API writes.
+        verify_hash: when use_cache is True, whether to hash the json file even if its size and mtime match the
+            cache
 
     Returns:
         detection_results: a Pandas DataFrame with columns (file, max_detection_conf, detections)
@@ -75,6 +110,14 @@ def load_api_results(api_output_path, normalize_paths=True, filename_replacement
         other_fields: a dict containing fields in the dict
     """
     
+    if use_cache:
+        results = load_api_results_columnar(api_output_path, normalize_paths=normalize_paths,
+                                            filename_replacements=filename_replacements,
+                                            use_cache=True, verify_hash=verify_hash)
+        detection_results = columnar_results_to_api_results(results)
+        other_fields = dict(results.other_fields)
+        return pd.DataFrame(detection_results['images']), other_fields
+    
     print('Loading API results from {}'.format(api_output_path))
 
     with open(api_output_path) as f:
@@ -123,6 +166,415 @@ def load_api_results(api_output_path, normalize_paths=True, filename_replacement
     return detection_results, other_fields
 
 
+#%% Functions for loading the result in columnar form
+
+class ColumnarApiResults:
+    """
+    Batch API results stored as an image table plus a flat detection table.
+    
+    Detections for image i are rows image_detection_start[i] through 
+    image_detection_start[i] + image_detection_count[i] - 1 of the detection arrays, and 
+    detection_image_index maps each detection back to its image.
+    """
+    
+    # Fields in the API output json other than 'images'
+    other_fields = None
+    
+    # A Pandas DataFrame with one row per image and columns 'file', 'max_detection_conf' 
+    # (float32, NaN if missing), and any other per-image fields that appear in the input 
+    # (e.g. 'meta', 'failure')
+    images = None
+    
+    # int64 arrays of length n_images
+    image_detection_start = None
+    image_detection_count = None
+    
+    # Arrays of length n_detections
+    detection_image_index = None  # int32
+    detection_category = None  # int32, category IDs are strings in the API output
+    detection_conf = None  # float32
+    detection_bbox = None  # float32, n_detections x 4, [x_min, y_min, width_of_box, height_of_box]
+    
+    # Dict mapping detection indices to dicts of fields other than category/conf/bbox 
+    # (e.g. 'classifications'), for the (typically few) detections that have them
+    detection_extra_fields = None
+    
+    @property
+    def n_images(self):
+        return len(self.images)
+    
+    @property
+    def n_detections(self):
+        return len(self.detection_conf)
+    
+    def subset(self, image_mask):
+        """
+        Returns a new ColumnarApiResults containing only the images where [image_mask] 
+        (a boolean array of length n_images) is True, and their detections.
+        """
+        
+        image_mask = np.asarray(image_mask, dtype=bool)
+        assert len(image_mask) == self.n_images
+        
+        detection_mask = image_mask[self.detection_image_index]
+        new_image_index = np.cumsum(image_mask) - 1
+        
+        results = ColumnarApiResults()
+        results.other_fields = self.other_fields
+        results.images = self.images[image_mask].reset_index(drop=True)
+        results.image_detection_count = self.image_detection_count[image_mask]
+        results.image_detection_start = np.zeros(len(results.image_detection_count), dtype=np.int64)
+        results.image_detection_start[1:] = np.cumsum(results.image_detection_count)[:-1]
+        results.detection_image_index = new_image_index[self.detection_image_index[detection_mask]].astype(np.int32)
+        results.detection_category = self.detection_category[detection_mask]
+        results.detection_conf = self.detection_conf[detection_mask]
+        results.detection_bbox = self.detection_bbox[detection_mask]
+        
+        new_detection_index = np.cumsum(detection_mask) - 1
+        results.detection_extra_fields = {int(new_detection_index[i]): v for i, v in 
+                                          self.detection_extra_fields.items() if detection_mask[i]}
+        return results
+    
+
+def normalize_paths_vectorized(paths):
+    """
+    Applies os.path.normpath to a Pandas Series of paths, only visiting the paths that 
+    would actually change (on posix systems, that's usually none of them).
+    """
+    
+    if os.sep != '/' or os.altsep is not None:
+        return paths.map(os.path.normpath)
+    
+    b_needs_normalization = paths.str.contains(_POSIX_UNNORMALIZED_PATH_PATTERN, regex=True)
+    if b_needs_normalization.any():
+        paths = paths.copy()
+        paths[b_needs_normalization] = paths[b_needs_normalization].map(os.path.normpath)
+    return paths
+
+
+def _parse_api_results_columnar(detection_results):
+    """
+    Converts a dict in the API output format to a ColumnarApiResults object, leaving 'file' 
+    fields as they appear in the input.
+    """
+    
+    # Sanity-check that this is really a detector output file
+    for s in ['info', 'detection_categories', 'images']:
+        assert s in detection_results
+        
+    results = ColumnarApiResults()
+    results.other_fields = {k: v for k, v in detection_results.items() if k != 'images'}
+    
+    images = detection_results['images']
+    n_images = len(images)
+    
+    files = [None] * n_images
+    max_confs = np.full(n_images, np.nan, dtype=np.float32)
+    counts = np.zeros(n_images, dtype=np.int64)
+    other_image_fields = defaultdict(lambda: [None] * n_images)
+    
+    categories = []
+    confs = []
+    bboxes = []
+    results.detection_extra_fields = {}
+    
+    for i_image, im in enumerate(images):
+        
+        files[i_image] = im['file']
+        for k, v in im.items():
+            if k == 'file' or k == 'detections':
+                continue
+            if k == 'max_detection_conf':
+                if v is not None:
+                    max_confs[i_image] = v
+            else:
+                other_image_fields[k][i_image] = v
+                
+        detections = im.get('detections')
+        if detections is None:
+            continue
+        counts[i_image] = len(detections)
+        
+        for d in detections:
+            if len(d) > 3:
+                results.detection_extra_fields[len(confs)] = \
+                    {k: v for k, v in d.items() if k not in ('category', 'conf', 'bbox')}
+            categories.append(d['category'])
+            confs.append(d['conf'])
+            bboxes.append(d['bbox'])
+            
+    # ...for each image
+    
+    results.image_detection_count = counts
+    results.image_detection_start = np.zeros(n_images, dtype=np.int64)
+    results.image_detection_start[1:] = np.cumsum(counts)[:-1]
+    results.detection_image_index = np.repeat(np.arange(n_images, dtype=np.int32), counts)
+    results.detection_category = np.array(categories, dtype=np.int32)
+    results.detection_conf = np.array(confs, dtype=np.float32)
+    results.detection_bbox = np.array(bboxes, dtype=np.float32).reshape(-1, 4)
+    
+    image_table = {'file': pd.Series(files, dtype=object), 'max_detection_conf': max_confs}
+    for k, v in other_image_fields.items():
+        image_table[k] = v
+    results.images = pd.DataFrame(image_table)
+    
+    return results
+
+
+#%% Binary cache for parsed results
+
+def api_results_cache_path(api_output_path):
+    
+    return api_output_path + API_RESULTS_CACHE_SUFFIX
+
+
+def _file_sha1(path, block_size=16 * 1024 * 1024):
+    
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _to_json_array(obj):
+    """
+    Stores a json-serializable object as a uint8 array, since we load .npz files with 
+    allow_pickle=False.
+    """
+    
+    return np.frombuffer(json.dumps(obj).encode('utf-8'), dtype=np.uint8)
+
+
+def _from_json_array(a):
+    
+    return json.loads(a.tobytes().decode('utf-8'))
+
+
+def _write_api_results_cache(results, cache_path, source_stat, source_sha1):
+    """
+    Writes a ColumnarApiResults object (with 'file' fields as they appear in the json file) 
+    to [cache_path], via a temporary file so readers never see a partial cache.  Failure to 
+    write the cache (e.g. in a read-only folder) is reported but not fatal.
+    """
+    
+    other_columns = [c for c in results.images.columns if c not in ('file', 'max_detection_conf')]
+    other_image_fields = {}
+    for c in other_columns:
+        other_image_fields[c] = [None if (isinstance(v, float) and np.isnan(v)) else v 
+                                 for v in results.images[c].tolist()]
+    
+    metadata = {'version': API_RESULTS_CACHE_VERSION,
+                'size': source_stat.st_size,
+                'mtime_ns': source_stat.st_mtime_ns,
+                'sha1': source_sha1}
+    
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez(f,
+                     metadata=_to_json_array(metadata),
+                     other_fields=_to_json_array(results.other_fields),
+                     files=_to_json_array(results.images['file'].tolist()),
+                     max_detection_conf=results.images['max_detection_conf'].to_numpy(dtype=np.float32),
+                     other_image_fields=_to_json_array(other_image_fields),
+                     image_detection_count=results.image_detection_count,
+                     detection_category=results.detection_category,
+                     detection_conf=results.detection_conf,
+                     detection_bbox=results.detection_bbox,
+                     detection_extra_fields=_to_json_array(sorted(results.detection_extra_fields.items())))
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print('Warning: could not write API results cache {}: {}'.format(cache_path, str(e)))
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        return
+    
+    print('Wrote API results cache to {}'.format(cache_path))
+
+
+def _read_api_results_cache(api_output_path, cache_path, verify_hash=False):
+    """
+    Loads a ColumnarApiResults object from [cache_path] if it exists and is up to date with
+    respect to [api_output_path], otherwise returns None.
+    
+    If the json file's mtime has changed but its contents haven't (e.g. it was copied or
+    touched), the cache is re-written with the new mtime, so later loads don't hash it again.
+    """
+    
+    if not os.path.isfile(cache_path):
+        return None
+    
+    source_stat = os.stat(api_output_path)
+    b_mtime_changed = False
+    
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            
+            metadata = _from_json_array(cache['metadata'])
+            if metadata.get('version') != API_RESULTS_CACHE_VERSION or \
+                    metadata['size'] != source_stat.st_size:
+                print('API results cache {} is out of date'.format(cache_path))
+                return None
+            
+            if verify_hash or metadata['mtime_ns'] != source_stat.st_mtime_ns:
+                if _file_sha1(api_output_path) != metadata['sha1']:
+                    print('API results cache {} is out of date'.format(cache_path))
+                    return None
+                b_mtime_changed = metadata['mtime_ns'] != source_stat.st_mtime_ns
+            
+            results = ColumnarApiResults()
+            results.other_fields = _from_json_array(cache['other_fields'])
+            
+            counts = cache['image_detection_count']
+            n_images = len(counts)
+            results.image_detection_count = counts
+            results.image_detection_start = np.zeros(n_images, dtype=np.int64)
+            results.image_detection_start[1:] = np.cumsum(counts)[:-1]
+            results.detection_image_index = np.repeat(np.arange(n_images, dtype=np.int32), counts)
+            results.detection_category = cache['detection_category']
+            results.detection_conf = cache['detection_conf']
+            results.detection_bbox = cache['detection_bbox']
+            results.detection_extra_fields = {i: v for i, v in _from_json_array(cache['detection_extra_fields'])}
+            
+            image_table = {'file': pd.Series(_from_json_array(cache['files']), dtype=object),
+                           'max_detection_conf': cache['max_detection_conf']}
+            for k, v in _from_json_array(cache['other_image_fields']).items():
+                image_table[k] = v
+            results.images = pd.DataFrame(image_table)
+            
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        print('Warning: could not read API results cache {}: {}'.format(cache_path, str(e)))
+        return None
+    
+    if b_mtime_changed:
+        _write_api_results_cache(results, cache_path, source_stat, metadata['sha1'])
+    
+    return results
+
+
+#%% Columnar loading
+
+def load_api_results_columnar(api_output_path, normalize_paths=True, filename_replacements={}, use_cache=False,
+                              verify_hash=False):
+    """
+    Loads the json formatted results from the batch processing API to a ColumnarApiResults 
+    object.  Confidence values and bounding box coordinates are stored as float32.
+
+    Args:
+        api_output_path: path to the API output json file
+        normalize_paths: whether to apply os.path.normpath to the 'file' field in each image entry in the output file
+        filename_replacements: replace some path tokens to match local paths to the original blob structure
+        use_cache: whether to load the parsed results from <api_output_path>.cache.npz if it is up to date, and
+            to (re-)write it otherwise.  The cache stores 'file' fields as they appear in the json file, so the
+            same cache can be used with different normalize_paths/filename_replacements values.
+        verify_hash: when use_cache is True, whether to hash the json file even if its size and mtime match the
+            cache
+
+    Returns:
+        a ColumnarApiResults object
+    """
+    
+    results = None
+    
+    if use_cache:
+        cache_path = api_results_cache_path(api_output_path)
+        results = _read_api_results_cache(api_output_path, cache_path, verify_hash=verify_hash)
+        if results is not None:
+            print('Loaded API results from cache {}'.format(cache_path))
+    
+    if results is None:
+        
+        print('Loading API results from {}'.format(api_output_path))
+        
+        source_stat = os.stat(api_output_path)
+        with open(api_output_path, 'rb') as f:
+            raw = f.read()
+        source_sha1 = hashlib.sha1(raw).hexdigest() if use_cache else None
+        
+        print('De-serializing API results from {}'.format(api_output_path))
+        
+        detection_results = json.loads(raw)
+        del raw
+        results = _parse_api_results_columnar(detection_results)
+        del detection_results
+        
+        if use_cache:
+            _write_api_results_cache(results, cache_path, source_stat, source_sha1)
+    
+    file_series = results.images['file']
+    
+    # Normalize paths to simplify comparisons later
+    if normalize_paths:
+        file_series = normalize_paths_vectorized(file_series)
+    
+    # Optionally replace some path tokens to match local paths to the original blob structure
+    for string_to_replace in filename_replacements:
+        replacement_string = filename_replacements[string_to_replace]
+        file_series = file_series.str.replace(string_to_replace, replacement_string, regex=False)
+    
+    results.images['file'] = file_series
+    
+    print('Finished loading and de-serializing API results for {} images ({} detections) from {}'.format(
+        results.n_images, results.n_detections, api_output_path))
+    
+    return results
+
+
+def columnar_results_to_api_results(results, conf_digits=CONF_DIGITS, coord_digits=COORD_DIGITS):
+    """
+    Converts a ColumnarApiResults object back to a dict in the API output format (i.e., the
+    dict you'd get by json.load'ing an API output file).  Confidence values and coordinates
+    are rounded, since they were stored as float32.
+    """
+    
+    confs = np.round(results.detection_conf.astype(np.float64), conf_digits).tolist()
+    bboxes = np.round(results.detection_bbox.astype(np.float64), coord_digits).tolist()
+    categories = [str(c) for c in results.detection_category.tolist()]
+    
+    other_columns = [c for c in results.images.columns if c not in ('file', 'max_detection_conf')]
+    files = results.images['file'].tolist()
+    max_confs = results.images['max_detection_conf'].to_numpy()
+    b_has_max_conf = ~np.isnan(max_confs)
+    max_confs = np.round(max_confs.astype(np.float64), conf_digits).tolist()
+    other_values = {c: results.images[c].tolist() for c in other_columns}
+    starts = results.image_detection_start.tolist()
+    counts = results.image_detection_count.tolist()
+    
+    images = []
+    for i_image in range(results.n_images):
+        
+        im = {'file': files[i_image]}
+        if b_has_max_conf[i_image]:
+            im['max_detection_conf'] = max_confs[i_image]
+        for c in other_columns:
+            v = other_values[c][i_image]
+            if v is not None and not (isinstance(v, float) and np.isnan(v)):
+                im[c] = v
+        
+        detections = []
+        for i_detection in range(starts[i_image], starts[i_image] + counts[i_image]):
+            d = {'category': categories[i_detection],
+                 'conf': confs[i_detection],
+                 'bbox': bboxes[i_detection]}
+            extra_fields = results.detection_extra_fields.get(i_detection)
+            if extra_fields is not None:
+                d.update(extra_fields)
+            detections.append(d)
+        
+        # Failed images don't have detections
+        if counts[i_image] > 0 or 'failure' not in im:
+            im['detections'] = detections
+        images.append(im)
+        
+    api_results = dict(results.other_fields)
+    api_results['images'] = images
+    return api_results
+
+
 def write_api_results(detection_results_table, other_fields, out_path):
     """
     Writes a Pandas DataFrame back to a json that is compatible with the API output format.
@@ -34,19 +34,13 @@ import io
 import warnings
 import copy
 import time
-from multiprocessing.pool import ThreadPool    
-from enum import IntEnum
-import errno
-import uuid
             
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.metrics import precision_recall_curve, confusion_matrix, average_precision_score
 from tqdm import tqdm
 import humanfriendly
-import pandas as pd
 
 # Assumes ai4eutils is on the python path
 # https://github.com/Microsoft/ai4eutils
@@ -55,8 +49,12 @@ import path_utils
 
 # Assumes the cameratraps repo root is on the path
 import visualization.visualization_utils as vis_utils
-from data_management.cct_json_utils import CameraTrapJsonUtils, IndexedJsonDb
+from visualization.rendering_engine import RenderingEngine, RenderingJob, RenderingOptions
 from api.batch_processing.postprocessing.load_api_results import load_api_results
+from api.batch_processing.postprocessing.detection_evaluation import DEFAULT_NEGATIVE_CLASSES, \
+    DEFAULT_UNKNOWN_CLASSES, DetectionStatus, image_detection_status, load_ground_truth_arrays, \
+    match_to_ground_truth, predicted_classes_from_detections, precision_recall, precision_at_recall, \
+    confusion_counts, classification_metrics
 from ct_utils import args_to_object
 
 warnings.filterwarnings("ignore", "(Possibly )?corrupt EXIF data", UserWarning)
@@ -64,10 +62,6 @@ warnings.filterwarnings("ignore", "(Possibly )?corrupt EXIF data", UserWarning)
 
 #%% Options
 
-DEFAULT_NEGATIVE_CLASSES = ['empty']
-DEFAULT_UNKNOWN_CLASSES = ['unknown', 'unlabeled', 'ambiguous']
-
-
 def has_overlap(set1, set2):
     ''' Helper function that checks whether two sets overlap '''
     
@@ -119,6 +113,14 @@ class PostProcessingOptions:
     api_output_filename_replacements = {}
     ground_truth_filename_replacements = {}
 
+    # Keep a binary cache of the parsed API output next to it (see load_api_results.py), so
+    # repeated runs on the same file don't re-parse the .json file
+    api_output_use_cache = False
+
+    # Keep a binary cache of the ground truth arrays next to the ground truth .json file (see
+    # detection_evaluation.py), so repeated evaluations on the same benchmark don't re-index it
+    ground_truth_use_cache = False
+
     # Allow bypassing API output loading when operating on previously-loaded results
     api_detection_results = None
     api_other_fields = None
@@ -133,6 +135,23 @@ class PostProcessingOptions:
     # Control rendering parallelization
     parallelize_rendering_n_cores = 100
     parallelize_rendering = False
+
+    # Render on a process pool rather than a thread pool; opening, resizing and drawing on images
+    # mostly hold the GIL, so processes scale much better.  Uses at most one process per core.
+    parallelize_rendering_with_processes = False
+
+    # Format of rendered images: None to keep each image's format, or 'jpeg' or 'webp'
+    rendered_image_format = None
+
+    # JPEG/WebP quality of rendered images (1-100), or None to use PIL's default
+    rendered_image_quality = None
+
+    # Decode JPEGs directly at reduced resolution when rendering (see visualization/rendering_engine.py)
+    rendered_image_draft_mode = True
+
+    # Don't re-render images whose source image and rendering haven't changed since the last
+    # run into the same output_dir
+    skip_up_to_date_renderings = True
     
     
 class PostProcessingResults:
@@ -144,39 +163,12 @@ class PostProcessingResults:
 
 ##%% Helper classes and functions
 
-# Flags used to mark images as positive or negative for P/R analysis (according
-# to ground truth and/or detector output)
-class DetectionStatus(IntEnum):
-
-    # This image is a negative
-    DS_NEGATIVE = 0
-
-    # This image is a positive
-    DS_POSITIVE = 1
-
-    # Anything greater than this isn't clearly positive or negative
-    DS_MAX_DEFINITIVE_VALUE = DS_POSITIVE
-
-    # This image has annotations suggesting both negative and positive
-    DS_AMBIGUOUS = 2
-
-    # This image is not annotated or is annotated with 'unknown', 'unlabeled', ETC.
-    DS_UNKNOWN = 3
-
-    # This image has not yet been assigned a state
-    DS_UNASSIGNED = 4
-
-    # In some analyses, we add an additional class that lets us look at detections just below
-    # our main confidence threshold
-    DS_ALMOST = 5
-        
-
 def mark_detection_status(indexed_db, negative_classes=DEFAULT_NEGATIVE_CLASSES,
                           unknown_classes=DEFAULT_UNKNOWN_CLASSES):
     """
     For each image in indexed_db.db['images'], add a '_detection_status' field
     to indicate whether to treat this image as positive, negative, ambiguous,
-    or unknown.
+    or unknown (see detection_evaluation.image_detection_status()).
 
     Makes modifications in-place.
 
@@ -200,61 +192,100 @@ def mark_detection_status(indexed_db, negative_classes=DEFAULT_NEGATIVE_CLASSES,
         image_categories = [ann['category_id'] for ann in annotations]
         image_category_names = set([indexed_db.cat_id_to_name[cat] for cat in image_categories])
 
-        # Check if image has unassigned-type labels
-        image_has_unknown_labels = has_overlap(image_category_names, unknown_classes)
-        assert image_has_unknown_labels is False, '{} has unknown labels'.format(annotations)
-        # Check if image has negative-type labels
-        image_has_negative_labels = has_overlap(image_category_names, negative_classes)
-        # Check if image has positive labels
-        # i.e. if we remove negative and unknown labels from image_category_names, then
-        # there are still labels left
-        image_has_positive_labels = 0 < len(image_category_names - unknown_classes - negative_classes)
-
-        # If there are no image annotations, the result is unknown
-        if len(image_categories) == 0:
-            # n_unknown += 1
-            # im['_detection_status'] = DetectionStatus.DS_UNKNOWN
+        detection_status = image_detection_status(image_category_names, negative_classes, unknown_classes)
+        im['_detection_status'] = detection_status
 
+        if detection_status == DetectionStatus.DS_NEGATIVE:
             n_negative += 1
-            im['_detection_status'] = DetectionStatus.DS_NEGATIVE
+        elif detection_status == DetectionStatus.DS_AMBIGUOUS:
+            n_ambiguous += 1
+        elif detection_status == DetectionStatus.DS_UNKNOWN:
+            n_unknown += 1
+        else:
+            n_positive += 1
 
-        # If the image has more than one type of labels, it's ambiguous
-        # note: booleans get automatically converted to 0/1, hence we can use the sum
-        elif image_has_unknown_labels + image_has_negative_labels + image_has_positive_labels > 1:
+            # Annotate the category, if it is unambiguous
+            if len(image_category_names) == 1:
+                im['_unambiguous_category'] = list(image_category_names)[0]
 
-            n_ambiguous += 1
-            im['_detection_status'] = DetectionStatus.DS_AMBIGUOUS
+    return n_negative, n_positive, n_unknown, n_ambiguous
 
-        # After the check above, we can be sure it's only one of positive, negative, or unknown
-        # Important: do not merge the following 'unknown' branch with the first 'unknown' branch
-        # above, where we were testing 'if len(image_categories) == 0'
-        #
-        # If the image has only unknown labels
-        elif image_has_unknown_labels:
 
-            n_unknown += 1
-            im['_detection_status'] = DetectionStatus.DS_UNKNOWN
+def rendering_options(options):
+    """
+    Translates the rendering settings in a PostProcessingOptions object to RenderingOptions.
+    """
 
-        # If the image has only negative labels
-        elif image_has_negative_labels:
+    r_options = RenderingOptions()
+    if options.viz_target_width is None:
+        r_options.target_size = (-1, -1)
+    else:
+        r_options.target_size = (options.viz_target_width, -1)
+    r_options.use_draft_mode = options.rendered_image_draft_mode
+    r_options.output_format = options.rendered_image_format
+    r_options.quality = options.rendered_image_quality
+    r_options.skip_up_to_date = options.skip_up_to_date_renderings
+
+    if not options.parallelize_rendering:
+        r_options.parallelism = 'serial'
+    elif options.parallelize_rendering_with_processes:
+        r_options.parallelism = 'processes'
+        r_options.n_workers = options.parallelize_rendering_n_cores
+        if r_options.n_workers is not None:
+            r_options.n_workers = min(r_options.n_workers, os.cpu_count())
+    else:
+        r_options.parallelism = 'threads'
+        r_options.n_workers = options.parallelize_rendering_n_cores
 
-            n_negative += 1
-            im['_detection_status'] = DetectionStatus.DS_NEGATIVE
+    return r_options
 
-        # If the images has only positive labels
-        elif image_has_positive_labels:
 
-            n_positive += 1
-            im['_detection_status'] = DetectionStatus.DS_POSITIVE
+def rendering_job(image_base_dir, image_relative_path, detections, res,
+                  detection_categories_map=None, classification_categories_map=None, options=None):
+    """
+    Creates the RenderingJob that renders the detections above options.confidence_threshold on
+    a single image; see render_bounding_boxes().
+    """
 
-            # Annotate the category, if it is unambiguous
-            if len(image_category_names) == 1:
-                im['_unambiguous_category'] = list(image_category_names)[0]
+    if options is None:
+        options = PostProcessingOptions()
 
-        else:
-            raise Exception('Invalid state, please check the code for bugs')
+    # Only pass the detections that will be drawn, so the rendering cache isn't invalidated for
+    # images whose rendering doesn't change when the threshold changes
+    detections_to_render = [d for d in detections if d['conf'] >= options.confidence_threshold]
 
-    return n_negative, n_positive, n_unknown, n_ambiguous
+    # Render images to a flat folder... we can use os.sep here because we've
+    # already normalized paths
+    sample_name = res + '_' + path_utils.flatten_path(image_relative_path)
+
+    return RenderingJob(os.path.join(image_base_dir, image_relative_path),
+                        os.path.join(options.output_dir, res, sample_name),
+                        vis_utils.render_detection_bounding_boxes,
+                        {'detections': detections_to_render,
+                         'label_map': detection_categories_map,
+                         'classification_label_map': classification_categories_map,
+                         'confidence_threshold': 0.0,
+                         'thickness': options.line_thickness,
+                         'expansion': options.box_expansion})
+
+
+def image_html_info(rendered_path, display_name, options):
+    """
+    Returns the html info struct for an image rendered to rendered_path, in the form that's used
+    for write_html_image_list, or '' if the image could not be rendered.
+    """
+
+    if rendered_path is None:
+        return ''
+
+    # Use slashes regardless of os
+    file_name = os.path.relpath(rendered_path, options.output_dir).replace('\\', '/')
+
+    return {
+        'filename': file_name,
+        'title': display_name,
+        'textStyle': 'font-family:verdana,arial,calibri;font-size:80%;text-align:left;margin-top:20;margin-bottom:5'
+    }
 
 
 def render_bounding_boxes(image_base_dir, image_relative_path, display_name, detections, res,
@@ -272,67 +303,53 @@ def render_bounding_boxes(image_base_dir, image_relative_path, display_name, det
         
         Returns the html info struct for this image in the form that's used for 
         write_html_image_list.
+
+        To render many images, use render_prepared_images(), which renders in parallel and
+        skips images that are up to date.
         """
         
         if options is None:
             options = PostProcessingOptions()
 
-        # Leaving code in place for reading from blob storage, may support this
-        # in the future.
-        """
-        stream = io.BytesIO()
-        _ = blob_service.get_blob_to_stream(container_name, image_id, stream)
-        image = Image.open(stream).resize(viz_size)  # resize is to display them in this notebook or in the HTML more quickly
-        """
+        job = rendering_job(image_base_dir, image_relative_path, detections, res,
+                            detection_categories_map, classification_categories_map, options)
+        r_options = rendering_options(options)
+        r_options.parallelism = 'serial'
+        rendered_path = RenderingEngine(r_options).render([job])[0]
 
-        image_full_path = os.path.join(image_base_dir, image_relative_path)
-        
-        # isfile() is slow when mounting remote directories; much faster to just try/except
-        # on the image open.
-        if False:
-            if not os.path.isfile(image_full_path):
-                print('Warning: could not find image file {}'.format(image_full_path))
-                return ''
-        
-        try:
-            image = vis_utils.open_image(image_full_path)
-        except:
-            print('Warning: could not open image file {}'.format(image_full_path))            
-            return ''
-        
-        if options.viz_target_width is not None:
-            image = vis_utils.resize_image(image, options.viz_target_width)
-
-        vis_utils.render_detection_bounding_boxes(detections, image,
-                                                  label_map=detection_categories_map,
-                                                  classification_label_map=classification_categories_map,
-                                                  confidence_threshold=options.confidence_threshold,
-                                                  thickness=options.line_thickness,expansion=options.box_expansion)
-
-        # Render images to a flat folder... we can use os.sep here because we've
-        # already normalized paths
-        sample_name = res + '_' + path_utils.flatten_path(image_relative_path)        
-        fullpath = os.path.join(options.output_dir, res, sample_name)
-        try:
-            image.save(fullpath)
-        except OSError as e:
-            # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so 
-            # we awkwardly check against a hard-coded limit
-            if (e.errno == errno.ENAMETOOLONG) or (len(fullpath) >= 259):
-                extension = os.path.splitext(sample_name)[1]
-                sample_name = res + '_' + str(uuid.uuid4()) + extension
-                image.save(os.path.join(options.output_dir, res, sample_name))
-            else:
-                raise
+        return image_html_info(rendered_path, display_name, options)
+
+
+def render_prepared_images(prepared_images, options):
+    """
+    Renders a list of images prepared by process_batch_results(); each element is either None
+    or a tuple (RenderingJob, display name, [collection names]).
 
-        # Use slashes regardless of os
-        file_name = '{}/{}'.format(res, sample_name)
+    Returns a list with, for each element, None or a list of [collection name,html info struct]
+    lists.
+    """
+
+    jobs = [p[0] for p in prepared_images if p is not None]
+
+    manifest_file = None
+    if options.skip_up_to_date_renderings:
+        manifest_file = os.path.join(options.output_dir, RenderingEngine.MANIFEST_FILE_NAME)
+    rendered_paths = iter(RenderingEngine(rendering_options(options), manifest_file).render(jobs))
 
-        return {
-            'filename': file_name,
-            'title': display_name,
-            'textStyle': 'font-family:verdana,arial,calibri;font-size:80%;text-align:left;margin-top:20;margin-bottom:5'
-        }
+    rendering_results = []
+    for prepared_image in prepared_images:
+        if prepared_image is None:
+            rendering_results.append(None)
+            continue
+        _, display_name, collection_names = prepared_image
+        rendered_path = next(rendered_paths)
+        if rendered_path is None:
+            rendering_results.append(None)
+            continue
+        rendered_image_html_info = image_html_info(rendered_path, display_name, options)
+        rendering_results.append([[res, rendered_image_html_info] for res in collection_names])
+
+    return rendering_results
 
 
 def prepare_html_subpages(images_html, output_dir, options=None):
@@ -388,16 +405,17 @@ def process_batch_results(options):
 
     ##%% Load ground truth if available
 
-    ground_truth_indexed_db = None
+    ground_truth = None
     
     if options.ground_truth_json_file and len(options.ground_truth_json_file) > 0:
 
-        ground_truth_indexed_db = IndexedJsonDb(options.ground_truth_json_file, b_normalize_paths=True,
-                                                filename_replacements=options.ground_truth_filename_replacements)
-
-        # Mark images in the ground truth as positive or negative
-        n_negative, n_positive, n_unknown, n_ambiguous = mark_detection_status(ground_truth_indexed_db,
-            negative_classes=options.negative_classes, unknown_classes=options.unlabeled_classes)
+        # Per-image ground truth arrays, with images marked as positive or negative
+        ground_truth = load_ground_truth_arrays(options.ground_truth_json_file, normalize_paths=True,
+                                                filename_replacements=options.ground_truth_filename_replacements,
+                                                negative_classes=options.negative_classes,
+                                                unknown_classes=options.unlabeled_classes,
+                                                use_cache=options.ground_truth_use_cache)
+        n_negative, n_positive, n_unknown, n_ambiguous = ground_truth.status_counts()
         print('Finished loading and indexing ground truth: {} negative, {} positive, {} unknown, {} ambiguous'.format(
                 n_negative, n_positive, n_unknown, n_ambiguous))
 
@@ -407,7 +425,8 @@ def process_batch_results(options):
     if options.api_detection_results is None:
         detection_results, other_fields = load_api_results(options.api_output_file,
                                                  normalize_paths=True,
-                                                 filename_replacements=options.api_output_filename_replacements)
+                                                 filename_replacements=options.api_output_filename_replacements,
+                                                 use_cache=options.api_output_use_cache)
         ppresults.api_detection_results = detection_results
         ppresults.api_other_fields = other_fields
         
@@ -445,27 +464,18 @@ def process_batch_results(options):
 
     ##%% If we have ground truth, remove images we can't match to ground truth
 
-    if ground_truth_indexed_db is not None:
-
-        b_match = [False] * len(detection_results)
+    if ground_truth is not None:
 
-        detector_files = detection_results['file'].tolist()
+        b_match = ground_truth.find(detection_results['file'].values) >= 0
 
-        # fn = detector_files[0]; print(fn)
-        for i_fn, fn in enumerate(detector_files):
-
-            # assert fn in ground_truth_indexed_db.filename_to_id, 'Could not find ground truth for row {} ({})'.format(i_fn,fn)
-            if fn in ground_truth_indexed_db.filename_to_id:
-                b_match[i_fn] = True
-
-        print('Confirmed filename matches to ground truth for {} of {} files'.format(sum(b_match), len(detector_files)))
+        print('Confirmed filename matches to ground truth for {} of {} files'.format(np.sum(b_match),
+              len(detection_results)))
 
         detection_results = detection_results[b_match]
-        detector_files = detection_results['file'].tolist()
 
-        assert len(detector_files) > 0, 'No detection files available, possible ground truth path issue?'
+        assert len(detection_results) > 0, 'No detection files available, possible ground truth path issue?'
         
-        print('Trimmed detection results to {} files'.format(len(detector_files)))
+        print('Trimmed detection results to {} files'.format(len(detection_results)))
 
     
     ##%% Sample images for visualization
@@ -495,68 +505,37 @@ def process_batch_results(options):
     #
     # Otherwise we'll just visualize detections/non-detections.
 
-    if ground_truth_indexed_db is not None:
+    if ground_truth is not None:
 
         ##%% Detection evaluation: compute precision/recall
 
-        # numpy array of detection probabilities
-        p_detection = detection_results['max_detection_conf'].values
-        n_detections = len(p_detection)
-
-        # numpy array of bools (0.0/1.0), and -1 as null value
-        gt_detections = np.zeros(n_detections, dtype=float)
-
-        for i_detection, fn in enumerate(detector_files):
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detection_status = image['_detection_status']
-
-            if detection_status == DetectionStatus.DS_NEGATIVE:
-                gt_detections[i_detection] = 0.0
-            elif detection_status == DetectionStatus.DS_POSITIVE:
-                gt_detections[i_detection] = 1.0
-            else:
-                gt_detections[i_detection] = -1.0
-
-        # Don't include ambiguous/unknown ground truth in precision/recall analysis
-        b_valid_ground_truth = gt_detections >= 0.0
-
-        p_detection_pr = p_detection[b_valid_ground_truth]
-        gt_detections_pr = gt_detections[b_valid_ground_truth]
-
-        print('Including {} of {} values in p/r analysis'.format(np.sum(b_valid_ground_truth),
-              len(b_valid_ground_truth)))
+        # Align detection results with ground truth; gt_label is 1.0/0.0 for positive/negative
+        # images, and -1 for ambiguous/unknown images, which we don't include in precision/recall
+        # analysis
+        predicted_classes = predicted_classes_from_detections(detection_results['detections'].values,
+                                                              classification_categories_map)
+        evaluation = match_to_ground_truth(ground_truth, detection_results['file'].values,
+                                           detection_results['max_detection_conf'].values, predicted_classes)
+        assert evaluation.n_images == len(detection_results)
 
-        precisions, recalls, thresholds = precision_recall_curve(gt_detections_pr, p_detection_pr)
+        print('Including {} of {} values in p/r analysis'.format(np.sum(evaluation.gt_label >= 0.0),
+              evaluation.n_images))
 
-        # For completeness, include the result at a confidence threshold of 1.0
-        thresholds = np.append(thresholds, [1.0])
-
-        precisions_recalls = pd.DataFrame(data={
-                'confidence_threshold': thresholds,
-                'precision': precisions,
-                'recall': recalls
-            })
+        precisions_recalls, average_precision = precision_recall(evaluation.max_conf, evaluation.gt_label)
+        precisions = precisions_recalls['precision'].values
+        recalls = precisions_recalls['recall'].values
 
         # Compute and print summary statistics
-        average_precision = average_precision_score(gt_detections_pr, p_detection_pr)
         print('Average precision: {:.1%}'.format(average_precision))
 
         # Thresholds go up throughout precisions/recalls/thresholds; find the last
         # value where recall is at or above target.  That's our precision @ target recall.
         target_recall = 0.9
-        b_above_target_recall = np.where(recalls >= target_recall)
-        if not np.any(b_above_target_recall):
-            precision_at_target_recall = 0.0
-        else:
-            i_target_recall = np.argmax(b_above_target_recall)
-            precision_at_target_recall = precisions[i_target_recall]
+        precision_at_target_recall = precision_at_recall(precisions_recalls, target_recall)
         print('Precision at {:.1%} recall: {:.1%}'.format(target_recall, precision_at_target_recall))
 
-        cm = confusion_matrix(gt_detections_pr, np.array(p_detection_pr) > options.confidence_threshold)
-
-        # Flatten the confusion matrix
-        tn, fp, fn, tp = cm.ravel()
+        tp, fp, fn, tn = [counts[0] for counts in confusion_counts(evaluation.max_conf, evaluation.gt_label,
+                                                                   [options.confidence_threshold])]
 
         precision_at_confidence_threshold = tp / (tp + fp)
         recall_at_confidence_threshold = tp / (tp + fn)
@@ -568,76 +547,23 @@ def process_batch_results(options):
 
         ##%% Collect classification results, if they exist
         
-        classifier_accuracies = []
-        
-        # Mapping of classnames to idx for the confusion matrix.
-        #
-        # The lambda is actually kind of a hack, because we use assume that
-        # the following code does not reassign classname_to_idx
-        classname_to_idx = collections.defaultdict(lambda: len(classname_to_idx))
-        
-        # Confusion matrix as defaultdict of defaultdict
-        #
-        # Rows / first index is ground truth, columns / second index is predicted category
-        classifier_cm = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
-        
-        # iDetection = 0; fn = detector_files[iDetection]; print(fn)
-        assert len(detector_files) == len(detection_results)
-        for iDetection,fn in enumerate(detector_files):
-            
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detections = detection_results['detections'].iloc[iDetection]
-            pred_class_ids = [det['classifications'][0][0] \
-                for det in detections if 'classifications' in det.keys()]
-            pred_classnames = [classification_categories_map[pd] for pd in pred_class_ids]
-
-            # If this image has classification predictions, and an unambiguous class
-            # annotated, and is a positive image...
-            if len(pred_classnames) > 0 \
-                    and '_unambiguous_category' in image.keys() \
-                    and image['_detection_status'] == DetectionStatus.DS_POSITIVE:
-                        
-                # The unambiguous category, we make this a set for easier handling afterward
-                gt_categories = set([image['_unambiguous_category']])
-                pred_categories = set(pred_classnames)
-                
-                # Compute the accuracy as intersection of union,
-                # i.e. (# of categories in both prediciton and GT)
-                #      divided by (# of categories in either prediction or GT
-                #
-                # In case of only one GT category, the result will be 1.0, if
-                # prediction is one category and this category matches GT
-                #
-                # It is 1.0/(# of predicted top-1 categories), if the GT is
-                # one of the predicted top-1 categories.
-                #
-                # It is 0.0, if none of the predicted categories is correct
-                
-                classifier_accuracies.append(
-                    len(gt_categories & pred_categories)
-                    / len(gt_categories | pred_categories)
-                )
-                image['_classification_accuracy'] = classifier_accuracies[-1]
-                
-                # Distribute this accuracy across all predicted categories in the
-                # confusion matrix
-                assert len(gt_categories) == 1
-                gt_class_idx = classname_to_idx[list(gt_categories)[0]]
-                for pred_category in pred_categories:
-                    pred_class_idx = classname_to_idx[pred_category]
-                    classifier_cm[gt_class_idx][pred_class_idx] += 1
-
-        # ...for each file in the detection results
+        # Accuracy of each image's top-1 classifications (NaN for images that were not evaluated),
+        # and confusion matrix counts, with ground truth in rows and predicted categories in columns
+        image_accuracy, classifier_cm_counts = classification_metrics(evaluation)
+        classifier_accuracies = image_accuracy[~np.isnan(image_accuracy)]
+
+        # Classification accuracy by ground truth image, used when sampling images below
+        gt_classification_accuracy = np.full(ground_truth.n_images, np.nan)
+        gt_classification_accuracy[evaluation.gt_index] = image_accuracy
         
         # If we have classification results
         if len(classifier_accuracies) > 0:
             
-            # Build confusion matrix as array from classifier_cm
-            all_class_ids = sorted(classname_to_idx.values())
-            classifier_cm_array = np.array(
-                [[classifier_cm[r_idx][c_idx] for c_idx in all_class_ids] for r_idx in all_class_ids], dtype=float)
+            # Build confusion matrix over the classes that appear in it
+            b_class_used = (classifier_cm_counts.sum(axis=0) + classifier_cm_counts.sum(axis=1)) > 0
+            classifier_cm_array = classifier_cm_counts[b_class_used][:, b_class_used]
             classifier_cm_array /= (classifier_cm_array.sum(axis=1, keepdims=True) + 1e-7)
+            classname_list = [name for name, b in zip(evaluation.class_names, b_class_used) if b]
 
             # Print some statistics
             print("Finished computation of {} classification results".format(len(classifier_accuracies)))
@@ -650,8 +576,6 @@ def process_batch_results(options):
             np.savetxt(sio, classifier_cm_array * 100, fmt='%5.1f')
             cm_str = sio.getvalue()
             # Get fixed-size classname for each idx
-            idx_to_classname = {v:k for k,v in classname_to_idx.items()}
-            classname_list = [idx_to_classname[idx] for idx in sorted(classname_to_idx.values())]
             classname_headers = ['{:<5}'.format(cname[:5]) for cname in classname_list]
 
             # Prepend class name on each line and add to the top
@@ -731,7 +655,7 @@ def process_batch_results(options):
             # Filenames should already have been normalized to either '/' or '\'
             files_to_render.append([row['file'],row['max_detection_conf'],row['detections']])
             
-        def render_image_with_gt(file_info):
+        def prepare_image_with_gt(file_info):
 
             image_relative_path = file_info[0]
             max_conf = file_info[1]
@@ -739,20 +663,17 @@ def process_batch_results(options):
 
             # This should already have been normalized to either '/' or '\'
 
-            image_id = ground_truth_indexed_db.filename_to_id.get(image_relative_path, None)
-            if image_id is None:
+            i_gt = ground_truth.find([image_relative_path])[0]
+            if i_gt < 0:
                 print('Warning: couldn''t find ground truth for image {}'.format(image_relative_path))
                 return None
 
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            annotations = ground_truth_indexed_db.image_id_to_annotations[image_id]
-
-            gt_status = image['_detection_status']
+            image_id = ground_truth.image_ids[i_gt]
+            gt_status = DetectionStatus(ground_truth.detection_status[i_gt])
 
             gt_presence = bool(gt_status)
 
-            gt_classes = CameraTrapJsonUtils.annotations_to_classnames(
-                    annotations,ground_truth_indexed_db.cat_id_to_name)
+            gt_classes = ground_truth.image_category_names(i_gt)
             gt_class_summary = ','.join(gt_classes)
 
             if gt_status > DetectionStatus.DS_MAX_DEFINITIVE_VALUE:
@@ -763,9 +684,9 @@ def process_batch_results(options):
             detected = max_conf > options.confidence_threshold
 
             if gt_presence and detected:
-                if '_classification_accuracy' not in image.keys():
+                if np.isnan(gt_classification_accuracy[i_gt]):
                     res = 'tp'
-                elif np.isclose(1, image['_classification_accuracy']):
+                elif np.isclose(1, gt_classification_accuracy[i_gt]):
                     res = 'tpc'
                 else:
                     res = 'tpi'
@@ -780,37 +701,24 @@ def process_batch_results(options):
                 res.upper(), str(gt_presence), gt_class_summary,
                 max_conf * 100, image_relative_path)
 
-            rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
-                                                                image_relative_path,
-                                                                display_name,
-                                                                detections,
-                                                                res,
-                                                                detection_categories_map,
-                                                                classification_categories_map,
-                                                                options)
-
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res,rendered_image_html_info]]
-                for gt_class in gt_classes:
-                    image_result.append(['class_{}'.format(gt_class),rendered_image_html_info])
+            job = rendering_job(options.image_base_dir,
+                                image_relative_path,
+                                detections,
+                                res,
+                                detection_categories_map,
+                                classification_categories_map,
+                                options)
+
+            collection_names = [res] + ['class_{}'.format(gt_class) for gt_class in gt_classes]
             
-            return image_result
+            return job, display_name, collection_names
             
-        # ...def render_image_with_gt(file_info)
+        # ...def prepare_image_with_gt(file_info)
         
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_with_gt, files_to_render), total=len(files_to_render)))    
-        else:
-            # file_info = files_to_render[0]
-            for file_info in tqdm(files_to_render):        
-                rendering_results.append(render_image_with_gt(file_info))
+        # file_info = files_to_render[0]
+        prepared_images = [prepare_image_with_gt(file_info) for file_info in files_to_render]
+        rendering_results = render_prepared_images(prepared_images, options)
         elapsed = time.time() - start_time
         
         # Map all the rendering results in the list rendering_results into the 
@@ -907,11 +815,11 @@ def process_batch_results(options):
         # Show links to each GT class
         #
         # We could do this without classification results; currently we don't.
-        if len(classname_to_idx) > 0:
+        if len(classifier_accuracies) > 0:
             
             index_page += '<h3>Images of specific classes</h3><br/><div class="contentdiv">'
             # Add links to all available classes
-            for cname in sorted(classname_to_idx.keys()):
+            for cname in classname_list:
                 index_page += "<a href='class_{0}.html'>{0}</a> ({1})<br>".format(
                     cname,
                     len(images_html['class_{}'.format(cname)]))
@@ -966,8 +874,8 @@ def process_batch_results(options):
                                     row['max_detection_conf'],
                                     row['detections']])
             
-        # Local function for parallelization
-        def render_image_no_gt(file_info):
+        # Local function to decide which page(s) an image goes on
+        def prepare_image_no_gt(file_info):
             
             image_relative_path = file_info[0]
             max_conf = file_info[1]
@@ -999,38 +907,27 @@ def process_batch_results(options):
             rendering_options = copy.copy(options)
             if detection_status == DetectionStatus.DS_ALMOST:
                 rendering_options.confidence_threshold = rendering_options.almost_detection_confidence_threshold
-            rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
-                                                                image_relative_path,
-                                                                display_name,
-                                                                detections,
-                                                                res,
-                                                                detection_categories_map,
-                                                                classification_categories_map,
-                                                                rendering_options)
+            job = rendering_job(options.image_base_dir,
+                                image_relative_path,
+                                detections,
+                                res,
+                                detection_categories_map,
+                                classification_categories_map,
+                                rendering_options)
             
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res,rendered_image_html_info]]
-                for det in detections:
-                    if 'classifications' in det:
-                        top1_class = classification_categories_map[det['classifications'][0][0]]
-                        image_result.append(['class_{}'.format(top1_class),rendered_image_html_info])
+            collection_names = [res]
+            for det in detections:
+                if 'classifications' in det:
+                    top1_class = classification_categories_map[det['classifications'][0][0]]
+                    collection_names.append('class_{}'.format(top1_class))
             
-            return image_result
+            return job, display_name, collection_names
         
-        # ...def render_image_no_gt(file_info):
+        # ...def prepare_image_no_gt(file_info):
         
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_no_gt, files_to_render), total=len(files_to_render)))    
-        else:
-            for file_info in tqdm(files_to_render):        
-                rendering_results.append(render_image_no_gt(file_info))            
+        prepared_images = [prepare_image_no_gt(file_info) for file_info in files_to_render]
+        rendering_results = render_prepared_images(prepared_images, options)
         elapsed = time.time() - start_time
         
         # Map all the rendering results in the list rendering_results into the 
@@ -1163,6 +1060,20 @@ def main():
     parser.add_argument('--viz_target_width', action='store', type=int,
                         help='Output image width',
                         default=default_options.viz_target_width)
+    parser.add_argument('--api_output_use_cache', action='store_true',
+                        help='Cache the parsed API output next to it for faster re-runs')
+    parser.add_argument('--ground_truth_use_cache', action='store_true',
+                        help='Cache the indexed ground truth next to it for faster re-runs')
+    parser.add_argument('--parallelize_rendering_with_processes', action='store_true',
+                        help='Render images on a process pool, one process per core')
+    parser.add_argument('--rendered_image_format', action='store', type=str, choices=['jpeg', 'webp'],
+                        help='Format of rendered images (defaults to the format of each image)',
+                        default=default_options.rendered_image_format)
+    parser.add_argument('--rendered_image_quality', action='store', type=int,
+                        help='JPEG/WebP quality of rendered images (1-100)',
+                        default=default_options.rendered_image_quality)
+    parser.add_argument('--rerender_all_images', action='store_true',
+                        help='Render all images, even those that are up to date from a previous run')
     parser.add_argument('--random_output_sort', action='store_true', help='Sort output randomly (defaults to sorting by filename)')
 
     if len(sys.argv[1:]) == 0:
@@ -1171,6 +1082,10 @@ def main():
 
     args = parser.parse_args()
     args.sort_html_by_filename = not args.random_output_sort
+    args.skip_up_to_date_renderings = not args.rerender_all_images
+    args.parallelize_rendering = args.parallelize_rendering_with_processes
+    if args.parallelize_rendering_with_processes:
+        args.parallelize_rendering_n_cores = None
 
     options = PostProcessingOptions()
     args_to_object(args,options)
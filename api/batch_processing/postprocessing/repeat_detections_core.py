@@ -8,12 +8,15 @@
 
 # %% Imports and environment
 
+import math
 import os
 import warnings
+from collections import defaultdict
 from datetime import datetime
 from itertools import compress
 
 import jsonpickle
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
@@ -43,6 +46,13 @@ warnings.filterwarnings('ignore', 'Metadata warning', UserWarning)
 
 DETECTION_INDEX_FILE_NAME = 'detectionIndex.json'
 
+# Size (in relative coordinates) of the grid cells used to bucket candidate detections
+# by position; see CandidateLocationIndex
+CANDIDATE_GRID_CELL_SIZE = 0.02
+
+# If a query would touch more grid cells than this, just compare against all candidates
+MAX_GRID_CELLS_PER_QUERY = 400
+
 
 #%% Classes
 
@@ -75,6 +85,11 @@ class RepeatDetectionOptions:
 
     # Set to zero to disable parallelism
     nWorkers = 10  # joblib.cpu_count()
+    
+    # Matching and rendering are mostly pure Python, so threads don't buy much; 'processes' 
+    # sends each directory's detections to a pool of worker processes instead.  Results are
+    # the same either way.
+    parallelizationBackend = 'threads'  # 'processes'
 
     viz_target_width = 800
 
@@ -110,6 +125,10 @@ class RepeatDetectionOptions:
     # has changed relative to the structure the detector saw
     filenameReplacements = {}
 
+    # Keep a binary cache of the parsed input file next to it (see load_api_results.py), so
+    # repeated runs with different thresholds don't re-parse the .json file
+    bUseInputCache = False
+
     # How many folders up from the leaf nodes should we be going to aggregate images?
     nDirLevelsFromLeaf = 0
 
@@ -191,6 +210,86 @@ class DetectionLocation:
         return detection
 
 
+class CandidateLocationIndex:
+    """
+    Spatial index over the DetectionLocations found so far in one directory, used to find
+    all locations whose bbox has IoU >= iouThreshold with a new detection without comparing
+    against every location.
+
+    Locations are bucketed into a grid by their upper-left corner.  If IoU(a,b) >= t, the 
+    upper-left corners of a and b differ by at most (1-t)/t times the width (height) of a in 
+    x (y), so only nearby cells need to be searched; IoU is then computed in one vectorized
+    call (ct_utils.get_iou_array) over the candidates in those cells.
+    """
+
+    def __init__(self, iouThreshold, cellSize=CANDIDATE_GRID_CELL_SIZE):
+        
+        self.iouThreshold = iouThreshold
+        self.cellSize = cellSize
+        self.locations = []
+        
+        # n x 4 array of [x_min, y_min, width_of_box, height_of_box], grown as needed
+        self.bboxes = np.zeros((64, 4), dtype=np.float64)
+        
+        # Maps (column,row) grid cells to lists of indices into self.locations
+        self.cells = defaultdict(list)
+
+    def cell_index(self, v):
+        
+        return int(math.floor(v / self.cellSize))
+
+    def add(self, location):
+        
+        iLocation = len(self.locations)
+        if iLocation == len(self.bboxes):
+            self.bboxes = np.concatenate([self.bboxes, np.zeros_like(self.bboxes)])
+        bbox = location.bbox
+        self.bboxes[iLocation] = bbox
+        self.locations.append(location)
+        self.cells[(self.cell_index(bbox[0]), self.cell_index(bbox[1]))].append(iLocation)
+
+    def find_matches(self, bbox):
+        """
+        Returns the DetectionLocations whose bbox has IoU >= iouThreshold with [bbox], in the 
+        order they were added.
+        """
+        
+        nLocations = len(self.locations)
+        if nLocations == 0 or self.iouThreshold > 1.0:
+            return []
+        
+        candidateIndices = None
+        
+        # With a threshold <= 0 every location matches, so there's nothing to prune
+        if self.iouThreshold > 0:
+            
+            # A little slack for floating-point error
+            ratio = (1.0 - self.iouThreshold) / self.iouThreshold
+            rx = ratio * bbox[2] + 1e-9
+            ry = ratio * bbox[3] + 1e-9
+            
+            c0, c1 = self.cell_index(bbox[0] - rx), self.cell_index(bbox[0] + rx)
+            r0, r1 = self.cell_index(bbox[1] - ry), self.cell_index(bbox[1] + ry)
+            
+            if (c1 - c0 + 1) * (r1 - r0 + 1) <= MAX_GRID_CELLS_PER_QUERY:
+                candidateIndices = []
+                for c in range(c0, c1 + 1):
+                    for r in range(r0, r1 + 1):
+                        cell = self.cells.get((c, r))
+                        if cell is not None:
+                            candidateIndices.extend(cell)
+                if len(candidateIndices) == 0:
+                    return []
+                candidateIndices = np.array(candidateIndices)
+            
+        if candidateIndices is None:
+            candidateIndices = np.arange(nLocations)
+            
+        iou = ct_utils.get_iou_array(bbox, self.bboxes[candidateIndices])
+        matches = np.sort(candidateIndices[iou >= self.iouThreshold])
+        return [self.locations[i] for i in matches]
+    
+
 ##%% Helper functions
 
 def enumerate_images(dirName,outputFileName=None):
@@ -223,25 +322,49 @@ def render_bounding_box(detection, inputFileName, outputFileName, lineWidth):
 
 ##%% Look for matches (one directory) (function)
 
-def find_matches_in_directory(dirName, options, rowsByDirectory):
-    
-    if options.pbar is not None:
-        options.pbar.update()
-
-    # List of DetectionLocations
-    candidateDetections = []
+class DirectoryDetections:
+    """
+    The detections in one directory that are eligible to be flagged as suspicious, in a 
+    compact form that's cheap to send to worker processes.
+    """
 
-    rows = rowsByDirectory[dirName]
+    def __init__(self):
+        
+        # Image filenames; detections refer to these by index
+        self.filenames = []
+        
+        # One element per detection
+        self.imageIndices = []
+        self.detectionIndices = []
+        self.bboxes = []
+        self.confidences = []
+        self.categories = []
+
+    def to_arrays(self):
+        
+        self.imageIndices = np.array(self.imageIndices, dtype=np.int32)
+        self.detectionIndices = np.array(self.detectionIndices, dtype=np.int32)
+        self.bboxes = np.array(self.bboxes, dtype=np.float64).reshape(-1, 4)
+        self.confidences = np.array(self.confidences, dtype=np.float64)
+        return self
+    
 
+def get_directory_detections(rows, options):
+    """
+    Applies the per-detection filters in [options] (confidence range, excluded classes, 
+    maximum size) to a directory's rows, returning a DirectoryDetections object.
+    """
+    
+    directoryDetections = DirectoryDetections()
+    
     # iDirectoryRow = 0; row = rows.iloc[iDirectoryRow]
-    for iDirectoryRow, row in rows.iterrows():
+    for filename, maxP, detections in zip(rows['file'], rows['max_detection_conf'], rows['detections']):
 
-        filename = row['file']
         if not ct_utils.is_image_file(filename):
             continue
 
         # Don't bother checking images with no detections above threshold
-        maxP = float(row['max_detection_conf'])
+        maxP = float(maxP)
         if maxP < options.confidenceMin:
             continue
 
@@ -252,8 +375,10 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
         #   'bbox': [x_min, y_min, width_of_box, height_of_box]  # (x_min, y_min) is upper-left,
         #                                                           all in relative coordinates and length
         # }
-        detections = row['detections']
         assert len(detections) > 0
+        
+        iImage = len(directoryDetections.filenames)
+        bAddedImage = False
 
         # For each detection in this image
         for iDetection, detection in enumerate(detections):
@@ -275,7 +400,6 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                     continue
 
             bbox = detection['bbox']
-            confidence = detection['conf']
             
             # Is this detection too big to be suspicious?
             w, h = bbox[2], bbox[3]
@@ -288,44 +412,75 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                 # print('Ignoring very large detection with area {}'.format(area))
                 continue
 
-            category = detection['category']
-            
-            instance = IndexedDetection(iDetection=iDetection,
-                                        filename=row['file'], bbox=bbox, 
-                                        confidence=confidence, category=category)
+            if not bAddedImage:
+                directoryDetections.filenames.append(filename)
+                bAddedImage = True
+                
+            directoryDetections.imageIndices.append(iImage)
+            directoryDetections.detectionIndices.append(iDetection)
+            directoryDetections.bboxes.append(bbox)
+            directoryDetections.confidences.append(confidence)
+            directoryDetections.categories.append(detection['category'])
 
-            bFoundSimilarDetection = False
+        # ...for each detection
 
-            # For each detection in our candidate list
-            for iCandidate, candidate in enumerate(candidateDetections):
+    # ...for each row
+    
+    return directoryDetections.to_arrays()
 
-                # Is this a match?                    
-                iou = ct_utils.get_iou(bbox, candidate.bbox)
 
-                if iou >= options.iouThreshold:
-                    
-                    bFoundSimilarDetection = True
+def find_matches_in_directory_detections(dirName, directoryDetections, iouThreshold):
+    """
+    Groups the detections in [directoryDetections] into DetectionLocations.  Detections 
+    are visited in order; each is added to every existing location it matches, or starts a 
+    new location if it matches none.
+    """
+    
+    # List of DetectionLocations
+    candidateDetections = []
+    candidateIndex = CandidateLocationIndex(iouThreshold)
+    
+    for iInstance in range(len(directoryDetections.detectionIndices)):
+        
+        bbox = directoryDetections.bboxes[iInstance].tolist()
+        filename = directoryDetections.filenames[directoryDetections.imageIndices[iInstance]]
+        instance = IndexedDetection(iDetection=int(directoryDetections.detectionIndices[iInstance]),
+                                    filename=filename, bbox=bbox, 
+                                    confidence=float(directoryDetections.confidences[iInstance]), 
+                                    category=directoryDetections.categories[iInstance])
 
-                    # If so, add this example to the list for this detection
-                    candidate.instances.append(instance)
+        # For each detection in our candidate list that's a match...
+        matchingCandidates = candidateIndex.find_matches(bbox)
+        for candidate in matchingCandidates:
 
-                    # We *don't* break here; we allow this instance to possibly
-                    # match multiple candidates.  There isn't an obvious right or
-                    # wrong here.
+            # ...add this example to the list for this detection
+            candidate.instances.append(instance)
 
-            # ...for each detection on our candidate list
+            # We *don't* stop at the first match; we allow this instance to possibly
+            # match multiple candidates.  There isn't an obvious right or
+            # wrong here.
 
-            # If we found no matches, add this to the candidate list
-            if not bFoundSimilarDetection:
-                candidate = DetectionLocation(instance, detection, dirName)
-                candidateDetections.append(candidate)
+        # ...for each matching detection on our candidate list
 
-        # ...for each detection
+        # If we found no matches, add this to the candidate list
+        if len(matchingCandidates) == 0:
+            candidate = DetectionLocation(instance, {'bbox': bbox}, dirName)
+            candidateDetections.append(candidate)
+            candidateIndex.add(candidate)
 
-    # ...for each row
+    # ...for each detection
 
     return candidateDetections
 
+
+def find_matches_in_directory(dirName, options, rowsByDirectory):
+    
+    if options.pbar is not None:
+        options.pbar.update()
+
+    directoryDetections = get_directory_detections(rowsByDirectory[dirName], options)
+    return find_matches_in_directory_detections(dirName, directoryDetections, options.iouThreshold)
+
 # ...def find_matches_in_directory(dirName)
 
     
@@ -338,14 +493,22 @@ def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
     if options.pbar is not None:
         options.pbar.update()
 
+    # suspiciousDetectionsThisDir is a list of DetectionLocation objects
+    return render_suspicious_detections_for_directory(iDir, nDirs, suspiciousDetections[iDir], options)
+
+
+def render_suspicious_detections_for_directory(iDir, nDirs, suspiciousDetectionsThisDir, options):
+    """
+    Renders the DetectionLocations in [suspiciousDetectionsThisDir] and writes html pages 
+    for them; returns the path of the directory-level html page, or None if there was 
+    nothing to render.
+    """
+    
     if options.debugMaxRenderDir > 0 and iDir > options.debugMaxRenderDir:
         return None
 
     dirName = 'dir{:0>4d}'.format(iDir)
 
-    # suspiciousDetectionsThisDir is a list of DetectionLocation objects
-    suspiciousDetectionsThisDir = suspiciousDetections[iDir]
-
     if len(suspiciousDetectionsThisDir) == 0:
         return None
 
@@ -443,7 +606,7 @@ def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
 
     return directoryHtmlFile
 
-# ...def render_images_for_directory(iDir)
+# ...def render_suspicious_detections_for_directory(iDir)
 
 
 ##%% Update the detection table based on suspicious results, write .csv output
@@ -588,7 +751,8 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
     # Load file
 
     detectionResults, otherFields = load_api_results(inputFilename, normalize_paths=True,
-                                         filename_replacements=options.filenameReplacements)
+                                         filename_replacements=options.filenameReplacements,
+                                         use_cache=options.bUseInputCache)
     toReturn.detectionResults = detectionResults
     toReturn.otherFields = otherFields
 
@@ -679,8 +843,20 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
             for iDir, dirName in enumerate(tqdm(dirsToSearch)):
                 allCandidateDetections[iDir] = find_matches_in_directory(dirName, options, rowsByDirectory)
 
+        elif options.parallelizationBackend == 'processes':
+
+            # Send each worker just the filtered detections for one directory; joblib 
+            # returns results in input order, so this matches the serial path exactly.
+            options.pbar = None
+            allCandidateDetections = Parallel(n_jobs=options.nWorkers, prefer='processes')(
+                delayed(find_matches_in_directory_detections)(
+                    dirName, get_directory_detections(rowsByDirectory[dirName], options), options.iouThreshold)
+                for dirName in tqdm(dirsToSearch))
+
         else:
 
+            assert options.parallelizationBackend == 'threads', \
+                'Unknown parallelization backend {}'.format(options.parallelizationBackend)
             options.pbar = tqdm(total=len(dirsToSearch))
             allCandidateDetections = Parallel(n_jobs=options.nWorkers, prefer='threads')(
                 delayed(find_matches_in_directory)(dirName, options, rowsByDirectory) for dirName in tqdm(dirsToSearch))
@@ -809,7 +985,16 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
         nDirs = len(dirsToSearch)
         directoryHtmlFiles = [None] * nDirs
 
-        if options.bParallelizeRendering:
+        if options.bParallelizeRendering and options.parallelizationBackend == 'processes':
+
+            # Only send each worker the detections for the directory it's rendering
+            options.pbar = None
+
+            directoryHtmlFiles = Parallel(n_jobs=options.nWorkers, prefer='processes')(delayed(
+                render_suspicious_detections_for_directory)(iDir, nDirs, suspiciousDetections[iDir], options) 
+                for iDir in tqdm(range(nDirs)))
+
+        elif options.bParallelizeRendering:
 
             # options.pbar = tqdm(total=nDirs)
             options.pbar = None
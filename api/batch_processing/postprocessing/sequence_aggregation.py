@@ -0,0 +1,545 @@
+########
+#
+# sequence_aggregation.py
+#
+# Aggregates batch API output to sequence level: joins detector results to the seq_id and
+# frame_num fields of a COCO Camera Traps database, and computes, for each sequence:
+#
+# * the number of images (and of images that failed)
+# * the maximum and mean (over images) of max_detection_conf
+# * the number of detections above a confidence threshold, in total and on the busiest image
+# * the top detection categories, ranked by their maximum confidence in the sequence
+#
+# Everything is computed in one pass over the arrays of a ColumnarApiResults object (see
+# load_api_results.py), so a SequenceAggregates object can be computed once and then used for
+# any number of thresholds/metrics without going back to the .json file.
+#
+# Detector results are matched to database images either by file name (the 'file' field of
+# the results against 'file_name' in the database), or by image ID, using a function that
+# converts 'file' fields to image IDs (e.g. load_api_results.ss_file_to_file_name).
+#
+# Command-line use writes a sequence-level .json file:
+#
+# python sequence_aggregation.py api_output.json cct_db.json sequences.json --detection_threshold 0.1
+#
+# The output file has the 'info' and 'detection_categories' fields of the API output, and a
+# 'sequences' list with one entry per sequence:
+#
+# {"seq_id": "...", "images": ["file", ...] (in frame order), "n_images": 3, "n_failed": 0,
+#  "max_detection_conf": 0.98, "mean_detection_conf": 0.61, "n_detections": 4,
+#  "max_detections_per_image": 2,
+#  "top_classes": [{"category": "1", "conf": 0.98, "count": 4}, ...]}
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from api.batch_processing.postprocessing.load_api_results import CONF_DIGITS
+from api.batch_processing.postprocessing.load_api_results import caltech_file_to_file_name
+from api.batch_processing.postprocessing.load_api_results import load_api_results_columnar
+from api.batch_processing.postprocessing.load_api_results import normalize_paths_vectorized
+from api.batch_processing.postprocessing.load_api_results import ss_file_to_file_name
+
+DEFAULT_DETECTION_THRESHOLD = 0.0
+DEFAULT_N_TOP_CLASSES = 3
+
+# Functions that can be used from the command line to convert 'file' fields to image IDs
+FILE_TO_IMAGE_ID_FUNCTIONS = {
+    'ss': ss_file_to_file_name,
+    'caltech': caltech_file_to_file_name
+}
+
+
+#%% Database side
+
+class SequenceIndex:
+    """
+    The sequence membership of the images in a COCO Camera Traps database, sorted by the key
+    detector results are matched on (file name or image ID).  Images without a seq_id are left out.
+    """
+
+    # Unicode array of sorted, unique keys
+    keys = None
+
+    # Object array of the seq_id of each key
+    seq_ids = None
+
+    # float64 array of the frame_num of each key (NaN if missing)
+    frame_nums = None
+
+    @property
+    def n_images(self):
+        return len(self.keys)
+
+    def find(self, keys):
+        """
+        Returns an int64 array with the index of each of [keys] in this object, or -1 for keys
+        that are not in the database.
+        """
+
+        keys = np.asarray(keys, dtype=str)
+        if self.n_images == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        indices = np.searchsorted(self.keys, keys)
+        indices = np.minimum(indices, self.n_images - 1)
+        b_found = self.keys[indices] == keys
+        return np.where(b_found, indices, -1).astype(np.int64)
+
+
+def sequence_index_from_db(db, match_on='file_name', normalize_paths=True, filename_replacements={}):
+    """
+    Builds a SequenceIndex from a COCO Camera Traps database: a dict, a .json file name, or an
+    IndexedJsonDb/SqliteIndexedJsonDb (for which file names have already been normalized).
+
+    match_on is 'file_name' or 'id'; file names are normalized and replaced the same way
+    IndexedJsonDb does it.
+    """
+
+    assert match_on in ('file_name', 'id'), 'Can\'t match on {}'.format(match_on)
+
+    if isinstance(db, str):
+        with open(db) as f:
+            db = json.load(f)
+    if isinstance(db, dict):
+        images = db['images']
+    else:
+        images = list(db.image_id_to_image.values())
+        normalize_paths = False
+        filename_replacements = {}
+
+    table = pd.DataFrame(images, columns=['id', 'file_name', 'seq_id', 'frame_num'])
+    table = table[table['seq_id'].notna()]
+
+    keys = table[match_on].astype(str)
+    if match_on == 'file_name':
+        if normalize_paths:
+            keys = normalize_paths_vectorized(keys)
+        for s in filename_replacements:
+            keys = keys.str.replace(s, filename_replacements[s], regex=False)
+
+    # If a key appears more than once, the last image wins, as in IndexedJsonDb
+    keys = keys.to_numpy(dtype=str)
+    _, i_last_reversed = np.unique(keys[::-1], return_index=True)
+    i_images = len(keys) - 1 - i_last_reversed
+
+    index = SequenceIndex()
+    index.keys = keys[i_images]
+    index.seq_ids = table['seq_id'].to_numpy(dtype=object)[i_images]
+    index.frame_nums = pd.to_numeric(table['frame_num'], errors='coerce').to_numpy(dtype=np.float64)[i_images]
+    return index
+
+
+#%% Aggregation
+
+class SequenceAggregates:
+    """
+    Per-sequence summaries of detector results, in order of each sequence's first image in the
+    detector results.
+
+    The images of sequence i are image_result_index[j] (indices into the detector results) for
+    j in seq_image_start[i] ... seq_image_start[i] + n_images[i] - 1, in frame order.
+    """
+
+    # Object array of seq_ids
+    seq_ids = None
+
+    # int64 arrays of length n_sequences
+    n_images = None
+    n_failed = None
+    n_detections = None
+    max_detections_per_image = None
+    seq_image_start = None
+
+    # float64 arrays of length n_sequences, over images that didn't fail (NaN if they all did)
+    max_detection_conf = None
+    mean_detection_conf = None
+
+    # n_sequences x n_top_classes arrays: category IDs (int32, -1 where a sequence has fewer
+    # categories), the maximum confidence (float64) and the number of detections (int64) of
+    # each category, in descending order of confidence
+    top_class_category = None
+    top_class_conf = None
+    top_class_count = None
+
+    # int64 array of detector result indices, grouped by sequence
+    image_result_index = None
+
+    # 'file' field of each detector result, and the fields of the API output other than 'images'
+    files = None
+    other_fields = None
+
+    # Settings the aggregates were computed with
+    detection_threshold = None
+
+    # Number of detector results that couldn't be matched to a database image with a seq_id
+    n_unmatched_images = 0
+
+    @property
+    def n_sequences(self):
+        return len(self.seq_ids)
+
+    def sequence_files(self, i_seq):
+        """
+        Returns the 'file' fields of the images in sequence i_seq, in frame order.
+        """
+
+        start = self.seq_image_start[i_seq]
+        return [self.files[i] for i in self.image_result_index[start:start + self.n_images[i_seq]]]
+
+    def non_empty(self, threshold):
+        """
+        Returns a boolean array that's True for sequences with a detection at or above [threshold].
+        """
+
+        return np.nan_to_num(self.max_detection_conf, nan=0.0) >= threshold
+
+    def to_dataframe(self):
+        """
+        Returns a DataFrame indexed by seq_id, with one column per summary statistic, plus the
+        list of top classes (as (category, conf, count) tuples) and image files of each sequence.
+        """
+
+        top_classes = []
+        for i_seq in range(self.n_sequences):
+            top_classes.append([(str(c), conf, count) for c, conf, count in
+                                zip(self.top_class_category[i_seq], self.top_class_conf[i_seq],
+                                    self.top_class_count[i_seq]) if c >= 0])
+
+        df = pd.DataFrame({
+            'seq_id': self.seq_ids,
+            'n_images': self.n_images,
+            'n_failed': self.n_failed,
+            'max_detection_conf': self.max_detection_conf,
+            'mean_detection_conf': self.mean_detection_conf,
+            'n_detections': self.n_detections,
+            'max_detections_per_image': self.max_detections_per_image,
+            'top_classes': top_classes,
+            'files': [self.sequence_files(i_seq) for i_seq in range(self.n_sequences)]
+        })
+        return df.set_index('seq_id')
+
+
+def _image_max_conf(results):
+    """
+    Returns the max_detection_conf of each image in a ColumnarApiResults object (computed from
+    its detections if it's missing), and a boolean array marking images that failed.
+    """
+
+    max_conf = results.images['max_detection_conf'].to_numpy(dtype=np.float64).copy()
+
+    if 'failure' in results.images.columns:
+        b_failed = results.images['failure'].notna().to_numpy()
+    else:
+        b_failed = np.zeros(results.n_images, dtype=bool)
+
+    b_missing = np.isnan(max_conf) & ~b_failed
+    if b_missing.any():
+        detection_max = np.zeros(results.n_images, dtype=np.float64)
+        np.maximum.at(detection_max, results.detection_image_index, results.detection_conf)
+        max_conf[b_missing] = detection_max[b_missing]
+    max_conf[b_failed] = np.nan
+
+    return max_conf, b_failed
+
+
+def _top_classes(det_seq, det_category, det_conf, n_sequences, n_top_classes):
+    """
+    Ranks the categories of each sequence's detections by their maximum confidence.
+    """
+
+    top_category = np.full((n_sequences, n_top_classes), -1, dtype=np.int32)
+    top_conf = np.full((n_sequences, n_top_classes), np.nan, dtype=np.float64)
+    top_count = np.zeros((n_sequences, n_top_classes), dtype=np.int64)
+
+    if len(det_seq) == 0 or n_top_classes == 0:
+        return top_category, top_conf, top_count
+
+    df = pd.DataFrame({'seq': det_seq, 'category': det_category, 'conf': det_conf})
+    per_class = df.groupby(['seq', 'category'], sort=False)['conf'].agg(['max', 'size']).reset_index()
+
+    # Highest confidence first; ties go to the category with more detections, then the lower ID
+    per_class = per_class.sort_values(['seq', 'max', 'size', 'category'], ascending=[True, False, False, True])
+    rank = per_class.groupby('seq', sort=False).cumcount().to_numpy()
+    b_top = rank < n_top_classes
+
+    seq = per_class['seq'].to_numpy()[b_top]
+    rank = rank[b_top]
+    top_category[seq, rank] = per_class['category'].to_numpy()[b_top]
+    top_conf[seq, rank] = per_class['max'].to_numpy()[b_top]
+    top_count[seq, rank] = per_class['size'].to_numpy()[b_top]
+
+    return top_category, top_conf, top_count
+
+
+def aggregate_sequences(results, sequence_index, file_to_image_id=None,
+                        detection_threshold=DEFAULT_DETECTION_THRESHOLD, n_top_classes=DEFAULT_N_TOP_CLASSES):
+    """
+    Computes sequence-level summaries of detector results.
+
+    Args:
+        results: a ColumnarApiResults object
+        sequence_index: a SequenceIndex, built with match_on='file_name' if file_to_image_id is None,
+            or match_on='id' otherwise
+        file_to_image_id: optional function that converts a 'file' field in the detector results
+            to an image ID in the database
+        detection_threshold: only detections at or above this confidence are counted in
+            n_detections, max_detections_per_image and the top classes
+        n_top_classes: number of top classes to keep per sequence
+
+    Returns:
+        a SequenceAggregates object
+    """
+
+    files = results.images['file']
+    keys = files if file_to_image_id is None else files.map(file_to_image_id)
+
+    db_index = sequence_index.find(keys.to_numpy(dtype=str))
+    b_matched = db_index >= 0
+    result_index = np.nonzero(b_matched)[0]
+    db_index = db_index[b_matched]
+
+    n_unmatched = results.n_images - len(result_index)
+    if n_unmatched > 0:
+        print('Warning: {} of {} images could not be matched to a sequence'.format(n_unmatched, results.n_images))
+
+    # Number sequences in order of their first image in the detector results
+    seq_codes, seq_ids = pd.factorize(pd.Series(sequence_index.seq_ids[db_index], dtype=object))
+    seq_ids = np.asarray(seq_ids, dtype=object)
+    n_sequences = len(seq_ids)
+
+    image_seq = np.full(results.n_images, -1, dtype=np.int64)
+    image_seq[result_index] = seq_codes
+
+    # Image-level statistics
+    image_max_conf, b_failed = _image_max_conf(results)
+    image_max_conf = image_max_conf[result_index]
+    b_failed = b_failed[result_index]
+    b_valid = ~np.isnan(image_max_conf)
+
+    n_images = np.bincount(seq_codes, minlength=n_sequences).astype(np.int64)
+    n_failed = np.bincount(seq_codes, weights=b_failed, minlength=n_sequences).astype(np.int64)
+    n_valid = np.bincount(seq_codes, weights=b_valid, minlength=n_sequences)
+
+    max_conf = np.full(n_sequences, -np.inf)
+    np.maximum.at(max_conf, seq_codes[b_valid], image_max_conf[b_valid])
+    max_conf[n_valid == 0] = np.nan
+
+    conf_sum = np.bincount(seq_codes[b_valid], weights=image_max_conf[b_valid], minlength=n_sequences)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_conf = conf_sum / n_valid
+    mean_conf[n_valid == 0] = np.nan
+
+    # Detection-level statistics
+    det_seq = image_seq[results.detection_image_index]
+    b_det = (det_seq >= 0) & (results.detection_conf >= detection_threshold)
+    det_image = results.detection_image_index[b_det]
+    det_seq = det_seq[b_det]
+
+    n_detections = np.bincount(det_seq, minlength=n_sequences).astype(np.int64)
+    image_n_detections = np.bincount(det_image, minlength=results.n_images)[result_index]
+    max_detections_per_image = np.zeros(n_sequences, dtype=np.int64)
+    np.maximum.at(max_detections_per_image, seq_codes, image_n_detections)
+
+    top_category, top_conf, top_count = _top_classes(det_seq, results.detection_category[b_det],
+                                                     results.detection_conf[b_det].astype(np.float64),
+                                                     n_sequences, n_top_classes)
+
+    # Group images by sequence, in frame order (then file order, for images without frame numbers)
+    frame_nums = sequence_index.frame_nums[db_index]
+    matched_files = files.to_numpy(dtype=str)[result_index]
+    order = np.lexsort((matched_files, frame_nums, seq_codes))
+
+    aggregates = SequenceAggregates()
+    aggregates.seq_ids = seq_ids
+    aggregates.n_images = n_images
+    aggregates.n_failed = n_failed
+    aggregates.n_detections = n_detections
+    aggregates.max_detections_per_image = max_detections_per_image
+    aggregates.max_detection_conf = max_conf
+    aggregates.mean_detection_conf = mean_conf
+    aggregates.top_class_category = top_category
+    aggregates.top_class_conf = top_conf
+    aggregates.top_class_count = top_count
+    aggregates.image_result_index = result_index[order]
+    aggregates.seq_image_start = np.zeros(n_sequences, dtype=np.int64)
+    aggregates.seq_image_start[1:] = np.cumsum(n_images)[:-1]
+    aggregates.files = files.tolist()
+    aggregates.other_fields = results.other_fields
+    aggregates.detection_threshold = detection_threshold
+    aggregates.n_unmatched_images = n_unmatched
+
+    return aggregates
+
+
+def aggregate_api_output(api_output_path, db, file_to_image_id=None,
+                         detection_threshold=DEFAULT_DETECTION_THRESHOLD, n_top_classes=DEFAULT_N_TOP_CLASSES,
+                         normalize_paths=None, filename_replacements={}, use_cache=False):
+    """
+    Loads an API output file and computes sequence-level summaries for it; [db] is anything
+    sequence_index_from_db() accepts, or a SequenceIndex.  See aggregate_sequences() for the
+    other arguments, and load_api_results_columnar() for use_cache.
+
+    normalize_paths defaults to True when matching by file name, and to False when
+    file_to_image_id is supplied, so that function sees 'file' fields as they are in the
+    .json file (e.g. ss_file_to_file_name splits on '/', which normpath changes on Windows).
+
+    Returns a SequenceAggregates object.
+    """
+
+    if normalize_paths is None:
+        normalize_paths = file_to_image_id is None
+
+    if isinstance(db, SequenceIndex):
+        sequence_index = db
+    else:
+        match_on = 'file_name' if file_to_image_id is None else 'id'
+        sequence_index = sequence_index_from_db(db, match_on=match_on, normalize_paths=normalize_paths,
+                                                filename_replacements=filename_replacements)
+
+    results = load_api_results_columnar(api_output_path, normalize_paths=normalize_paths,
+                                        filename_replacements=filename_replacements, use_cache=use_cache)
+    return aggregate_sequences(results, sequence_index, file_to_image_id=file_to_image_id,
+                               detection_threshold=detection_threshold, n_top_classes=n_top_classes)
+
+
+#%% Output
+
+def _round_conf(value, conf_digits):
+
+    return None if np.isnan(value) else round(float(value), conf_digits)
+
+
+def sequence_aggregates_to_json(aggregates, sequence_mask=None, conf_digits=CONF_DIGITS):
+    """
+    Converts a SequenceAggregates object to a dict in the sequence-level output format (see
+    the top of this file), optionally keeping only the sequences where [sequence_mask] is True.
+    """
+
+    info = dict(aggregates.other_fields.get('info', {}))
+    info['sequence_aggregation'] = {'detection_threshold': aggregates.detection_threshold,
+                                    'n_unmatched_images': int(aggregates.n_unmatched_images)}
+
+    sequences = []
+    for i_seq in range(aggregates.n_sequences):
+
+        if sequence_mask is not None and not sequence_mask[i_seq]:
+            continue
+
+        top_classes = []
+        for category, conf, count in zip(aggregates.top_class_category[i_seq], aggregates.top_class_conf[i_seq],
+                                         aggregates.top_class_count[i_seq]):
+            if category < 0:
+                break
+            top_classes.append({'category': str(category), 'conf': _round_conf(conf, conf_digits),
+                                'count': int(count)})
+
+        seq_id = aggregates.seq_ids[i_seq]
+        sequences.append({
+            'seq_id': seq_id.item() if isinstance(seq_id, np.generic) else seq_id,
+            'images': aggregates.sequence_files(i_seq),
+            'n_images': int(aggregates.n_images[i_seq]),
+            'n_failed': int(aggregates.n_failed[i_seq]),
+            'max_detection_conf': _round_conf(aggregates.max_detection_conf[i_seq], conf_digits),
+            'mean_detection_conf': _round_conf(aggregates.mean_detection_conf[i_seq], conf_digits),
+            'n_detections': int(aggregates.n_detections[i_seq]),
+            'max_detections_per_image': int(aggregates.max_detections_per_image[i_seq]),
+            'top_classes': top_classes
+        })
+
+    return {'info': info,
+            'detection_categories': aggregates.other_fields.get('detection_categories', {}),
+            'sequences': sequences}
+
+
+def write_sequence_aggregates(aggregates, output_path, sequence_mask=None, conf_digits=CONF_DIGITS):
+    """
+    Writes a SequenceAggregates object to a sequence-level .json file.
+    """
+
+    output = sequence_aggregates_to_json(aggregates, sequence_mask=sequence_mask, conf_digits=conf_digits)
+    with open(output_path, 'w') as f:
+        json.dump(output, f, indent=1)
+    print('Wrote {} sequences to {}'.format(len(output['sequences']), output_path))
+
+
+#%% Interactive driver
+
+if False:
+
+    #%%
+
+    api_output_path = '/datadrive/snapshotserengeti/results/detections.json'
+    db_path = '/datadrive/snapshotserengeti/databases/snapshotserengeti.json'
+    output_path = '/datadrive/snapshotserengeti/results/sequences.json'
+
+    aggregates = aggregate_api_output(api_output_path, db_path, file_to_image_id=ss_file_to_file_name,
+                                      detection_threshold=0.1, use_cache=True)
+    for threshold in [0.5, 0.8, 0.9]:
+        print('{} non-empty sequences at {}'.format(aggregates.non_empty(threshold).sum(), threshold))
+    write_sequence_aggregates(aggregates, output_path)
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Summarize batch API output per sequence, using seq_id/frame_num from a COCO Camera Traps database')
+    parser.add_argument('api_output_path', type=str, help='API output .json file')
+    parser.add_argument('db_path', type=str, help='COCO Camera Traps .json database with seq_id fields')
+    parser.add_argument('output_path', type=str, help='Sequence-level .json file to write')
+    parser.add_argument('--detection_threshold', type=float, default=DEFAULT_DETECTION_THRESHOLD,
+                        help='Only count detections at or above this confidence')
+    parser.add_argument('--n_top_classes', type=int, default=DEFAULT_N_TOP_CLASSES,
+                        help='Number of top classes to write per sequence')
+    parser.add_argument('--non_empty_threshold', type=float, default=None,
+                        help='Only write sequences whose max_detection_conf is at least this value')
+    parser.add_argument('--file_to_image_id', type=str, default=None, choices=sorted(FILE_TO_IMAGE_ID_FUNCTIONS),
+                        help='Match images by ID, converting \'file\' fields with this function, rather than by file name')
+    parser.add_argument('--use_sqlite_index', action='store_true',
+                        help='Read the database through a SQLite index (see cct_json_utils.SqliteIndexedJsonDb)')
+    parser.add_argument('--use_cache', action='store_true',
+                        help='Cache the parsed API output file next to it')
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    db = args.db_path
+    if args.use_sqlite_index:
+        from data_management.cct_json_utils import open_indexed_json_db
+        db = open_indexed_json_db(args.db_path, use_sqlite_index=True)
+
+    file_to_image_id = None
+    if args.file_to_image_id is not None:
+        file_to_image_id = FILE_TO_IMAGE_ID_FUNCTIONS[args.file_to_image_id]
+
+    aggregates = aggregate_api_output(args.api_output_path, db, file_to_image_id=file_to_image_id,
+                                      detection_threshold=args.detection_threshold,
+                                      n_top_classes=args.n_top_classes, use_cache=args.use_cache)
+
+    sequence_mask = None
+    if args.non_empty_threshold is not None:
+        sequence_mask = aggregates.non_empty(args.non_empty_threshold)
+        print('{} of {} sequences have a detection at or above {}'.format(
+            sequence_mask.sum(), aggregates.n_sequences, args.non_empty_threshold))
+
+    output_dir = os.path.dirname(args.output_path)
+    if len(output_dir) > 0:
+        os.makedirs(output_dir, exist_ok=True)
+    write_sequence_aggregates(aggregates, args.output_path, sequence_mask=sequence_mask)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -50,11 +50,13 @@
 #%% Constants and imports
 
 import json
+from collections import OrderedDict
 from tqdm import tqdm
 import os
-import copy
 
 from data_management.annotations import annotation_constants
+from api.batch_processing.postprocessing.api_output_reader import ApiOutputReader
+from api.batch_processing.postprocessing.api_output_writer import ApiOutputWriter
 
 
 #%% Helper classes
@@ -99,6 +101,15 @@ class SubsetJsonDetectorOutputOptions:
     
     debug_max_images = -1
     
+    # Read the input file one image at a time and write outputs as we go, rather than loading
+    # the whole file, so memory use doesn't depend on the size of the input.  Only used when
+    # reading from a file (i.e., when no data dictionary is supplied).
+    streaming = False
+    
+    # In streaming mode, the maximum number of output files that are open at a time when
+    # splitting by folders
+    max_open_files = 256
+    
     
 #%% Main function
 
@@ -138,9 +149,10 @@ def add_missing_detection_results_fields(data):
     return data
     
 
-def write_detection_results(data,output_filename,options):
+def prepare_output_file(output_filename,options):
     """
-    Write the detector-output-formatted dict *data* to *output_filename*.
+    Checks whether we're allowed to write to *output_filename*, and creates its folder if 
+    necessary.
     """
     
     if (not options.overwrite_json_files) and os.path.isfile(output_filename):
@@ -151,8 +163,16 @@ def write_detection_results(data,output_filename,options):
     if options.copy_jsons_to_folders and options.copy_jsons_to_folders_directories_must_exist:
         if not os.path.isdir(basedir):
             raise ValueError('Directory {} does not exist'.format(basedir))
-    else:
+    elif len(basedir) > 0:
         os.makedirs(basedir,exist_ok=True)
+
+
+def write_detection_results(data,output_filename,options):
+    """
+    Write the detector-output-formatted dict *data* to *output_filename*.
+    """
+    
+    prepare_output_file(output_filename,options)
     
     print('Serializing to {}...'.format(output_filename), end = '')    
     s = json.dumps(data, indent=1)
@@ -163,12 +183,51 @@ def write_detection_results(data,output_filename,options):
     print(' ...done')
 
 
+def apply_confidence_threshold(im,options):
+    """
+    Remove all detections below options.confidence_threshold from the image entry *im*, 
+    updating its max confidence accordingly.  Modifies *im* in place.
+    
+    Returns True if the max confidence changed.
+    """
+    
+    p_orig = im['max_detection_conf']
+
+    # Find all detections above threshold for this image
+    detections = [d for d in im['detections'] if d['conf'] >= options.confidence_threshold]
+
+    # If there are no detections above threshold, set the max probability
+    # to -1, unless it already had a negative probability.
+    if len(detections) == 0:
+        if p_orig <= 0:                
+            p = p_orig
+        else:
+            p = -1
+
+    # Otherwise find the max confidence
+    else:
+        p = max(d['conf'] for d in detections)
+    
+    im['detections'] = detections
+
+    # Did this thresholding result in a max-confidence change?
+    b_changed = False
+    if abs(p_orig - p) > 0.00001:
+
+        # We should only be *lowering* max confidence values (i.e., making them negative)
+        assert (p_orig <= 0) or (p < p_orig), 'Confidence changed from {} to {}'.format(p_orig,p)
+        b_changed = True
+    im['max_detection_conf'] = p
+    
+    return b_changed
+
+
 def subset_json_detector_output_by_confidence(data,options):
     """
     Remove all detections below options.confidence_threshold, update max confidences accordingly.
     """
     
-    if not options.confidence_threshold:
+    if options.confidence_threshold is None:
         return data
     
     images_in = data['images']
@@ -181,32 +240,8 @@ def subset_json_detector_output_by_confidence(data,options):
     # iImage = 0; im = images_in[0]
     for iImage,im in tqdm(enumerate(images_in),total=len(images_in)):
         
-        p_orig = im['max_detection_conf']
-
-        # Find all detections above threshold for this image
-        detections = [d for d in im['detections'] if d['conf'] >= options.confidence_threshold]
-
-        # If there are no detections above threshold, set the max probability
-        # to -1, unless it already had a negative probability.
-        if len(detections) == 0:
-            if p_orig <= 0:                
-                p = p_orig
-            else:
-                p = -1
-
-        # Otherwise find the max confidence
-        else:
-            p = max(d['conf'] for d in detections)
-        
-        im['detections'] = detections
-
-        # Did this thresholding result in a max-confidence change?
-        if abs(p_orig - p) > 0.00001:
-
-            # We should only be *lowering* max confidence values (i.e., making them negative)
-            assert (p_orig <= 0) or (p < p_orig), 'Confidence changed from {} to {}'.format(p_orig,p)
+        if apply_confidence_threshold(im,options):
             n_max_changes += 1
-        im['max_detection_conf'] = p
         images_out.append(im)
         
     # ...for each image        
@@ -218,6 +253,28 @@ def subset_json_detector_output_by_confidence(data,options):
     return data
 
 
+def apply_query(im,options):
+    """
+    Returns True if the filename of the image entry *im* matches options.query, in which 
+    case options.query is replaced with options.replacement in place.
+    """
+    
+    fn = im['file']
+    
+    # Only take images that match the query
+    if (options.query is not None) and (options.query not in fn):
+        return False
+    
+    if options.replacement is not None:
+        if options.query is not None:
+            fn = fn.replace(options.query,options.replacement)
+        else:
+            fn = options.replacement + fn
+        
+    im['file'] = fn
+    return True
+
+
 def subset_json_detector_output_by_query(data,options):
     """
     Subset to images whose filename matches options.query; replace all instances of 
@@ -232,21 +289,8 @@ def subset_json_detector_output_by_query(data,options):
     # iImage = 0; im = images_in[0]
     for iImage,im in tqdm(enumerate(images_in),total=len(images_in)):
         
-        fn = im['file']
-        
-        # Only take images that match the query
-        if (options.query is not None) and (options.query not in fn):
-            continue
-        
-        if options.replacement is not None:
-            if options.query is not None:
-                fn = fn.replace(options.query,options.replacement)
-            else:
-                fn = options.replacement + fn
-            
-        im['file'] = fn
-        
-        images_out.append(im)
+        if apply_query(im,options):
+            images_out.append(im)
         
     # ...for each image        
     
@@ -310,11 +354,178 @@ if False:
     p = r'c:\foo/bar'; s = top_level_folder(p); print(s); assert s == 'c:\\foo'
     
     
+def image_folder(fn,options):
+    """
+    Returns the folder that the image *fn* belongs to when splitting by folders.
+    """
+    
+    if options.split_folder_mode == 'bottom':
+        dirname = os.path.dirname(fn)
+    elif options.split_folder_mode == 'n_from_bottom':
+        dirname = os.path.dirname(fn)
+        for n in range(0,options.split_folder_param):
+            dirname = os.path.dirname(dirname)
+    elif options.split_folder_mode == 'top':
+        dirname = top_level_folder(fn)                
+    else:
+        raise ValueError('Unrecognized folder split mode {}'.format(options.split_folder_mode))
+    return dirname
+
+
+def folder_json_filename(dirname,output_filename,options):
+    """
+    Returns the .json filename to write the images in folder *dirname* to when splitting 
+    by folders.
+    """
+    
+    json_fn = dirname.replace('/','_').replace('\\','_') + '.json'
+    
+    if options.copy_jsons_to_folders:
+        return os.path.join(output_filename,dirname,json_fn)            
+    else:
+        return os.path.join(output_filename,json_fn)
+
+
+class FolderOutputWriters:
+    """
+    One ApiOutputWriter per output file, of which at most *max_open_files* have an open 
+    file handle at any time; the least recently used writer is suspended when we need 
+    to open another one.
+    """
+    
+    def __init__(self,fields,options):
+        
+        self.fields = fields
+        self.options = options
+        self.writers = {}
+        self.open_writers = OrderedDict()
+        
+    def write_image(self,json_fn,im):
+        
+        writer = self.writers.get(json_fn)
+        if writer is None:
+            prepare_output_file(json_fn,self.options)
+            writer = ApiOutputWriter.from_fields(json_fn,self.fields)
+            self.writers[json_fn] = writer
+            
+        if json_fn in self.open_writers:
+            self.open_writers.move_to_end(json_fn)
+        else:
+            while len(self.open_writers) >= max(1,self.options.max_open_files):
+                _, lru_writer = self.open_writers.popitem(last=False)
+                lru_writer.suspend()
+            self.open_writers[json_fn] = writer
+                
+        writer.write_image(im)
+        
+    def close(self,trailing_fields=None):
+        """
+        Finalizes all output files; returns a dict mapping output filenames to image counts.
+        """
+        
+        image_counts = {}
+        for json_fn, writer in self.writers.items():
+            writer.close(trailing_fields)
+            image_counts[json_fn] = writer.n_images
+        self.open_writers.clear()
+        return image_counts
+    
+    def abort(self):
+        
+        for writer in self.writers.values():
+            writer.abort()
+    
+
+def subset_json_detector_output_streaming(input_filename,output_filename,options):
+    """
+    Streaming version of subset_json_detector_output(): reads images from *input_filename*
+    one at a time, filters them, and appends them to their output file(s) right away.
+    
+    The output files are identical to the ones subset_json_detector_output() writes.
+    
+    Returns a dict mapping output filenames to the number of images written to each.
+    """
+    
+    reader = ApiOutputReader(input_filename)
+    writers = FolderOutputWriters(reader.fields_before_images,options)
+    
+    if options.split_folders:
+        os.makedirs(output_filename,exist_ok=True)
+    
+    n_images_in = 0
+    n_max_changes = 0
+    
+    # Folder name --> output filename, so we only compute each output filename once
+    folder_to_json_fn = {}
+    
+    print('Streaming images from {}'.format(input_filename))
+    
+    try:
+        
+        for im in tqdm(reader.iterate_images()):
+            
+            if options.debug_max_images > 0 and n_images_in >= options.debug_max_images:
+                break
+            n_images_in += 1
+            
+            if options.query is not None:
+                if not apply_query(im,options):
+                    continue
+                
+            if options.confidence_threshold is not None:
+                if apply_confidence_threshold(im,options):
+                    n_max_changes += 1
+            
+            if not options.split_folders:
+                writers.write_image(output_filename,im)
+                continue
+            
+            dirname = image_folder(im['file'],options)
+            json_fn = folder_to_json_fn.get(dirname)
+            if json_fn is None:
+                json_fn = folder_json_filename(dirname,output_filename,options)
+                folder_to_json_fn[dirname] = json_fn
+            
+            if options.make_folder_relative:
+                im['file'] = os.path.relpath(im['file'],dirname)
+                
+            writers.write_image(json_fn,im)
+        
+        # ...for each image
+        
+        # Fields after the 'images' array are only available once we've read all images
+        # (unless we stopped early)
+        trailing_fields = reader.fields_after_images
+        
+        # Without splitting, we write an output file even if no images matched
+        if not options.split_folders and len(writers.writers) == 0:
+            prepare_output_file(output_filename,options)
+            writers.writers[output_filename] = ApiOutputWriter.from_fields(output_filename,
+                                                                           reader.fields_before_images)
+            
+        image_counts = writers.close(trailing_fields)
+        
+    except:
+        writers.abort()
+        raise
+        
+    finally:
+        reader.close()
+        
+    print('Read {} images, wrote {} images to {} files, {} max conf changes'.format(
+        n_images_in,sum(image_counts.values()),len(image_counts),n_max_changes))
+    
+    return image_counts
+
+
 def subset_json_detector_output(input_filename,output_filename,options,data=None):
     """
     Main internal entry point
         
     Makes a copy of [data] before modifying if a data dictionary is supplied.
+    
+    If options.streaming is set and [data] is None, processes the input file one image at 
+    a time (see subset_json_detector_output_streaming()) and returns None.
     """
     
     if options is None:    
@@ -329,6 +540,10 @@ def subset_json_detector_output(input_filename,output_filename,options,data=None
         if os.path.isfile(output_filename):
             raise ValueError('When splitting by folders, output must be a valid directory name, you specified an existing file')
             
+    if data is None and options.streaming:
+        subset_json_detector_output_streaming(input_filename,output_filename,options)
+        return None
+    
     if data is None:
         print('Reading json...',end='')
         with open(input_filename) as f:
@@ -338,7 +553,10 @@ def subset_json_detector_output(input_filename,output_filename,options,data=None
             print('Trimming to {} images'.format(options.debug_max_images))
             data['images'] = data['images'][:options.debug_max_images]
     else:
-        data = copy.deepcopy(data)
+        # We only ever replace fields of image entries (never modify detections in place), 
+        # so copying the image entries is enough to leave the caller's data untouched
+        data = dict(data)
+        data['images'] = [dict(im) for im in data['images']]
         
     # data = add_missing_detection_results_fields(data)
     
@@ -364,17 +582,7 @@ def subset_json_detector_output(input_filename,output_filename,options,data=None
         
         # im = data['images'][0]
         for im in tqdm(data['images']):
-            fn = im['file']
-            if options.split_folder_mode == 'bottom':
-                dirname = os.path.dirname(fn)
-            elif options.split_folder_mode == 'n_from_bottom':
-                dirname = os.path.dirname(fn)
-                for n in range(0,options.split_folder_param):
-                    dirname = os.path.dirname(dirname)
-            elif options.split_folder_mode == 'top':
-                dirname = top_level_folder(fn)                
-            else:
-                raise ValueError('Unrecognized folder split mode {}'.format(options.split_folder_mode))
+            dirname = image_folder(im['file'],options)
             folders_to_images.setdefault(dirname,[]).append(im)
         
         print('Found {} unique folders'.format(len(folders_to_images)))
@@ -400,12 +608,7 @@ def subset_json_detector_output(input_filename,output_filename,options,data=None
         # dirname = list(folders_to_images.keys())[0]
         for dirname in tqdm(folders_to_images):
                         
-            json_fn = dirname.replace('/','_').replace('\\','_') + '.json'
-            
-            if options.copy_jsons_to_folders:
-                json_fn = os.path.join(output_filename,dirname,json_fn)            
-            else:
-                json_fn = os.path.join(output_filename,json_fn)
+            json_fn = folder_json_filename(dirname,output_filename,options)
             
             # Recycle the 'data' struct, replacing 'images' every time... medium-hacky, but 
             # forward-compatible in that I don't take dependencies on the other fields
@@ -506,6 +709,8 @@ def main():
     parser.add_argument('--overwrite_json_files', action='store_true', help='Overwrite output files')
     parser.add_argument('--copy_jsons_to_folders', action='store_true', help='When using split_folders and make_folder relative, copy jsons to their corresponding folders (relative to output_file)')    
     parser.add_argument('--create_folders', action='store_true', help='When using copy_jsons_to_folders, create folders that don''t exist')    
+    parser.add_argument('--streaming', action='store_true', help='Process the input file one image at a time, using constant memory')
+    parser.add_argument('--max_open_files', type=int, default=256, help='In streaming mode, the maximum number of output files to keep open at a time')
     
     if len(sys.argv[1:])==0:
         parser.print_help()
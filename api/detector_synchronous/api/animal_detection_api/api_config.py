@@ -7,6 +7,10 @@ IMAGE_CONTENT_TYPES = ['image/png', 'application/octet-stream', 'image/jpeg']
 
 GPU_BATCH_SIZE = 8
 
+# Images from concurrent requests are coalesced into batches of up to GPU_BATCH_SIZE; a batch is run once it's full,
+# or this many milliseconds after its first image arrived
+MAX_BATCH_WAIT_MS = 20
+
 MODEL_PATH = '/app/animal_detection_api/model/megadetector_v3_tf19.pb'
 
 MODEL_VERSION = 'megadetector_v3_tf19'
@@ -0,0 +1,133 @@
+"""
+Dynamic micro-batching for the synchronous API.
+
+Each /detect request usually carries one or a few images, and requests are handled on concurrent threads, so running
+every request's images through the model separately means many small session.run calls. MicroBatchScheduler instead
+queues the images of all in-flight requests, and a single background thread runs them through the model in batches of
+up to max_batch_size: a batch is started as soon as it is full, or max_wait_seconds after its first image arrived,
+whichever comes first. Each request thread blocks until all of its images have been processed.
+
+Under light load a request waits at most max_wait_seconds longer than before; under bursty load, images from
+concurrent requests share GPU batches instead of queueing for the GPU one request at a time.
+"""
+
+import queue
+import threading
+import time
+
+
+class _PendingRequest:
+    """Collects the results for the items of one submit() call."""
+
+    def __init__(self, num_items):
+        self.results = [None] * num_items
+        self.num_remaining = num_items
+        self.exception = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def set_result(self, i_item, result):
+        with self.lock:
+            self.results[i_item] = result
+            self.num_remaining -= 1
+            if self.num_remaining == 0:
+                self.done.set()
+
+    def set_exception(self, exception):
+        with self.lock:
+            if self.exception is None:
+                self.exception = exception
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.results
+
+
+class MicroBatchScheduler:
+
+    def __init__(self, run_batch, max_batch_size, max_wait_seconds):
+        """
+        Args:
+            run_batch: function that takes a list of up to max_batch_size items and returns a list of results of the
+                same length; only ever called from the scheduler's thread
+            max_batch_size: maximum number of items per call to run_batch
+            max_wait_seconds: how long to wait for more items after the first item of a batch arrives
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_seconds = max_wait_seconds
+
+        # items are (pending_request, index of the item in its request, item), or None to stop the scheduler
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, items):
+        """Queues items for processing and blocks until all of them have been processed.
+
+        Returns: list of results, in the order of items
+
+        Raises: the exception raised by run_batch, if it failed on a batch that contained any of the items
+        """
+        if len(items) == 0:
+            return []
+        request = _PendingRequest(len(items))
+        for i_item, item in enumerate(items):
+            self.queue.put((request, i_item, item))
+        return request.wait()
+
+    def close(self):
+        """Stops the scheduler thread after the items queued so far have been processed."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _next_batch(self):
+        """Blocks until an item is available, then collects items until the batch is full or the wait window
+        has passed. Returns None if the scheduler is being stopped.
+        """
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_seconds
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    entry = self.queue.get(timeout=timeout)
+                else:
+                    # still take whatever is already queued
+                    entry = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # process this batch first, then stop
+                self.queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            num_requests = len(set(id(request) for request, _, _ in batch))
+            print('batching_scheduler.py, running a batch of {} images from {} requests'.format(
+                len(batch), num_requests))
+            try:
+                results = self.run_batch([item for _, _, item in batch])
+                assert len(results) == len(batch), 'run_batch returned {} results for {} items'.format(
+                    len(results), len(batch))
+            except Exception as e:
+                for request, _, _ in batch:
+                    request.set_exception(e)
+                continue
+
+            for (request, i_item, _), result in zip(batch, results):
+                request.set_result(i_item, result)
@@ -1,8 +1,11 @@
 import numpy as np
 import tensorflow as tf
-from PIL import Image, ImageDraw, ImageFont
+from PIL import ImageDraw, ImageFont
 
 from animal_detection_api import api_config
+from animal_detection_api import image_preprocessing
+from animal_detection_api.batching_scheduler import MicroBatchScheduler
+from animal_detection_api.detection_engine import DetectionEngine
 
 tf.logging.set_verbosity(tf.logging.ERROR)
 
@@ -17,37 +20,26 @@ COLORS = [
     'AliceBlue', 'Red', 'RoyalBlue', 'Gold', 'Chartreuse'
 ]
 
+# Images are resized to fit in a canvas of this (width, height), preserving their aspect ratio
+CANVAS_SIZE = (api_config.MAX_DIM, api_config.MIN_DIM)
+
 
 class TFDetector:
 
     def __init__(self, checkpoint):
-        self.detection_graph = self.load_model(checkpoint)
-        self.session = tf.Session(graph=self.detection_graph)
-
-    def load_model(self, checkpoint):
-        """Loads a detection model (i.e., create a graph) from a .pb file.
+        # load the model once, and warm it up so that the first request doesn't pay for graph optimization
+        self.engine = DetectionEngine(checkpoint, batch_size=api_config.GPU_BATCH_SIZE,
+                                      warmup_image_size=CANVAS_SIZE)
+        self.detection_graph = self.engine.graph
 
-        Args:
-            checkpoint: .pb file of the model.
-
-        Returns: the loaded graph.
-
-        """
-        print('tf_detector.py: Loading graph...')
-        detection_graph = tf.Graph()
-        with detection_graph.as_default():
-            od_graph_def = tf.GraphDef()
-            with tf.gfile.GFile(checkpoint, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
-        print('tf_detector.py: Detection graph loaded.')
-
-        return detection_graph
+        # images from concurrent requests are run through the model together, in batches of up to GPU_BATCH_SIZE
+        self.scheduler = MicroBatchScheduler(self._run_batch, api_config.GPU_BATCH_SIZE,
+                                             api_config.MAX_BATCH_WAIT_MS / 1000.0)
 
     @staticmethod
     def open_image(input):
-        """Opens an image in binary format using PIL.Image and convert to RGB mode.
+        """Opens an image in binary format using PIL.Image and convert to RGB mode. JPEGs will be decoded at reduced
+        resolution if they are much larger than CANVAS_SIZE.
 
         Args:
             input: an image in binary format read from the POST request's body or
@@ -56,7 +48,7 @@ class TFDetector:
         Returns:
             an PIL image object in RGB mode
         """
-        image = Image.open(input)
+        image = image_preprocessing.open_image(input, CANVAS_SIZE)
         if image.mode not in ('RGBA', 'RGB'):
             raise AttributeError('Input image not in RGBA or RGB mode and cannot be processed.')
         if image.mode == 'RGBA':
@@ -64,51 +56,37 @@ class TFDetector:
             image = image.convert(mode='RGB')
         return image
 
-    def _generate_detections_batch(self, images, image_tensor, box_tensor, score_tensor, class_tensor):
-        print('_generate_detections_batch')
-        np_images = [np.asarray(image, np.uint8) for image in images]
-        images_stacked = np.stack(np_images, axis=0) if len(images) > 1 else np.expand_dims(np_images[0], axis=0)
-        print('images_stacked shape: ', images_stacked.shape)
-
-        # performs inference
-        box_tensor, score_tensor, class_tensor = self.session.run(
-            [box_tensor, score_tensor, class_tensor],
-            feed_dict={image_tensor: images_stacked})
-        return box_tensor, score_tensor, class_tensor
+    def _run_batch(self, canvases):
+        """Runs one batch of padded images through the model; called on the scheduler's thread."""
+        boxes, scores, classes = self.engine.run(np.stack(canvases, axis=0))
+        return list(zip(boxes, scores, classes))
 
     def generate_detections_batch(self, images):
         # number of images should be small - all are loaded at once and a copy of resized version exists at one point
         print('tf_detector.py: generate_detections_batch...')
 
-        # resize the images since the client side renders them as small images too
-        height, width = api_config.MIN_DIM, api_config.MAX_DIM
-        resized_images = []
+        # resize the images since the client side renders them as small images too; the aspect ratio is preserved,
+        # and images are padded to CANVAS_SIZE so they can be stacked into batches
+        resized_images, canvases, image_extents = [], [], []
         for image in images:
-            resized_images.append(image.resize((width, height)))  # first time image is loaded by PIL
-        images = resized_images
+            resized_image = image_preprocessing.resize_to_fit(image, CANVAS_SIZE)  # first time image is loaded by PIL
+            canvas, image_extent = image_preprocessing.pad_to_canvas(resized_image, CANVAS_SIZE)
+            resized_images.append(resized_image)
+            canvases.append(canvas)
+            image_extents.append(image_extent)
 
-        # group the images into batches; image_batches is a list of lists
-        batch_size = api_config.GPU_BATCH_SIZE
-        image_batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
-        print('Length of image_batches: ', len(image_batches))
-        detections = []
+        # blocks until the scheduler has run all of this request's images, possibly batched with other requests'
+        outputs = self.scheduler.submit(canvases)
 
-        # get the operators to go in the fetch list
-        image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
-        box_tensor = self.detection_graph.get_tensor_by_name('detection_boxes:0')
-        score_tensor = self.detection_graph.get_tensor_by_name('detection_scores:0')
-        class_tensor = self.detection_graph.get_tensor_by_name('detection_classes:0')
-
-        for image_batch in image_batches:
-            b_box, b_score, b_class = self._generate_detections_batch(image_batch, image_tensor,
-                                                             box_tensor, score_tensor, class_tensor)
-            for i, image in enumerate(image_batch):
-                detections.append({
-                    'box': b_box[i],
-                    'score': b_score[i],
-                    'category': b_class[i],
-                    'image': image  # save the opened image for rendering
-                })
+        detections = []
+        for i_image, (box, score, category) in enumerate(outputs):
+            detections.append({
+                # boxes are relative to the original image, not the padded canvas
+                'box': image_preprocessing.unletterbox_boxes(box, image_extents[i_image]),
+                'score': score,
+                'category': category,
+                'image': resized_images[i_image]  # save the opened image for rendering
+            })
         return detections
 
     @staticmethod
@@ -2,9 +2,12 @@ import json
 from random import sample
 import os
 
+import numpy as np
+
 from sklearn.metrics import precision_recall_curve, average_precision_score, accuracy_score
 
-from api.batch_processing.postprocessing import load_api_results
+from api.batch_processing.postprocessing import sequence_aggregation
+from data_management import cct_json_utils
 from data_management.cct_json_utils import CameraTrapJsonUtils
 from visualization import visualization_utils
 
@@ -111,7 +114,8 @@ def get_number_empty_seq(gt_db_indexed):
 
 
 def empty_accuracy_seq_level(gt_db_indexed, detector_output_path, file_to_image_id,
-                             threshold=0.5, visualize_wrongly_classified=False, images_dir=''):
+                             threshold=0.5, visualize_wrongly_classified=False, images_dir='',
+                             sequence_aggregates=None):
     """ Ground truth label is empty if the fine-category label on all images in this sequence are "empty"
 
     Args:
@@ -123,13 +127,20 @@ def empty_accuracy_seq_level(gt_db_indexed, detector_output_path, file_to_image_
             classes don't agree with gt
         images_dir: directory where the 'file' field in the detector output is rooted at. Relevant only if
            visualize_wrongly_classified is true
+        sequence_aggregates: optional, a SequenceAggregates object (see sequence_aggregation.py) computed
+            for detector_output_path, so evaluating several thresholds doesn't reload the detector output
     Returns:
 
     """
-    # TODO move detector_output_path specific code out so that this function evaluates only on classification results (confidences)
     gt_seq_id_to_annotations = CameraTrapJsonUtils.annotations_groupby_image_field(gt_db_indexed, image_field='seq_id')
-    pred_seq_id_to_res = load_api_results.api_results_groupby(detector_output_path, gt_db_indexed,
-                                                              file_to_image_id)
+    if sequence_aggregates is None:
+        sequence_aggregates = sequence_aggregation.aggregate_api_output(detector_output_path, gt_db_indexed,
+                                                                        file_to_image_id=file_to_image_id,
+                                                                        normalize_paths=False)
+    seq_id_to_index = {seq_id: i for i, seq_id in enumerate(sequence_aggregates.seq_ids)}
+
+    # Sequences where every image failed have no confidence; treat them as empty
+    seq_max_conf = np.nan_to_num(sequence_aggregates.max_detection_conf, nan=0.0)
 
     gt_seq_level = []
     pred_seq_level = []
@@ -138,7 +149,7 @@ def empty_accuracy_seq_level(gt_db_indexed, detector_output_path, file_to_image_
 
     # evaluate on sequences that are present in both gt and the detector output file
     gt_sequences = set(gt_seq_id_to_annotations.keys())
-    pred_sequences = set(pred_seq_id_to_res.keys())
+    pred_sequences = set(seq_id_to_index.keys())
 
     diff = gt_sequences.symmetric_difference(pred_sequences)
     print('Number of sequences not in both gt and pred: {}'.format(len(diff)))
@@ -147,30 +158,31 @@ def empty_accuracy_seq_level(gt_db_indexed, detector_output_path, file_to_image_
 
     for seq_id in intersection_sequences:
         gt_seq_level.append(is_gt_seq_non_empty(gt_seq_id_to_annotations[seq_id], empty_category_id_in_gt))
-        pred_seq_level.append(pred_seq_max_conf(pred_seq_id_to_res[seq_id]))
+        pred_seq_level.append(seq_max_conf[seq_id_to_index[seq_id]])
 
     pred_class = [0 if max_conf < threshold else 1 for max_conf in pred_seq_level]
     accuracy = accuracy_score(gt_seq_level, pred_class)
 
     if visualize_wrongly_classified:
-        show_wrongly_classified_seq(pred_seq_id_to_res, intersection_sequences, gt_seq_level, pred_class, images_dir)
+        show_wrongly_classified_seq(sequence_aggregates, intersection_sequences, gt_seq_level, pred_class, images_dir)
 
     return accuracy, gt_seq_level, pred_seq_level, intersection_sequences
 
 
-def show_wrongly_classified_seq(pred_seq_id_to_res, seq_ids, gt_seq_level, pred_binary_seq_level, images_dir):
+def show_wrongly_classified_seq(sequence_aggregates, seq_ids, gt_seq_level, pred_binary_seq_level, images_dir):
     wrongly_classified_seqs = []
     for seq_id, gt, pred in zip(seq_ids, gt_seq_level, pred_binary_seq_level):
         if gt != pred:
             wrongly_classified_seqs.append((seq_id, gt, pred))
 
-    num_to_sample = 5
+    num_to_sample = min(5, len(wrongly_classified_seqs))
     sampled = sample(wrongly_classified_seqs, num_to_sample)
+    seq_id_to_index = {seq_id: i for i, seq_id in enumerate(sequence_aggregates.seq_ids)}
 
     for seq_id, gt, pred in sampled:
         print('Ground truth is {}, predicted class is {}, seq_id {}.'.format(gt, pred, seq_id))
-        predicted_res = pred_seq_id_to_res[seq_id]
-        predicted_res_files = [os.path.join(images_dir, item['file']) for item in predicted_res]
+        predicted_res_files = [os.path.join(images_dir, fn) for fn in
+                               sequence_aggregates.sequence_files(seq_id_to_index[seq_id])]
 
         fig = visualization_utils.show_images_in_a_row(predicted_res_files)
 
@@ -219,19 +231,18 @@ def make_detection_res(results_path, file_prefix=''):
     return detection_res
 
 
-def get_gt_db(gt_db_path):
+def get_gt_db(gt_db_path, use_sqlite_index=False):
     """ Load the CCT formatted DB and index it.
 
     Args:
         gt_db_path: path to the json DB.
+        use_sqlite_index: open the DB through an on-disk SQLite index (built on first use)
+            rather than loading it into memory.
 
     Returns:
-       An IndexedJsonDb object
+       An IndexedJsonDb (or SqliteIndexedJsonDb) object
     """
-    with open(gt_db_path) as f:
-        gt_db = json.load(f)
-    gt_indexed = cct_json_utils.IndexedJsonDb(gt_db)
-    return gt_indexed
+    return cct_json_utils.open_indexed_json_db(gt_db_path, use_sqlite_index=use_sqlite_index)
 
 
 
@@ -0,0 +1,28 @@
+#
+# run_benchmark.py
+#
+# Regression-tests detector builds against a fixed COCO Camera Traps benchmark database.  This
+# is the command-line driver of api/batch_processing/postprocessing/detection_evaluation.py,
+# which evaluates each detector output at image level, at sequence level and for each location
+# (average precision, precision at a target recall, and tp/fp/fn/tn, precision, recall, F1 and
+# accuracy at each threshold in a grid), and writes the results as .csv files.
+#
+# With --baseline_model and --max_ap_drop, exits with an error if a model's image- or
+# sequence-level average precision is more than max_ap_drop below the baseline's.
+#
+# Sample invocation, comparing a new build to the current one:
+#
+# python run_benchmark.py benchmark_db.json md_v4.json md_new.json --output_dir report --use_cache --baseline_model md_v4 --max_ap_drop 0.01
+#
+
+#%% Imports
+
+# Assumes the cameratraps repo root is on the path
+from api.batch_processing.postprocessing.detection_evaluation import main
+
+
+#%% Command-line driver
+
+if __name__ == '__main__':
+
+    main()
@@ -5,6 +5,18 @@
 # Takes the JSON file produced by the detection API and
 # classifies all boxes above a confidence threshold.
 #
+# Images are decoded and cropped in a pool of worker threads while the classifier
+# runs on the main thread.  Crops are kept as uint8 until they're passed to the
+# classifier.  If the classifier graph takes a batch of fixed-size images
+# (input shape [None, height, width, 3]), crops are resized to that size and
+# classified in batches across images; graphs exported by
+# export_inference_graph_definition.py take a single image of any size and do
+# their own resizing, so crops are classified one at a time.
+#
+# Optionally, crops are cached on disk (keyed by image file, box, padding factor
+# and crop size), so that re-running the classifier on the same boxes doesn't
+# need to decode the images again.
+#
 ######
 
 #%% Constants, imports, environment
@@ -12,7 +24,9 @@
 import os
 import time
 import argparse
+import hashlib
 import json
+from multiprocessing.pool import ThreadPool
 
 # Assumes that the root of the CameraTraps repo is on the PYTHONPATH
 import ct_utils
@@ -45,6 +59,12 @@ assert all([isinstance(x, str) for x in DETECTION_CATEGORY_WHITELIST])
 # Number of significant float digits in JSON output
 NUM_SIGNIFICANT_DIGITS = 3
 
+# Number of threads used to load images and extract crops
+DEFAULT_NUM_WORKERS = 4
+
+# Maximum number of crops per classifier call, for graphs that take batches
+DEFAULT_BATCH_SIZE = 32
+
 
 #%% Core detection functions
 
@@ -104,9 +124,145 @@ def add_classification_categories(json_object, classes_file):
 # def add_classification_categories
     
 
+#%% Crop extraction
+
+class CropClassifier:
+    """
+    Wraps a session for a classification graph with an 'input:0' and an 'output:0' tensor.
+
+    If the input tensor is a batch of fixed-size images, crop_size is its (width, height)
+    and classify() runs up to batch_size crops per sess.run call; otherwise, crop_size is
+    None and crops are run one at a time.
+    """
+
+    def __init__(self, classification_graph, batch_size=DEFAULT_BATCH_SIZE):
+
+        self.graph = classification_graph
+        self.session = tf.Session(graph=classification_graph)
+        self.image_tensor = classification_graph.get_tensor_by_name('input:0')
+        self.predictions_tensor = classification_graph.get_tensor_by_name('output:0')
+
+        self.crop_size = None
+        self.batch_size = 1
+        input_shape = self.image_tensor.shape
+        if input_shape.ndims == 4:
+            height, width = input_shape[1].value, input_shape[2].value
+            if height is not None and width is not None:
+                self.crop_size = (width, height)
+                self.batch_size = max(1, batch_size)
+        if self.crop_size is None:
+            with classification_graph.as_default():
+                self.predictions_tensor = tf.squeeze(self.predictions_tensor, [0])
+
+    def classify(self, crops):
+        """
+        Classifies a list of uint8 crops (arrays of shape [height, width, 3]), returning an
+        array of shape [len(crops), num_classes].
+        """
+
+        predictions = []
+        if self.crop_size is None:
+            for crop in crops:
+                # Scale pixel values to [0,1]
+                predictions.append(self.session.run(self.predictions_tensor,
+                                                    feed_dict={self.image_tensor: crop / 255}))
+            return np.array(predictions)
+
+        for i_start in range(0, len(crops), self.batch_size):
+            batch = np.stack(crops[i_start:i_start+self.batch_size]).astype(np.float32) / 255
+            predictions.append(self.session.run(self.predictions_tensor,
+                                                feed_dict={self.image_tensor: batch}))
+        return np.concatenate(predictions, axis=0)
+
+    def close(self):
+
+        self.session.close()
+
+
+def compute_crop_box(bbox, image_width, image_height, padding_factor=PADDING_FACTOR):
+    """
+    Pads the detection box *bbox* (relative [x_min, y_min, width, height]) to a square box,
+    enlarged by *padding_factor*, in pixel coordinates.
+
+    Returns [ymin, xmin, ymax, xmax], clipped to the image.
+    """
+
+    # Convert to [ymin, xmin, ymax, xmax] in pixel coordinates
+    box_coords_abs = np.array([bbox[1], bbox[0], bbox[1]+bbox[3], bbox[0]+bbox[2]]) * \
+        np.array([image_height, image_width, image_height, image_width])
+    # Pad the detected animal to a square box and additionally by padding_factor
+    bbox_sizes = np.array([box_coords_abs[2] - box_coords_abs[0], box_coords_abs[3] - box_coords_abs[1]])
+    offsets = (padding_factor * np.max(bbox_sizes) - bbox_sizes) / 2
+    crop_box = box_coords_abs + np.hstack([-offsets, offsets])
+    # However, we need to make sure that the box coordinates are still within the image
+    crop_box = np.maximum(0, crop_box).astype(int)
+    crop_box[2] = min(crop_box[2], image_height)
+    crop_box[3] = min(crop_box[3], image_width)
+    return crop_box
+
+
+def crop_cache_file(crop_cache_dir, image_path, bbox, padding_factor, crop_size):
+
+    key = json.dumps([os.path.abspath(image_path), list(bbox), padding_factor,
+                      None if crop_size is None else list(crop_size)])
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(crop_cache_dir, key[:2], key + '.npy')
+
+
+def load_crops(image_path, bboxes, padding_factor=PADDING_FACTOR, crop_size=None, crop_cache_dir=None):
+    """
+    Extracts padded crops for the detection boxes *bboxes* from the image *image_path*,
+    as uint8 arrays of shape [height, width, 3]; if *crop_size* (width, height) is not None,
+    crops are resized to that size.
+
+    Returns a list of crops, or None if the image can't be loaded.
+    """
+
+    crops = [None] * len(bboxes)
+    cache_files = [None] * len(bboxes)
+
+    if crop_cache_dir is not None:
+        for i_box, bbox in enumerate(bboxes):
+            cache_files[i_box] = crop_cache_file(crop_cache_dir, image_path, bbox, padding_factor, crop_size)
+            try:
+                crops[i_box] = np.load(cache_files[i_box])
+            except (OSError, ValueError):
+                pass
+        if all(crop is not None for crop in crops):
+            return crops
+
+    try:
+        image = PIL.Image.open(image_path).convert('RGB')
+    except KeyboardInterrupt as e:
+        raise e
+    except:
+        print('Couldn\'t load image {}'.format(image_path))
+        return None
+
+    for i_box, bbox in enumerate(bboxes):
+        if crops[i_box] is not None:
+            continue
+        ymin, xmin, ymax, xmax = compute_crop_box(bbox, image.width, image.height, padding_factor)
+        crop = image.crop((xmin, ymin, xmax, ymax))
+        if crop_size is not None:
+            crop = crop.resize(crop_size, PIL.Image.BILINEAR)
+        crops[i_box] = np.asarray(crop)
+        if cache_files[i_box] is not None:
+            os.makedirs(os.path.dirname(cache_files[i_box]), exist_ok=True)
+            np.save(cache_files[i_box], crops[i_box])
+
+    return crops
+
+
+def _load_crops_args(args):
+    return load_crops(*args)
+
+
+
 def classify_boxes(classification_graph, json_with_classes, image_dir, confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD,
                   detection_category_whitelist=DETECTION_CATEGORY_WHITELIST, padding_factor=PADDING_FACTOR,
-                  num_annotated_classes=NUM_ANNOTATED_CLASSES):
+                  num_annotated_classes=NUM_ANNOTATED_CLASSES, num_workers=DEFAULT_NUM_WORKERS,
+                  batch_size=DEFAULT_BATCH_SIZE, crop_cache_dir=None):
     """
     Takes a classification model and applies it to all detected boxes with a detection confidence
     larger than confidence_threshold.
@@ -122,6 +278,10 @@ def classify_boxes(classification_graph, json_with_classes, image_dir, confidenc
         padding_factor:       The function will enlarge the bounding boxes by this factor before passing them to the
                               classifier.
         num_annotated_classes: Number of top-scoring class predictions to store in the json
+        num_workers:          Number of threads used to load images and extract crops
+        batch_size:           Maximum number of crops per classifier call, if the graph takes batches of fixed-size
+                              images
+        crop_cache_dir:       Optional folder in which to cache crops
 
     Returns the updated json object. Classification results are added as field 'classifications' to all elements images/detections
     assuming a 0-based indexing of the classifier output, i.e. output with index 0 has the class key '0'
@@ -132,78 +292,70 @@ def classify_boxes(classification_graph, json_with_classes, image_dir, confidenc
     assert isinstance(detection_category_whitelist, list)
     assert all([isinstance(x, str) for x in detection_category_whitelist])
 
-    with classification_graph.as_default():
-
-        with tf.Session(graph=classification_graph) as sess:
-
-            # Get input and output tensors of classification model
-            image_tensor = classification_graph.get_tensor_by_name('input:0')
-            predictions_tensor = classification_graph.get_tensor_by_name('output:0')
-            predictions_tensor = tf.squeeze(predictions_tensor, [0])
-
-            # For each image
-            nImages = len(json_with_classes['images'])
-            for iImage in tqdm.tqdm(list(range(0,nImages))):
-
-                image_description = json_with_classes['images'][iImage]
-
-                # Read image
-                try:
-                    image_path = image_description['file']
-                    if image_dir:
-                        image_path = os.path.join(image_dir, image_path)
-                    image_data = np.array(PIL.Image.open(image_path).convert("RGB"))
-                    # Scale pixel values to [0,1]
-                    image_data = image_data / 255
-                    image_height, image_width, _ = image_data.shape
-                except KeyboardInterrupt as e:
-                    raise e
-                except:
-                    print('Couldn\'t load image {}'.format(image_path))
-                    continue
-
-                # For each box
-                nDetections = len(image_description['detections'])
-                for iBox in range(nDetections):
-
-                    cur_detection = image_description['detections'][iBox]
-
-                    # Skip detections with low confidence
-                    if cur_detection['conf'] < confidence_threshold:
-                        continue
-
-                    # Skip if detection category is not in whitelist
-                    if not cur_detection['category'] in detection_category_whitelist:
-                        continue
-
-                    # Skip if already classified
-                    if 'classifications' in cur_detection.keys() and len(cur_detection['classifications']) > 0:
-                        continue
-
-                    # Get current box in relative coordinates and format [x_min, y_min, width_of_box, height_of_box]
-                    box_orig = cur_detection['bbox']
-                    # Convert to [ymin, xmin, ymax, xmax] and
-                    # store it as 1x4 numpy array so we can re-use the generic multi-box padding code
-                    box_coords = np.array([[box_orig[1],
-                                            box_orig[0],
-                                            box_orig[1]+box_orig[3],
-                                            box_orig[0]+box_orig[2]
-                                          ]])
-                    # Convert normalized coordinates to pixel coordinates
-                    box_coords_abs = (box_coords * np.tile([image_height, image_width], (1,2)))
-                    # Pad the detected animal to a square box and additionally by PADDING_FACTOR, the result will be in crop_boxes
-                    # However, we need to make sure that it box coordinates are still within the image
-                    bbox_sizes = np.vstack([box_coords_abs[:,2] - box_coords_abs[:,0], box_coords_abs[:,3] - box_coords_abs[:,1]]).T
-                    offsets = (padding_factor * np.max(bbox_sizes, axis=1, keepdims=True) - bbox_sizes) / 2
-                    crop_boxes = box_coords_abs + np.hstack([-offsets,offsets])
-                    crop_boxes = np.maximum(0,crop_boxes).astype(int)
-                    # Get the first (and only) row as our bbox to classify
-                    crop_box = crop_boxes[0]
-
-                    # Get the image data for that box
-                    cropped_img = image_data[crop_box[0]:crop_box[2], crop_box[1]:crop_box[3]]
-                    # Run inference
-                    predictions = sess.run(predictions_tensor, feed_dict={image_tensor: cropped_img})
+    # Find the boxes to classify in each image
+    images_to_classify = []
+    for image_description in json_with_classes['images']:
+
+        detections_to_classify = []
+        for cur_detection in image_description['detections']:
+
+            # Skip detections with low confidence
+            if cur_detection['conf'] < confidence_threshold:
+                continue
+
+            # Skip if detection category is not in whitelist
+            if not cur_detection['category'] in detection_category_whitelist:
+                continue
+
+            # Skip if already classified
+            if 'classifications' in cur_detection.keys() and len(cur_detection['classifications']) > 0:
+                continue
+
+            detections_to_classify.append(cur_detection)
+
+        if len(detections_to_classify) > 0:
+            image_path = image_description['file']
+            if image_dir:
+                image_path = os.path.join(image_dir, image_path)
+            images_to_classify.append((image_path, detections_to_classify))
+
+    print('Classifying {} boxes in {} images'.format(
+        sum(len(detections) for _, detections in images_to_classify), len(images_to_classify)))
+
+    classifier = CropClassifier(classification_graph, batch_size)
+    pool = ThreadPool(max(1, num_workers))
+
+    try:
+
+        # Load crops a chunk of images at a time, so we only keep a bounded number of crops in memory
+        chunk_size = max(classifier.batch_size, 16 * max(1, num_workers))
+        progress = tqdm.tqdm(total=len(images_to_classify))
+
+        for i_chunk_start in range(0, len(images_to_classify), chunk_size):
+
+            chunk = images_to_classify[i_chunk_start:i_chunk_start+chunk_size]
+            load_args = [(image_path, [d['bbox'] for d in detections], padding_factor,
+                          classifier.crop_size, crop_cache_dir) for image_path, detections in chunk]
+
+            crops = []
+            detections_for_crops = []
+            for (image_path, detections), image_crops in zip(chunk, pool.imap(_load_crops_args, load_args)):
+                if image_crops is not None:
+                    crops.extend(image_crops)
+                    detections_for_crops.extend(detections)
+                progress.update()
+
+            # Run inference, in batches across images if the classifier supports it
+            while len(crops) > 0:
+
+                batch_crops = crops[:classifier.batch_size]
+                batch_detections = detections_for_crops[:classifier.batch_size]
+                crops = crops[classifier.batch_size:]
+                detections_for_crops = detections_for_crops[classifier.batch_size:]
+
+                batch_predictions = classifier.classify(batch_crops)
+
+                for cur_detection, predictions in zip(batch_detections, batch_predictions):
 
                     # Add an empty list to the json for our predictions
                     cur_detection['classifications'] = list()
@@ -212,13 +364,16 @@ def classify_boxes(classification_graph, json_with_classes, image_dir, confidenc
                         class_conf = ct_utils.truncate_float(predictions[class_idx].item())
                         cur_detection['classifications'].append(['%i'%class_idx, class_conf])
 
-                # ...for each box
+            # ...for each batch
 
-            # ...for each image
+        # ...for each chunk of images
 
-        # ...with tf.Session
+        progress.close()
 
-    # with classification_graph
+    finally:
+        pool.close()
+        pool.join()
+        classifier.close()
 
     return json_with_classes
 
@@ -228,7 +383,8 @@ def classify_boxes(classification_graph, json_with_classes, image_dir, confidenc
 def load_and_run_classifier(classifier_file, classes_file, image_dir, detector_json_file, output_json_file,
                           confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD, padding_factor=PADDING_FACTOR,
                           num_annotated_classes=NUM_ANNOTATED_CLASSES, detection_category_whitelist=DETECTION_CATEGORY_WHITELIST,
-                          detection_graph=None, classification_graph=None):
+                          detection_graph=None, classification_graph=None, num_workers=DEFAULT_NUM_WORKERS,
+                          batch_size=DEFAULT_BATCH_SIZE, crop_cache_dir=None):
 
     # Load classification model
     if classification_graph is None:
@@ -244,7 +400,7 @@ def load_and_run_classifier(classifier_file, classes_file, image_dir, detector_j
     # Run classifier on all images, changes will be writting directly to the json
     startTime = time.time()
     updated_json = classify_boxes(classification_graph, updated_json, image_dir, confidence_threshold, detection_category_whitelist,
-                                  padding_factor, num_annotated_classes)
+                                  padding_factor, num_annotated_classes, num_workers, batch_size, crop_cache_dir)
     elapsed = time.time() - startTime
     print("Done running detector and classifier in {}".format(humanfriendly.format_timespan(elapsed)))
 
@@ -279,13 +435,22 @@ def main():
                         help='Number of top-scoring classes to add to the output for each bounding box, default: %d'%NUM_ANNOTATED_CLASSES)
     parser.add_argument('--detection_category_whitelist', type=str, nargs='+', default=DETECTION_CATEGORY_WHITELIST,
                         help='We will run the detector on all detections with these detection categories, default: ' + ' '.join(DETECTION_CATEGORY_WHITELIST))
+    parser.add_argument('--num_workers', action='store', type=int, default=DEFAULT_NUM_WORKERS,
+                        help='Number of threads used to load images and extract crops, default: %d'%DEFAULT_NUM_WORKERS)
+    parser.add_argument('--batch_size', action='store', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Maximum number of crops per classifier call, if the classifier takes batches of fixed-size ' + \
+                        'images, default: %d'%DEFAULT_BATCH_SIZE)
+    parser.add_argument('--crop_cache_dir', action='store', type=str, default=None,
+                        help='Optional folder in which to cache crops, so that re-running the classifier on the same ' + \
+                        'boxes doesn\'t need to decode the images again')
     args = parser.parse_args()
 
 
     load_and_run_classifier(classifier_file=args.classifier_file, classes_file=args.classes_file, image_dir=args.image_dir,
                           detector_json_file=args.detector_json_file, output_json_file=args.output_json_file,
                           confidence_threshold=args.threshold, padding_factor=args.padding_factor,
-                          num_annotated_classes=args.num_annotated_classes, detection_category_whitelist=args.detection_category_whitelist)
+                          num_annotated_classes=args.num_annotated_classes, detection_category_whitelist=args.detection_category_whitelist,
+                          num_workers=args.num_workers, batch_size=args.batch_size, crop_cache_dir=args.crop_cache_dir)
 
 
 if __name__ == '__main__':
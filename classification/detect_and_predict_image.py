@@ -29,6 +29,8 @@ import matplotlib.patches as patches
 import matplotlib.ticker as ticker
 import os
 
+from api.batch_processing.api_core.orchestrator_api.aml_scripts.detection_engine import DetectionEngine
+
 # Minimum detection confidence for showing a bounding box on the output image
 DEFAULT_CONFIDENCE_THRESHOLD = 0.85
 
@@ -59,12 +61,15 @@ def load_model(checkpoint):
     return graph
 
 
-def generate_detections(detection_graph,images):
+def generate_detections(detector,images):
     """
-    boxes,scores,classes,images = generate_detections(detection_graph,images)
+    boxes,scores,classes,images = generate_detections(detector,images)
 
     Run an already-loaded detector network on a set of images.
 
+    [detector] should be a DetectionEngine, or a detection graph returned by load_model(), in
+    which case a session is opened just for this call.
+
     [images] can be a list of numpy arrays or a list of filenames.  Non-list inputs will be
     wrapped into a list.
 
@@ -111,71 +116,23 @@ def generate_detections(detection_graph,images):
         else:
             assert isinstance(image,np.ndarray)
 
-    boxes = []
-    scores = []
-    classes = []
-
     nImages = len(images)
 
-    with detection_graph.as_default():
-
-        with tf.Session(graph=detection_graph) as sess:
-
-            for iImage,imageNP in enumerate(images):
-
-                print('Processing image {} of {}'.format(iImage,nImages))
-                imageNP_expanded = np.expand_dims(imageNP, axis=0)
-                image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-                box = detection_graph.get_tensor_by_name('detection_boxes:0')
-                score = detection_graph.get_tensor_by_name('detection_scores:0')
-                clss = detection_graph.get_tensor_by_name('detection_classes:0')
-                num_detections = detection_graph.get_tensor_by_name('num_detections:0')
+    if isinstance(detector,DetectionEngine):
+        engine = detector
+    else:
+        engine = DetectionEngine(graph=detector)
 
-                # Actual detection
-                (box, score, clss, num_detections) = sess.run(
-                        [box, score, clss, num_detections],
-                        feed_dict={image_tensor: imageNP_expanded})
+    print('Running detector on {} images'.format(nImages))
 
-                boxes.append(box)
-                scores.append(score)
-                classes.append(clss)
+    # Images of different sizes are run one at a time
+    boxes,scores,classes = engine.detect(images)
+    classes = classes.astype(int)
 
-            # ...for each image
+    if engine is not detector:
+        engine.close()
 
-    nBoxes = len(boxes)
-
-    # Currently "boxes" is a list of length nImages, where each element is shaped as
-    #
-    # 1,nDetections,4
-    #
-    # This implicitly banks on TF giving us back a fixed number of boxes, let's assert on this
-    # to make sure this doesn't silently break in the future.
-    nDetections = -1
-    # iBox = 0; box = boxes[iBox]
-    for iBox,box in enumerate(boxes):
-        nDetectionsThisBox = box.shape[1]
-        assert (nDetections == -1 or nDetectionsThisBox == nDetections), 'Detection count mismatch'
-        nDetections = nDetectionsThisBox
-        assert(box.shape[0] == 1)
-
-    # "scores" is a length-nImages list of elements with size 1,nDetections
-    assert(len(scores) == nImages)
-    for(iScore,score) in enumerate(scores):
-        assert score.shape[0] == 1
-        assert score.shape[1] == nDetections
-
-    # "classes" is a length-nImages list of elements with size 1,nDetections
-    #
-    # Still as floats, but really representing ints
-    assert(len(classes) == nBoxes)
-    for(iClass,c) in enumerate(classes):
-        assert c.shape[0] == 1
-        assert c.shape[1] == nDetections
-
-    # Squeeze out the empty axis
-    boxes = np.squeeze(np.array(boxes),axis=1)
-    scores = np.squeeze(np.array(scores),axis=1)
-    classes = np.squeeze(np.array(classes),axis=1).astype(int)
+    nDetections = boxes.shape[1]
 
     # boxes is nImages x nDetections x 4
     assert(len(boxes.shape) == 3)
@@ -430,9 +387,10 @@ def load_and_run_detector(detector_file, classifier_file, classes_file, image_fi
         print('Warning: no files available')
         return
 
-    # Load and run detector on target images
+    # Load and run detector on target images; [detection_graph] can also be a DetectionEngine,
+    # which is what we return so that callers can re-use its session
     if detection_graph is None:
-        detection_graph = load_model(detector_file)
+        detection_graph = DetectionEngine(detector_file)
 
     if classification_graph is None:
         classification_graph = load_model(classifier_file)
@@ -167,3 +167,45 @@ def get_iou(bb1, bb2):
     assert iou >= 0.0
     assert iou <= 1.0
     return iou
+
+
+def get_iou_array(bb1, bbs):
+    """
+    Vectorized version of get_iou(...): calculates the IoU of one bounding box with each of an 
+    array of bounding boxes.  Results are identical to calling get_iou(...) on each pair.
+
+    Args:
+        bb1: [x_min, y_min, width_of_box, height_of_box]
+        bbs: numpy array of shape (n, 4), each row [x_min, y_min, width_of_box, height_of_box]
+
+    Returns:
+        numpy array of shape (n,) with the intersection_over_union of bb1 and each row of bbs,
+        all in [0, 1]
+    """
+
+    bb1 = convert_xwyh_to_xyxy(bb1)
+    bbs = np.asarray(bbs, dtype=np.float64).reshape(-1, 4)
+
+    # Convert to [x1,y1,x2,y2] the same way convert_xwyh_to_xyxy does, so we get bit-identical 
+    # results
+    x1 = bbs[:, 0]
+    y1 = bbs[:, 1]
+    x2 = x1 + bbs[:, 2]
+    y2 = y1 + bbs[:, 3]
+
+    # Determine the coordinates of the intersection rectangles
+    x_left = np.maximum(bb1[0], x1)
+    y_top = np.maximum(bb1[1], y1)
+    x_right = np.minimum(bb1[2], x2)
+    y_bottom = np.minimum(bb1[3], y2)
+
+    b_overlap = (x_right >= x_left) & (y_bottom >= y_top)
+
+    intersection_area = (x_right - x_left) * (y_bottom - y_top)
+    bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
+    bbs_area = (x2 - x1) * (y2 - y1)
+
+    iou = np.zeros(len(bbs), dtype=np.float64)
+    iou[b_overlap] = intersection_area[b_overlap] / \
+        (bb1_area + bbs_area[b_overlap] - intersection_area[b_overlap])
+    return iou
@@ -4,6 +4,11 @@
 #
 # Utilities for working with COCO Camera Traps .json databases
 #
+# SqliteIndexedJsonDb is a drop-in replacement for IndexedJsonDb for large databases: the
+# .json file is converted once to an indexed SQLite file next to it, after which opening
+# the database takes well under a second, and images and annotations are only read from
+# disk when they're looked up.
+#
 # Format spec:
 #
 # https://github.com/Microsoft/CameraTraps/blob/master/data_management/README.md#coco-cameratraps-format
@@ -15,7 +20,12 @@
 
 import os
 import json
+import sqlite3
 from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
+
+SQLITE_INDEX_VERSION = 1
+SQLITE_INDEX_SUFFIX = '.index.sqlite'
 
 
 #%% Classes
@@ -135,15 +145,7 @@ class IndexedJsonDb:
         assert 'images' in self.db, 'Could not find image list in file {}, are you sure this is a COCO camera traps file?'.format(
             json_filename)
 
-        if b_normalize_paths:
-            # Normalize paths to simplify comparisons later
-            for im in self.db['images']:
-                im['file_name'] = os.path.normpath(im['file_name'])
-
-        for s in filename_replacements:
-            r = filename_replacements[s]
-            for im in self.db['images']:
-                im['file_name'] = im['file_name'].replace(s, r)
+        normalize_db_file_names(self.db, b_normalize_paths, filename_replacements)
 
         ### Build useful mappings to facilitate working with the DB
 
@@ -207,3 +209,320 @@ class IndexedJsonDb:
         return class_names
 
 # ...class IndexedJsonDb
+
+
+def _encode_key(key):
+    """
+    Keys are stored as .json strings; numpy scalars (e.g. IDs read from a numpy array) are
+    encoded like the equivalent Python values.
+    """
+
+    def to_python(obj):
+        if hasattr(obj, 'item'):
+            return obj.item()
+        raise TypeError('Object of type {} is not a valid key'.format(type(obj).__name__))
+
+    return json.dumps(key, default=to_python)
+
+
+class _SqliteMapping(Mapping):
+    """
+    Read-only, dict-like view of a key --> value query on a SqliteIndexedJsonDb.
+    """
+
+    def __init__(self, connection, get_query, iter_query, items_query, len_query):
+
+        self.connection = connection
+        self.get_query = get_query
+        self.iter_query = iter_query
+        self.items_query = items_query
+        self.len_query = len_query
+
+    def _decode_value(self, value):
+
+        return json.loads(value)
+
+    def __getitem__(self, key):
+
+        row = self.connection.execute(self.get_query, (_encode_key(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._decode_value(row[0])
+
+    def __contains__(self, key):
+
+        return self.connection.execute(self.get_query, (_encode_key(key),)).fetchone() is not None
+
+    def __iter__(self):
+
+        for row in self.connection.execute(self.iter_query):
+            yield json.loads(row[0])
+
+    def __len__(self):
+
+        return self.connection.execute(self.len_query).fetchone()[0]
+
+    def items(self):
+
+        for key, value in self.connection.execute(self.items_query):
+            yield json.loads(key), self._decode_value(value)
+
+    def values(self):
+
+        for _, value in self.items():
+            yield value
+
+
+class _SqliteAnnotationMapping(_SqliteMapping):
+    """
+    Image ID --> list of annotations; like the defaultdict(list) in IndexedJsonDb, returns []
+    for images without annotations.
+    """
+
+    def __init__(self, connection):
+
+        super().__init__(connection, None, None, None, None)
+
+    def __getitem__(self, image_id):
+
+        rows = self.connection.execute('SELECT json FROM annotations WHERE image_id = ? ORDER BY rowid',
+                                       (_encode_key(image_id),))
+        return [json.loads(row[0]) for row in rows]
+
+    def __contains__(self, image_id):
+
+        return self.connection.execute('SELECT 1 FROM annotations WHERE image_id = ? LIMIT 1',
+                                       (_encode_key(image_id),)).fetchone() is not None
+
+    def __iter__(self):
+
+        for image_id, _ in self.items():
+            yield image_id
+
+    def __len__(self):
+
+        return self.connection.execute('SELECT COUNT(DISTINCT image_id) FROM annotations').fetchone()[0]
+
+    def items(self):
+
+        # Same order as IndexedJsonDb: images in the order of their first annotation
+        image_id = None
+        annotations = []
+        for row_image_id, ann in self.connection.execute(
+                'SELECT image_id, json FROM annotations ORDER BY image_order, rowid'):
+            if row_image_id != image_id:
+                if len(annotations) > 0:
+                    yield json.loads(image_id), annotations
+                image_id = row_image_id
+                annotations = []
+            annotations.append(json.loads(ann))
+        if len(annotations) > 0:
+            yield json.loads(image_id), annotations
+
+
+class SqliteIndexedJsonDb:
+    """
+    Same interface as IndexedJsonDb, backed by an indexed SQLite copy of the database
+    (by default [json_filename].index.sqlite) that is built the first time a database is
+    opened, and rebuilt when the .json file or the normalization options change.
+
+    Categories are loaded when the database is opened; filename_to_id, image_id_to_image
+    and image_id_to_annotations are read-only mappings that query the SQLite file.  Image
+    and annotation dicts are decoded on each lookup, so changes to them are not kept.
+
+    The .json file is only loaded in full if the 'db' attribute is accessed.
+    """
+
+    def __init__(self, json_filename, b_normalize_paths=False, filename_replacements={},
+                 index_filename=None, force_rebuild=False):
+
+        assert isinstance(json_filename, str), 'SqliteIndexedJsonDb needs a .json filename'
+
+        self.json_filename = json_filename
+        self.b_normalize_paths = b_normalize_paths
+        self.filename_replacements = filename_replacements
+        if index_filename is None:
+            index_filename = json_filename + SQLITE_INDEX_SUFFIX
+        self.index_filename = index_filename
+        self._db = None
+
+        metadata = self._index_metadata()
+        if force_rebuild or not self._index_is_current(metadata):
+            self._build_index(metadata)
+
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(index_filename), uri=True,
+                                          check_same_thread=False)
+
+        categories = json.loads(self._read_metadata('categories'))
+        self.cat_id_to_name = {cat['id']: cat['name'] for cat in categories}
+        self.cat_name_to_id = {cat['name']: cat['id'] for cat in categories}
+
+        # As in a dict built from the images list, keys are in order of first appearance, and
+        # the last image with a given key wins
+        self.filename_to_id = _SqliteMapping(
+            self.connection,
+            get_query='SELECT id FROM images WHERE file_name = ? ORDER BY rowid DESC LIMIT 1',
+            iter_query='SELECT file_name FROM images GROUP BY file_name ORDER BY MIN(rowid)',
+            items_query='SELECT i.file_name, i.id FROM images i JOIN '
+                        '(SELECT MIN(rowid) AS first, MAX(rowid) AS last FROM images GROUP BY file_name) g '
+                        'ON i.rowid = g.last ORDER BY g.first',
+            len_query='SELECT COUNT(DISTINCT file_name) FROM images')
+        self.image_id_to_image = _SqliteMapping(
+            self.connection,
+            get_query='SELECT json FROM images WHERE id = ? ORDER BY rowid DESC LIMIT 1',
+            iter_query='SELECT id FROM images GROUP BY id ORDER BY MIN(rowid)',
+            items_query='SELECT i.id, i.json FROM images i JOIN '
+                        '(SELECT MIN(rowid) AS first, MAX(rowid) AS last FROM images GROUP BY id) g '
+                        'ON i.rowid = g.last ORDER BY g.first',
+            len_query='SELECT COUNT(DISTINCT id) FROM images')
+        self.image_id_to_annotations = _SqliteAnnotationMapping(self.connection)
+
+    # ...__init__
+
+    def _index_metadata(self):
+
+        st = os.stat(self.json_filename)
+        return {'version': SQLITE_INDEX_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                'b_normalize_paths': self.b_normalize_paths,
+                'filename_replacements': self.filename_replacements}
+
+    def _read_metadata(self, key):
+
+        return self.connection.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()[0]
+
+    def _index_is_current(self, metadata):
+
+        if not os.path.isfile(self.index_filename):
+            return False
+        try:
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.index_filename), uri=True)
+            try:
+                row = connection.execute("SELECT value FROM metadata WHERE key = 'source'").fetchone()
+            finally:
+                connection.close()
+        except sqlite3.DatabaseError:
+            return False
+        return row is not None and json.loads(row[0]) == metadata
+
+    def _load_json(self):
+
+        with open(self.json_filename) as f:
+            db = json.load(f)
+
+        assert 'images' in db, 'Could not find image list in file {}, are you sure this is a COCO camera traps file?'.format(
+            self.json_filename)
+
+        normalize_db_file_names(db, self.b_normalize_paths, self.filename_replacements)
+        return db
+
+    def _build_index(self, metadata):
+
+        print('Building SQLite index {} for {}'.format(self.index_filename, self.json_filename))
+        db = self._load_json()
+
+        # Same order as IndexedJsonDb.image_id_to_annotations.items(): each image's annotations
+        # are ordered by the position of the image's first annotation
+        image_order = {}
+        for ann in db['annotations']:
+            image_order.setdefault(ann['image_id'], len(image_order))
+
+        # Write to a temporary file first, so a partially-built index is never picked up
+        temp_filename = self.index_filename + '.tmp'
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+        connection = sqlite3.connect(temp_filename)
+        try:
+            connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+            # Keys (image IDs and file names) are stored JSON-encoded, so integer and string
+            # image IDs stay distinct
+            connection.execute('CREATE TABLE images (id TEXT, file_name TEXT, json TEXT)')
+            connection.execute('CREATE TABLE annotations (image_id TEXT, image_order INTEGER, json TEXT)')
+            connection.executemany('INSERT INTO metadata VALUES (?, ?)',
+                                   [('source', json.dumps(metadata)),
+                                    ('categories', json.dumps(db.get('categories', []))),
+                                    ('info', json.dumps(db.get('info', {})))])
+            connection.executemany('INSERT INTO images VALUES (?, ?, ?)',
+                                   ((json.dumps(im['id']), json.dumps(im['file_name']), json.dumps(im))
+                                    for im in db['images']))
+            connection.executemany('INSERT INTO annotations VALUES (?, ?, ?)',
+                                   ((json.dumps(ann['image_id']), image_order[ann['image_id']], json.dumps(ann))
+                                    for ann in db['annotations']))
+            connection.execute('CREATE INDEX images_id ON images (id)')
+            connection.execute('CREATE INDEX images_file_name ON images (file_name)')
+            connection.execute('CREATE INDEX annotations_image_id ON annotations (image_id)')
+            connection.execute('CREATE INDEX annotations_image_order ON annotations (image_order)')
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_filename, self.index_filename)
+
+        print('Indexed {} images and {} annotations'.format(len(db['images']), len(db['annotations'])))
+
+    @property
+    def db(self):
+        """
+        The full database as a dict; loads the .json file the first time it's accessed.
+        """
+
+        if self._db is None:
+            self._db = self._load_json()
+        return self._db
+
+    def get_annotations_for_image(self, image):
+        """
+        Returns a list of annotations associated with [image]
+
+        Returns [] if no annotations are available
+        """
+
+        return self.image_id_to_annotations[image['id']]
+
+    def get_classes_for_image(self, image):
+        """
+        Returns a list of class names associated with [image]
+
+        Returns [] if no annotations are available
+        """
+
+        class_ids = list(set(ann['category_id'] for ann in self.image_id_to_annotations[image['id']]))
+        class_ids.sort()
+        class_names = [self.cat_id_to_name[x] for x in class_ids]
+
+        return class_names
+
+    def close(self):
+
+        self.connection.close()
+
+# ...class SqliteIndexedJsonDb
+
+
+#%% Functions
+
+def normalize_db_file_names(db, b_normalize_paths=False, filename_replacements={}):
+    """
+    Normalizes and/or replaces substrings in the file names of the images in the COCO
+    Camera Traps database [db], in place.
+    """
+
+    if b_normalize_paths:
+        # Normalize paths to simplify comparisons later
+        for im in db['images']:
+            im['file_name'] = os.path.normpath(im['file_name'])
+
+    for s in filename_replacements:
+        r = filename_replacements[s]
+        for im in db['images']:
+            im['file_name'] = im['file_name'].replace(s, r)
+
+
+def open_indexed_json_db(json_filename, b_normalize_paths=False, filename_replacements={},
+                         use_sqlite_index=False):
+    """
+    Returns an IndexedJsonDb, or a SqliteIndexedJsonDb if use_sqlite_index is True and
+    json_filename is a file name (rather than an already-loaded database).
+    """
+
+    if use_sqlite_index and isinstance(json_filename, str):
+        return SqliteIndexedJsonDb(json_filename, b_normalize_paths, filename_replacements)
+    return IndexedJsonDb(json_filename, b_normalize_paths, filename_replacements)
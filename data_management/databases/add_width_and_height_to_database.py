@@ -5,23 +5,27 @@
 #
 # Originally used when we created a .json file for snapshot serengeti from .csv.
 #
+# See data_management/harvest_image_metadata.py, which does the reading (image headers
+# only, in parallel, optionally with a cache), and can also add timestamps and camera
+# fields.
+#
 
 import json
-from PIL import Image
+
+from data_management.harvest_image_metadata import add_metadata_to_database
 
 datafile = '/datadrive/snapshotserengeti/databases/snapshotserengeti.json'
 image_base = '/datadrive/snapshotserengeti/images/'
 
-with open(datafile,'r') as f:
-    data = json.load(f)
-
-
-for im in data['images']:
-    if 'height' not in im:
-        im_w, im_h = Image.open(image_base+im['file_name']).size
-        im['height'] = im_h
-        im['width'] = im_w
-
-
-json.dump(data, open(datafile,'w'))
-
+# Optional SQLite cache of image metadata, e.g. shared with other scripts that read
+# the same images
+cache_file = None
+
+if __name__ == '__main__':
+    
+    with open(datafile,'r') as f:
+        data = json.load(f)
+    
+    data = add_metadata_to_database(data, image_base, fields=['width','height'], cache_file=cache_file)
+    
+    json.dump(data, open(datafile,'w'))
@@ -4,34 +4,86 @@
 # Given a coco-camera-traps .json file, checks all images for TF-friendliness and generates
 # a new .json file that only contains the non-corrupted images.
 #
+# Each image is checked in two steps: a structural check of the JPEG file (SOI marker, a
+# frame header, a scan, and an EOI marker after the scan, which catches truncated files),
+# and, unless header_only is set, a full decode with PIL.  Images are checked in a pool of
+# worker processes.
+#
+# Verdicts can be cached in a SQLite file, keyed by image path, size and modification time,
+# so re-scanning a dataset only checks new or changed images (see image_file_utils.py).
+#
 
 #%% Imports and constants
 
 import argparse
-# import multiprocessing
-import gc
+import io
 import json
 import os
 import time
-from multiprocessing.pool import ThreadPool
+from collections import defaultdict
+from functools import partial
 
 import humanfriendly
-import numpy as np
-import tensorflow as tf
+from PIL import Image
+
+# Assumes the cameratraps repo root is on the path
+from data_management.image_file_utils import N_WORKERS, check_jpeg_structure, process_image_files
 
-N_THREADS = 16 # 1 # multiprocessing.cpu_count()
 DEBUG_MAX_IMAGES = -1
 
-# I leave this at an annoying low number, since by definition weird stuff will
-# be happening in the TF kernel, and it's useful to keep having content in the console.
-IMAGE_PRINT_FREQUENCY = 10
+CHECK_MODE_HEADER = 'header'
+CHECK_MODE_FULL = 'full'
 
 
 #%% Function definitions
 
-def check_images(images, image_file_root):    
+def check_image_file(image_file, mode=CHECK_MODE_FULL):
+    """
+    Checks a single image file; [mode] is CHECK_MODE_HEADER (structure only) or 
+    CHECK_MODE_FULL (structure and full decode).
+    
+    Returns None if the image is valid, otherwise a short description of the problem.
+    """
+    
+    try:
+        with open(image_file, 'rb') as f:
+            image_data = f.read()
+    except OSError as e:
+        return 'could not read file: {}'.format(e)
+    
+    problem = check_jpeg_structure(image_data)
+    if problem is not None or mode == CHECK_MODE_HEADER:
+        return problem
+    
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            image.load()
+    except Exception as e:
+        return 'could not decode: {}'.format(e)
+    
+    return None
+
+
+def _check_image_verdict(image_file, mode):
+    """
+    Checks one image in a worker process; returns the verdict that gets cached for it.
+    """
+    
+    return {'mode': mode, 'problem': check_image_file(image_file, mode)}
+
+
+def _is_cached_verdict_valid(verdict, mode):
+    """
+    A cached verdict is still valid if it came from the same or a more thorough check, or
+    if that check already found a problem.
+    """
+    
+    return verdict['mode'] == mode or verdict['mode'] == CHECK_MODE_FULL or verdict['problem'] is not None
+
+
+def check_images(images, image_file_root, n_workers=N_WORKERS, cache_file=None, mode=CHECK_MODE_FULL):    
     ''' 
-    Checks all the images in [images] for corruption using TF.
+    Checks all the images in [images] for corruption.
     
     [images] is a list of image dictionaries, as they would appear in COCO
     files.
@@ -39,94 +91,55 @@ def check_images(images, image_file_root):
     Returns a dictionary mapping image IDs to booleans. 
     '''    
     
-    # I sometimes pass in a list of images, sometimes a dict with a single
-    # element mapping a job ID to the list of images
-    if isinstance(images,dict):
-        assert(len(images) == 1)
-        jobID = list(images.keys())[0]
-        images = images[jobID]
-    else:
-        jobID = 0
+    if (DEBUG_MAX_IMAGES > 0):
+        print('Checking only the first {} images'.format(DEBUG_MAX_IMAGES))
         
     keep_im = {im['id']:True for im in images}
+    if (DEBUG_MAX_IMAGES > 0):
+        images = images[:DEBUG_MAX_IMAGES]
+    
+    image_files = {im['id']:os.path.abspath(os.path.join(image_file_root,im['file_name'])) for im in images}
+    
+    verdicts, n_from_cache = process_image_files(
+        image_files.values(), partial(_check_image_verdict, mode=mode), n_workers=n_workers,
+        cache_file=cache_file, cache_table='image_verdicts',
+        is_cached_result_valid=partial(_is_cached_verdict_valid, mode=mode),
+        missing_result={'mode': mode, 'problem': 'missing file'})
+    
+    problems = defaultdict(int)
+    for image_id, image_file in image_files.items():
+        problem = verdicts[image_file]['problem']
+        if problem is not None:
+            keep_im[image_id] = False
+            problems[problem.split(':')[0]] += 1
             
-    count = 0
-    nImages = len(images)
-    
-    # We're about to start a lot of TF sessions, and we don't want gobs 
-    # of debugging information printing out for every session.
-    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-    config=tf.ConfigProto(log_device_placement=False)
-    
-    # At some point we were creating a single session and looping over images
-    # within that session, but the only way I found to reliably not run out
-    # of GPU memory was to create a session per image and gc.collect() after
-    # each session.
-    for iImage,im in enumerate(images):
-
-        with tf.Session(config=config) as sess:
-
-            if ((DEBUG_MAX_IMAGES > 0) and (iImage >= DEBUG_MAX_IMAGES)):
-                print('Breaking after {} images'.format(DEBUG_MAX_IMAGES))
-                break
-            
-            if (count % IMAGE_PRINT_FREQUENCY == 0):
-                print('Job {}: processed {} of {} images'.format(jobID,count,nImages))
-                
-            count += 1
-            image_file = os.path.join(image_file_root,im['file_name'])
-            assert(os.path.isfile(image_file))
-            
-            try:
-                image_data = tf.gfile.FastGFile(image_file,'rb').read()
-                image = tf.image.decode_jpeg(image_data)
-                sess.run(image)
-            except:
-                keep_im[im['id']] = False
-
-        gc.collect()
+    print('Checked {} images ({} verdicts from cache)'.format(len(verdicts) - n_from_cache, n_from_cache))
+    for problem, count in sorted(problems.items(), key=lambda x: -x[1]):
+        print('  {}: {}'.format(problem, count))
         
     return keep_im
 
 
-def remove_corrupted_images_from_database(data, image_file_root):
+def remove_corrupted_images_from_database(data, image_file_root, n_workers=N_WORKERS, cache_file=None,
+                                          mode=CHECK_MODE_FULL):
     '''
-    Given the COCO database [data], checks all images for corruption using
-    TF, and returns a subset of [data] containing only non-corrupted images.
+    Given the COCO database [data], checks all images for corruption, and returns a 
+    subset of [data] containing only non-corrupted images.
     '''
     
+    start = time.time()
+    
     # Map Image IDs to boolean (should I keep this image?)
-    images = data['images']
+    keep_im = check_images(data['images'], image_file_root, n_workers, cache_file, mode)
     
-    if (N_THREADS == 1):
-        
-        keep_im = check_images(images,image_file_root)
-        
-    else:
-        
-        start = time.time()
-        imageChunks = np.array_split(images,N_THREADS)
-        # Convert to lists, append job numbers to the image lists
-        for iChunk in range(0,len(imageChunks)):
-            imageChunks[iChunk] = list(imageChunks[iChunk])
-            imageChunks[iChunk] = {iChunk:imageChunks[iChunk]}
-        pool = ThreadPool(N_THREADS)
-        # results = pool.imap_unordered(lambda x: fetch_url(x,nImages), indexedUrlList)
-        results = pool.map(lambda x: check_images(x,image_file_root), imageChunks)
-        processingTime = time.time() - start
-        
-        # Merge results
-        keep_im = {}
-        for d in results:
-            keep_im.update(d)
-        bValid = keep_im.values()
-            
-        print("Checked image corruption in {}, found {} invalid images (of {})".format(
-                humanfriendly.format_timespan(processingTime),
-                len(bValid)-sum(bValid),len(bValid)))
+    processingTime = time.time() - start
+    bValid = keep_im.values()
+    print("Checked image corruption in {}, found {} invalid images (of {})".format(
+            humanfriendly.format_timespan(processingTime),
+            len(bValid)-sum(bValid),len(bValid)))
         
     data['images'] = [im for im in data['images'] if keep_im[im['id']]]
-    data['annotations'] = [ann for ann in data['annotations'] if keep_im[ann['image_id']]]
+    data['annotations'] = [ann for ann in data['annotations'] if keep_im.get(ann['image_id'],False)]
     
     return data
 
@@ -160,7 +173,7 @@ if False:
 
 def parse_args():
     
-    parser = argparse.ArgumentParser(description = 'Remove images from a .json file that can''t be opened in TF')
+    parser = argparse.ArgumentParser(description = 'Remove images from a .json file that can''t be opened')
 
     parser.add_argument('--input_file', dest='input_file',
                          help='Path to .json database that includes corrupted jpegs',
@@ -171,6 +184,15 @@ def parse_args():
     parser.add_argument('--output_file', dest='output_file',
                          help='Path to store uncorrupted .json database',
                          type=str, required=True)
+    parser.add_argument('--n_workers', dest='n_workers',
+                         help='Number of worker processes (default: number of cores)',
+                         type=int, default=N_WORKERS)
+    parser.add_argument('--cache_file', dest='cache_file',
+                         help='SQLite file in which to cache verdicts, so re-scans only check new or changed images',
+                         type=str, default=None)
+    parser.add_argument('--header_only', dest='header_only',
+                         help='Only check the JPEG structure, don''t decode images',
+                         action='store_true')
 
     args = parser.parse_args()
     return args
@@ -183,7 +205,9 @@ def main():
     with open(args.input_file,'r') as f:
         data = json.load(f)
     print('Removing corrupted images from database')
-    uncorrupted_data = remove_corrupted_images_from_database(data, args.image_file_root)
+    mode = CHECK_MODE_HEADER if args.header_only else CHECK_MODE_FULL
+    uncorrupted_data = remove_corrupted_images_from_database(data, args.image_file_root, args.n_workers,
+                                                             args.cache_file, mode)
 
     json.dump(uncorrupted_data, open(args.output_file,'w'))
 
@@ -0,0 +1,231 @@
+#
+# harvest_image_metadata.py
+#
+# Reads width, height, EXIF timestamps and camera make/model for all the images in a
+# COCO Camera Traps .json database in one parallel pass, and adds the missing fields
+# to the database.
+#
+# Only image headers are read: PIL's Image.open() parses the file header (including
+# the EXIF segment of JPEGs) without decoding any pixels.  Files are read in a pool of
+# worker processes.
+#
+# Results can be cached in a SQLite file, keyed by image path, size and modification
+# time, so other scripts (e.g. importers that need timestamps, or a later run with more
+# images) can call harvest_image_metadata() with the same cache file and only read
+# new or changed images.
+#
+# Fields added to each image (if not already present, unless overwrite is set):
+#
+# width, height: image size in pixels, as PIL reports it (i.e., not rotated according
+#   to the EXIF orientation)
+#
+# datetime: EXIF DateTimeOriginal (or DateTimeDigitized, or DateTime), formatted as
+#   'YYYY-MM-DD HH:MM:SS'
+#
+# camera_make, camera_model: EXIF Make and Model
+#
+# Command-line use:
+#
+# python harvest_image_metadata.py input.json output.json --image_base /data/images --cache_file /data/metadata_cache.sqlite
+#
+
+#%% Constants and imports
+
+import argparse
+import json
+import os
+
+from PIL import Image
+
+# Assumes the cameratraps repo root is on the path
+from data_management.image_file_utils import N_WORKERS, process_image_files
+
+# EXIF tags we read
+EXIF_TAG_MAKE = 0x010F
+EXIF_TAG_MODEL = 0x0110
+EXIF_TAG_DATETIME = 0x0132
+EXIF_TAG_DATETIME_ORIGINAL = 0x9003
+EXIF_TAG_DATETIME_DIGITIZED = 0x9004
+EXIF_TAG_EXIF_IFD = 0x8769
+
+DEFAULT_FIELDS = ['width', 'height', 'datetime', 'camera_make', 'camera_model']
+
+
+#%% Reading metadata from a single image
+
+def exif_datetime_to_string(value):
+    """
+    Converts an EXIF date/time ('YYYY:MM:DD HH:MM:SS') to 'YYYY-MM-DD HH:MM:SS'; returns None
+    for values that don't look like EXIF date/times (e.g. blank values written by some cameras).
+    """
+
+    if not isinstance(value, str):
+        return None
+    value = value.strip().strip('\x00')
+    if len(value) < 19 or value[4] != ':' or value[7] != ':' or not value[:4].isdigit():
+        return None
+    return value[:4] + '-' + value[5:7] + '-' + value[8:10] + value[10:19]
+
+
+def _read_exif(image):
+    """
+    Returns a dict mapping EXIF tag IDs to values, with the tags of the EXIF sub-IFD (where
+    the date/time tags live) merged in.
+    """
+
+    if hasattr(image, '_getexif'):
+        exif = image._getexif()
+        return {} if exif is None else exif
+
+    exif = dict(image.getexif())
+    if EXIF_TAG_EXIF_IFD in exif and hasattr(image.getexif(), 'get_ifd'):
+        exif.update(image.getexif().get_ifd(EXIF_TAG_EXIF_IFD))
+    return exif
+
+
+def _exif_string(exif, tag):
+
+    value = exif.get(tag)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    if not isinstance(value, str):
+        return None
+    value = value.strip().strip('\x00').strip()
+    return value if len(value) > 0 else None
+
+
+def read_image_metadata(image_file):
+    """
+    Reads the size, timestamp and camera make/model of an image from its header.
+
+    Returns a dict with 'width' and 'height', and 'datetime', 'camera_make' and 'camera_model'
+    if they're available, or a dict with just 'error' if the image can't be opened.
+    """
+
+    try:
+        with Image.open(image_file) as image:
+            metadata = {'width': image.width, 'height': image.height}
+            try:
+                exif = _read_exif(image)
+            except Exception:
+                # Plenty of cameras write malformed EXIF data; the size is still useful
+                exif = {}
+    except Exception as e:
+        return {'error': str(e)}
+
+    for tag in [EXIF_TAG_DATETIME_ORIGINAL, EXIF_TAG_DATETIME_DIGITIZED, EXIF_TAG_DATETIME]:
+        datetime_string = exif_datetime_to_string(_exif_string(exif, tag))
+        if datetime_string is not None:
+            metadata['datetime'] = datetime_string
+            break
+
+    for tag, field in [(EXIF_TAG_MAKE, 'camera_make'), (EXIF_TAG_MODEL, 'camera_model')]:
+        value = _exif_string(exif, tag)
+        if value is not None:
+            metadata[field] = value
+
+    return metadata
+
+
+#%% Harvesting metadata for many images
+
+def harvest_image_metadata(image_files, n_workers=N_WORKERS, cache_file=None):
+    """
+    Reads the metadata (see read_image_metadata()) of all the images in [image_files], in a
+    pool of worker processes, reusing metadata from [cache_file] for images that haven't
+    changed (see image_file_utils.process_image_files()).
+
+    Returns a dict mapping each (absolute) image path to its metadata.
+    """
+
+    image_file_to_metadata, n_from_cache = process_image_files(
+        image_files, read_image_metadata, n_workers=n_workers, cache_file=cache_file,
+        cache_table='metadata', missing_result={'error': 'missing file'})
+
+    n_errors = sum(1 for metadata in image_file_to_metadata.values() if 'error' in metadata)
+    print('Read metadata for {} images ({} from cache), {} could not be read'.format(
+        len(image_file_to_metadata) - n_from_cache, n_from_cache, n_errors))
+
+    return image_file_to_metadata
+
+
+def add_metadata_to_database(data, image_base, fields=DEFAULT_FIELDS, overwrite=False,
+                             n_workers=N_WORKERS, cache_file=None):
+    """
+    Adds [fields] (a subset of DEFAULT_FIELDS) to the images in the COCO Camera Traps
+    database [data], modifying it in place.  Fields that are already present are left
+    alone unless [overwrite] is True.
+
+    Returns [data].
+    """
+
+    images_to_read = [im for im in data['images'] if overwrite or not all(f in im for f in fields)]
+    print('Reading metadata for {} of {} images'.format(len(images_to_read), len(data['images'])))
+
+    image_files = [os.path.join(image_base, im['file_name']) for im in images_to_read]
+    image_file_to_metadata = harvest_image_metadata(image_files, n_workers, cache_file)
+
+    n_updated = 0
+    for im, image_file in zip(images_to_read, image_files):
+        metadata = image_file_to_metadata[os.path.abspath(image_file)]
+        if 'error' in metadata:
+            print('Could not read metadata for {}: {}'.format(image_file, metadata['error']))
+            continue
+        updated = False
+        for field in fields:
+            if field in metadata and (overwrite or field not in im):
+                im[field] = metadata[field]
+                updated = True
+        n_updated += updated
+
+    print('Updated {} images'.format(n_updated))
+    return data
+
+
+#%% Interactive driver
+
+if False:
+
+    #%%
+
+    input_file = '/datadrive/snapshotserengeti/databases/snapshotserengeti.json'
+    output_file = '/datadrive/snapshotserengeti/databases/snapshotserengeti_metadata.json'
+    image_base = '/datadrive/snapshotserengeti/images/'
+    cache_file = '/datadrive/snapshotserengeti/metadata_cache.sqlite'
+
+    with open(input_file) as f:
+        data = json.load(f)
+    data = add_metadata_to_database(data, image_base, cache_file=cache_file)
+    with open(output_file, 'w') as f:
+        json.dump(data, f, indent=1)
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Add width, height, datetime and camera fields to a COCO Camera Traps .json database, reading only image headers')
+    parser.add_argument('input_file', type=str, help='Input .json database')
+    parser.add_argument('output_file', type=str, help='Output .json database')
+    parser.add_argument('--image_base', type=str, default='', help='Folder that image file names are relative to')
+    parser.add_argument('--fields', type=str, nargs='+', default=DEFAULT_FIELDS,
+                        help='Fields to add, default: ' + ' '.join(DEFAULT_FIELDS))
+    parser.add_argument('--overwrite', action='store_true', help='Replace fields that are already present')
+    parser.add_argument('--n_workers', type=int, default=N_WORKERS, help='Number of worker processes (default: number of cores)')
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='SQLite file in which to cache metadata, so later runs only read new or changed images')
+    args = parser.parse_args()
+
+    for field in args.fields:
+        assert field in DEFAULT_FIELDS, 'Unknown field {}'.format(field)
+
+    with open(args.input_file) as f:
+        data = json.load(f)
+    data = add_metadata_to_database(data, args.image_base, args.fields, args.overwrite, args.n_workers, args.cache_file)
+    with open(args.output_file, 'w') as f:
+        json.dump(data, f, indent=1)
+
+
+if __name__ == '__main__':
+
+    main()
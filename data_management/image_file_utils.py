@@ -0,0 +1,285 @@
+#
+# image_file_utils.py
+#
+# Reads what we need from image file headers without decoding the images: the format and
+# dimensions of JPEG and PNG files, and a structural check of JPEG files that catches
+# truncated files.
+#
+# Also runs a function over many image files in a pool of worker processes, optionally
+# caching its results in a SQLite file keyed by path, size and modification time, so later
+# runs only process new or changed files.
+#
+# Used by remove_corrupted_images_from_database.py, harvest_image_metadata.py and
+# create_tfrecords_py3.py.
+#
+
+#%% Constants and imports
+
+import json
+import os
+import sqlite3
+import struct
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+N_WORKERS = os.cpu_count() or 1
+
+# Number of files sent to a worker process at a time
+CHUNK_SIZE = 64
+
+# Cached results are written to the cache file in batches of this many files
+CACHE_WRITE_FREQUENCY = 10000
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+#%% JPEG marker structure
+
+class JpegMarkerInfo:
+    """
+    What walk_jpeg_markers() found in a JPEG file.
+    """
+
+    # None if the marker structure up to the first scan looks valid, otherwise a short
+    # description of the problem
+    problem = None
+
+    # Image dimensions and number of color components from the first frame header, or None
+    height = None
+    width = None
+    channels = None
+
+    # Offset of the compressed data that follows the first scan header, or None
+    scan_data_start = None
+
+
+def walk_jpeg_markers(image_data):
+    """
+    Walks the marker segments of the JPEG file contents [image_data], up to the first
+    start-of-scan marker.
+
+    Returns a JpegMarkerInfo.
+    """
+
+    info = JpegMarkerInfo()
+
+    if image_data[:2] != b'\xff\xd8':
+        info.problem = 'not a JPEG file'
+        return info
+
+    i = 2
+    while True:
+        if i + 4 > len(image_data):
+            info.problem = 'truncated header'
+            return info
+        if image_data[i] != 0xFF:
+            info.problem = 'invalid marker'
+            return info
+        marker = image_data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a payload
+            i += 2
+            continue
+        if marker == 0xD9:
+            info.problem = 'no image data'
+            return info
+        segment_length = struct.unpack('>H', image_data[i + 2:i + 4])[0]
+        if segment_length < 2:
+            info.problem = 'invalid segment length'
+            return info
+        # SOF0-SOF15, other than DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC) and info.height is None:
+            if i + 10 > len(image_data):
+                info.problem = 'truncated header'
+                return info
+            info.height, info.width = struct.unpack('>HH', image_data[i + 5:i + 9])
+            info.channels = image_data[i + 9]
+        if marker == 0xDA:
+            info.scan_data_start = i + 2 + segment_length
+            break
+        i += 2 + segment_length
+
+    if info.height is None:
+        info.problem = 'no frame header'
+
+    return info
+
+
+def check_jpeg_structure(image_data):
+    """
+    Checks the marker structure of the JPEG file contents [image_data], without decoding
+    the image: SOI marker, a frame header, a scan, and an EOI marker after the scan.
+
+    Returns None if the structure looks valid, otherwise a short description of the problem.
+    """
+
+    info = walk_jpeg_markers(image_data)
+    if info.problem is not None:
+        return info.problem
+
+    # A truncated file won't have an EOI marker after the compressed data.  Some cameras
+    # write data after the EOI marker, so it doesn't need to be at the very end of the file.
+    if image_data.rfind(b'\xff\xd9', info.scan_data_start) < 0:
+        return 'truncated scan (no EOI marker)'
+
+    return None
+
+
+#%% Image headers
+
+def image_header_info(image_data):
+    """
+    Reads the format and dimensions of a JPEG or PNG image from its header, without decoding
+    the image.
+
+    Returns (image_format, height, width, channels):
+        image_format: 'JPEG', 'PNG', or None if the image is neither
+        height, width: image size in pixels, or None if it could not be read
+        channels: number of color components (JPEG only; None for PNG)
+    """
+
+    if image_data[:8] == PNG_SIGNATURE:
+        if len(image_data) < 24 or image_data[12:16] != b'IHDR':
+            return 'PNG', None, None, None
+        width, height = struct.unpack('>II', image_data[16:24])
+        return 'PNG', height, width, None
+
+    if image_data[:2] != b'\xff\xd8':
+        return None, None, None, None
+
+    info = walk_jpeg_markers(image_data)
+    return 'JPEG', info.height, info.width, info.channels
+
+
+#%% Processing many image files
+
+class FileResultCache:
+    """
+    SQLite file mapping absolute file paths to (size, mtime_ns, result), where result is
+    any json-serializable value.  Several caches can share a file, in different tables.
+    """
+
+    def __init__(self, cache_file, table_name):
+
+        self.table_name = table_name
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (path TEXT PRIMARY KEY, size INTEGER, '
+                                'mtime_ns INTEGER, result TEXT)'.format(table_name))
+        self.pending = []
+
+    def get(self, paths):
+        """
+        Returns a dict mapping the paths in [paths] that are in the cache to
+        (size, mtime_ns, result).
+        """
+
+        entries = {}
+        paths = list(paths)
+        # Stay well below SQLite's limit on the number of query parameters
+        for i_start in range(0, len(paths), 500):
+            batch = paths[i_start:i_start+500]
+            query = 'SELECT * FROM {} WHERE path IN ({})'.format(self.table_name, ','.join('?' * len(batch)))
+            for path, size, mtime_ns, result in self.connection.execute(query, batch):
+                entries[path] = (size, mtime_ns, json.loads(result))
+        return entries
+
+    def add(self, path, size, mtime_ns, result):
+
+        self.pending.append((path, size, mtime_ns, json.dumps(result)))
+        if len(self.pending) >= CACHE_WRITE_FREQUENCY:
+            self.flush()
+
+    def flush(self):
+
+        self.connection.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'.format(self.table_name),
+                                    self.pending)
+        self.connection.commit()
+        self.pending = []
+
+    def close(self):
+
+        self.flush()
+        self.connection.close()
+
+
+def _process_file_task(args):
+    """
+    Runs [function] on one file in a worker process, unless [cached] (a cache entry, or None)
+    is still valid for it.
+
+    Returns (path, size, mtime_ns, result, from_cache).
+    """
+
+    path, function, cached, is_cached_result_valid, missing_result = args
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path, None, None, missing_result, False
+
+    if cached is not None:
+        size, mtime_ns, result = cached
+        if size == st.st_size and mtime_ns == st.st_mtime_ns and \
+            (is_cached_result_valid is None or is_cached_result_valid(result)):
+            return path, size, mtime_ns, result, True
+
+    return path, st.st_size, st.st_mtime_ns, function(path), False
+
+
+def process_image_files(image_files, function, n_workers=N_WORKERS, cache_file=None, cache_table='results',
+                        is_cached_result_valid=None, missing_result=None):
+    """
+    Runs function(path) on all the files in [image_files], in a pool of [n_workers] processes;
+    [function] needs to be picklable (e.g. a module-level function or a functools.partial of
+    one) and return a json-serializable value.
+
+    If cache_file is not None, results are cached in table [cache_table] of that SQLite file,
+    and a cached result is reused if the file's size and modification time haven't changed
+    (and is_cached_result_valid(result) is True, if supplied).  Missing files get
+    [missing_result], which is not cached.
+
+    Returns:
+        results: dict mapping each (absolute) path to its result; each file is only processed
+            once, even if it's in the list more than once
+        n_from_cache: number of results that came from the cache
+    """
+
+    image_files = list(dict.fromkeys(os.path.abspath(fn) for fn in image_files))
+
+    cache = None
+    cached_entries = {}
+    if cache_file is not None:
+        cache = FileResultCache(cache_file, cache_table)
+        cached_entries = cache.get(image_files)
+
+    tasks = [(fn, function, cached_entries.get(fn), is_cached_result_valid, missing_result) for fn in image_files]
+
+    if n_workers <= 1:
+        task_results = map(_process_file_task, tasks)
+        pool = None
+    else:
+        pool = Pool(n_workers)
+        task_results = pool.imap_unordered(_process_file_task, tasks, chunksize=CHUNK_SIZE)
+
+    results = {}
+    n_from_cache = 0
+
+    try:
+        for path, size, mtime_ns, result, from_cache in tqdm(task_results, total=len(tasks)):
+            results[path] = result
+            if from_cache:
+                n_from_cache += 1
+            elif cache is not None and size is not None:
+                cache.add(path, size, mtime_ns, result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.close()
+
+    return results, n_from_cache
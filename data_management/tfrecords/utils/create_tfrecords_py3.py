@@ -18,20 +18,37 @@ A lot of this code comes from the tensorflow inception example, so here is their
 # limitations under the License.
 # ==============================================================================
 
+Shards are written in parallel by a pool of worker processes (or threads), one shard per
+task. Image dimensions are read from the JPEG/PNG header rather than by decoding the image,
+and only images that aren't RGB or grayscale JPEGs (PNGs, CMYK JPEGs) are decoded and
+re-encoded, with PIL, so most images go from disk to the tfrecord file untouched.  JPEGs that
+are copied without decoding are checked for truncation by walking their marker structure
+(see data_management/image_file_utils.py); broken files end up in the error list.
+
+Each completed shard gets a small status file in a `.shard_status` folder in the output
+directory, so that a run that was interrupted can be resumed with resume=True (--resume):
+shards whose status matches the examples they would contain are not written again.
 """
 import argparse
 from datetime import datetime
 import hashlib
+import io
 import json
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
-from queue import Queue
 import random
 import sys
-import threading
+import time
 
 import numpy as np
 import tensorflow as tf
 
+# Assumes the cameratraps repo root is on the path
+from data_management.image_file_utils import check_jpeg_structure, image_header_info
+
+SHARD_STATUS_FOLDER = '.shard_status'
+
 def _int64_feature(value):
     """Wrapper for inserting int64 features into Example proto."""
     if not isinstance(value, list):
@@ -229,101 +246,173 @@ def _process_image(filename, coder):
     return image_data, height, width
 
 
-def _process_image_files_batch(coder, thread_index, ranges, name, output_directory,
-                               dataset, num_shards, store_images, error_queue):
-    """Processes and saves list of images as TFRecord in 1 thread.
+def _transcode_to_jpeg(image_data):
+    """Decodes an image with PIL, and re-encodes it as an RGB JPEG.
+    Returns:
+      image_buffer: bytes, JPEG encoding of RGB image.
+      height: integer, image height in pixels.
+      width: integer, image width in pixels.
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_data))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=100)
+    return output.getvalue(), image.height, image.width
+
+
+def _read_image(filename):
+    """Reads an image file, and returns an RGB or grayscale JPEG encoding of it and its
+    dimensions, without decoding it if it already is one.
     Args:
-      coder: instance of ImageCoder to provide TensorFlow image coding utils.
-      thread_index: integer, unique batch to run index is within [0, len(ranges)).
-      ranges: list of pairs of integers specifying ranges of each batches to
-        analyze in parallel.
+      filename: string, path to an image file e.g., '/path/to/example.JPG'.
+    Returns:
+      image_buffer: bytes, JPEG encoding of the image.
+      height: integer, image height in pixels.
+      width: integer, image width in pixels.
+    """
+    with tf.gfile.GFile(filename, 'rb') as f:
+        image_data = f.read()
+
+    image_format, height, width, channels = image_header_info(image_data)
+
+    # JPEGs are copied into the record without decoding, so check that they aren't
+    # truncated or otherwise broken; PNGs and other formats are checked by decoding them.
+    if image_format == 'JPEG':
+        problem = check_jpeg_structure(image_data)
+        if problem is not None:
+            raise ValueError('Invalid JPEG file {}: {}'.format(filename, problem))
+
+    # Grayscale JPEGs decode to RGB with decode_jpeg(channels=3); anything else (PNG,
+    # CMYK JPEGs, other formats) is transcoded.
+    if image_format == 'JPEG' and channels in (1, 3):
+        return image_data, height, width
+
+    return _transcode_to_jpeg(image_data)
+
+
+def _shard_name(name, shard, num_shards):
+    # e.g. 'train-00002-of-00010'
+    return '%s-%.5d-of-%.5d' % (name, shard, num_shards)
+
+
+def _shard_fingerprint(examples, store_images):
+    """Identifies the examples that go into a shard, including their labels, boxes and
+    sizes, to decide whether a shard written by a previous run can be kept when resuming.
+    Encoded image bytes are hashed rather than serialized."""
+    h = hashlib.sha1()
+    h.update(str(store_images).encode())
+    for image_example in examples:
+        image_example = dict(image_example)
+        encoded = image_example.pop('encoded', None)
+        if encoded is not None:
+            image_example['encoded_sha1'] = hashlib.sha1(encoded).hexdigest()
+        h.update(json.dumps(image_example, sort_keys=True, default=str).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _shard_status_path(output_directory, shard_name):
+    return os.path.join(output_directory, SHARD_STATUS_FOLDER, shard_name + '.json')
+
+
+def _read_shard_status(output_directory, shard_name, fingerprint):
+    """Returns the status of a previously completed shard, or None if the shard has to be
+    (re-)written."""
+    status_path = _shard_status_path(output_directory, shard_name)
+    if not os.path.isfile(status_path) or \
+            not os.path.isfile(os.path.join(output_directory, shard_name)):
+        return None
+    try:
+        with open(status_path) as f:
+            status = json.load(f)
+    except ValueError:
+        return None
+    if status.get('fingerprint') != fingerprint:
+        return None
+    return status
+
+
+def _make_example(image_example, store_images):
+    """Builds the Example proto for one image example, reading the image if needed."""
+    if store_images:
+        if 'encoded' in image_example:
+            image_buffer = image_example['encoded']
+            height = image_example['height']
+            width = image_example['width']
+            colorspace = image_example['colorspace']
+            image_format = image_example['format']
+            num_channels = image_example['channels']
+            return _convert_to_example(image_example, image_buffer, height,
+                                       width, colorspace, num_channels,
+                                       image_format)
+        else:
+            image_buffer, height, width = _read_image(str(image_example['filename']))
+            return _convert_to_example(image_example, image_buffer, height, width)
+    else:
+        image_buffer = b''
+        height = int(image_example['height'])
+        width = int(image_example['width'])
+        return _convert_to_example(image_example, image_buffer, height, width)
+
+
+def _write_shard(args):
+    """Writes one shard; runs in a worker process or thread.
+    Args (packed in a tuple, for Pool.imap_unordered):
+      shard: integer, index of the shard
+      examples: list of the image example dicts in this shard
       name: string, unique identifier specifying the data set (e.g. `train` or `test`)
       output_directory: string, file path to store the tfrecord files.
-      dataset: list, a list of image example dicts
       num_shards: integer number of shards for this data set.
       store_images: bool, should the image be stored in the tfrecord
-      error_queue: Queue, a queue to place image examples that failed.
+      fingerprint: string, see _shard_fingerprint()
+    Returns:
+      dict with the shard's name, the number of images written, the image examples that
+      failed (with an 'error_msg' field), and the elapsed time in seconds
     """
-    # Each thread produces N shards where N = int(num_shards / num_threads).
-    # For instance, if num_shards = 128, and the num_threads = 2, then the first
-    # thread would produce shards [0, 64).
-    num_threads = len(ranges)
-    assert not num_shards % num_threads
-    num_shards_per_batch = int(num_shards / num_threads)
-
-    shard_ranges = np.linspace(ranges[thread_index][0],
-                               ranges[thread_index][1],
-                               num_shards_per_batch + 1).astype(int)
-    num_files_in_thread = ranges[thread_index][1] - ranges[thread_index][0]
-
-    counter = 0
-    error_counter = 0
-    for s in range(num_shards_per_batch):
-        # Generate a sharded version of the file name, e.g. 'train-00002-of-00010'
-        shard = thread_index * num_shards_per_batch + s
-        output_filename = '%s-%.5d-of-%.5d' % (name, shard, num_shards)
-        output_file = os.path.join(output_directory, output_filename)
-        writer = tf.python_io.TFRecordWriter(output_file)
-
-        shard_counter = 0
-        files_in_shard = np.arange(shard_ranges[s], shard_ranges[s + 1], dtype=int)
-        for i in files_in_shard:
-
-            image_example = dataset[i]
-
-            filename = str(image_example['filename'])
+    shard, examples, name, output_directory, num_shards, store_images, fingerprint = args
 
-            try:
-                if store_images:
-                    if 'encoded' in image_example:
-                        image_buffer = image_example['encoded']
-                        height = image_example['height']
-                        width = image_example['width']
-                        colorspace = image_example['colorspace']
-                        image_format = image_example['format']
-                        num_channels = image_example['channels']
-                        example = _convert_to_example(image_example, image_buffer, height,
-                                                    width, colorspace, num_channels,
-                                                    image_format)
-
-                    else:
-                        image_buffer, height, width = _process_image(filename, coder)
-                        example = _convert_to_example(image_example, image_buffer, height,
-                                                    width)
-                else:
-                    image_buffer=''
-                    height = int(image_example['height'])
-                    width = int(image_example['width'])
-                    example = _convert_to_example(image_example, image_buffer, height,
-                                                    width)
+    shard_name = _shard_name(name, shard, num_shards)
+    output_file = os.path.join(output_directory, shard_name)
 
+    # Write to a temporary file first, so an interrupted shard is never mistaken for a
+    # complete one
+    temp_file = output_file + '.tmp'
+    start_time = time.time()
+    n_written = 0
+    errors = []
+
+    writer = tf.python_io.TFRecordWriter(temp_file)
+    try:
+        for image_example in examples:
+            try:
+                example = _make_example(image_example, store_images)
                 writer.write(example.SerializeToString())
-                shard_counter += 1
-                counter += 1
+                n_written += 1
             except Exception as e:
-                #raise
-                print('Exception in making example for {}.'.format(i))
-                error_counter += 1
-                error_msg = repr(e)
-                image_example['error_msg'] = error_msg
-                error_queue.put(image_example)
-
-            if not counter % 1000:
-                print('%s [thread %d]: Processed %d of %d images in thread batch, with %d errors.' %
-                      (datetime.now(), thread_index, counter, num_files_in_thread, error_counter))
-                sys.stdout.flush()
-
-        print('%s [thread %d]: Wrote %d images to %s, with %d errors.' %
-              (datetime.now(), thread_index, shard_counter, output_file, error_counter))
-        sys.stdout.flush()
-        shard_counter = 0
-
-    print('%s [thread %d]: Wrote %d images to %d shards, with %d errors.' %
-          (datetime.now(), thread_index, counter, num_files_in_thread, error_counter))
-    sys.stdout.flush()
-
-
-def create(dataset, dataset_name, output_directory, num_shards, num_threads, shuffle=True, store_images=True):
+                print('Exception in making example for {}: {}'.format(image_example['filename'], e))
+                image_example = dict(image_example)
+                image_example['error_msg'] = repr(e)
+                image_example.pop('encoded', None)
+                errors.append(image_example)
+    finally:
+        writer.close()
+    os.replace(temp_file, output_file)
+
+    status = {'shard': shard_name, 'fingerprint': fingerprint, 'n_images': n_written,
+              'errors': errors, 'seconds': time.time() - start_time}
+    status_path = _shard_status_path(output_directory, shard_name)
+    with open(status_path + '.tmp', 'w') as f:
+        json.dump(status, f, indent=1, default=str)
+    os.replace(status_path + '.tmp', status_path)
+
+    return status
+
+
+def create(dataset, dataset_name, output_directory, num_shards, num_threads, shuffle=True, store_images=True,
+           use_processes=True, resume=False, shuffle_seed=None):
     """Create the tfrecord files to be used to train or test a model.
 
     Args:
@@ -351,55 +440,82 @@ def create(dataset, dataset_name, output_directory, num_shards, num_threads, shu
 
       num_shards: the number of tfrecord files to create
 
-      num_threads: the number of threads to use
+      num_threads: the number of worker processes (or threads) to use
 
       shuffle : bool, should the image examples be shuffled or not prior to creating the tfrecords.
 
+      store_images: bool, should the images be stored in the tfrecords
+
+      use_processes: bool, write shards in worker processes rather than threads; on platforms
+        that spawn rather than fork processes (Windows, macOS), the calling script needs an
+        `if __name__ == '__main__':` guard
+
+      resume: bool, keep shards that a previous run with the same examples (and, if shuffling,
+        the same shuffle_seed) completed
+
+      shuffle_seed: optional, seed for shuffling, so that shards are reproducible
+
     Returns:
       list : a list of image examples that failed to process.
     """
 
     # Images in the tfrecords set must be shuffled properly
     if shuffle:
-        random.shuffle(dataset)
-
-    # Break all images into batches with a [ranges[i][0], ranges[i][1]].
-    spacing = np.linspace(0, len(dataset), num_threads + 1).astype(np.int)
-    ranges = []
-    threads = []
-    for i in range(len(spacing) - 1):
-        ranges.append([spacing[i], spacing[i+1]])
+        if shuffle_seed is None:
+            if resume:
+                print('Warning: resuming without a shuffle_seed; shards from the previous run '
+                      'will only be kept if they contain the same examples')
+            random.shuffle(dataset)
+        else:
+            random.Random(shuffle_seed).shuffle(dataset)
 
-    # Launch a thread for each batch.
-    print('Launching %d threads for spacings: %s' % (num_threads, ranges))
-    sys.stdout.flush()
+    os.makedirs(os.path.join(output_directory, SHARD_STATUS_FOLDER), exist_ok=True)
 
-    # Create a mechanism for monitoring when all threads are finished.
-    coord = tf.train.Coordinator()
+    # Break all images into shards with [spacing[i], spacing[i+1]].
+    spacing = np.linspace(0, len(dataset), num_shards + 1).astype(int)
 
-    # Create a generic TensorFlow-based utility for converting all image codings.
-    coder = ImageCoder()
-
-    # A Queue to hold the image examples that fail to process.
-    error_queue = Queue()
+    tasks = []
+    errors = []
+    n_kept = 0
+    for shard in range(num_shards):
+        examples = dataset[spacing[shard]:spacing[shard + 1]]
+        fingerprint = _shard_fingerprint(examples, store_images)
+        shard_name = _shard_name(dataset_name, shard, num_shards)
+        if resume:
+            status = _read_shard_status(output_directory, shard_name, fingerprint)
+            if status is not None:
+                errors.extend(status['errors'])
+                n_kept += 1
+                continue
+        tasks.append((shard, examples, dataset_name, output_directory, num_shards, store_images,
+                      fingerprint))
+
+    print('%s: Writing %d of %d shards (%d already complete) with %d %s' %
+          (datetime.now(), len(tasks), num_shards, n_kept, num_threads,
+           'processes' if use_processes else 'threads'))
+    sys.stdout.flush()
 
-    threads = []
-    for thread_index in range(len(ranges)):
-        args = (coder, thread_index, ranges, dataset_name, output_directory, dataset,
-                num_shards, store_images, error_queue)
-        t = threading.Thread(target=_process_image_files_batch, args=args)
-        t.start()
-        threads.append(t)
+    start_time = time.time()
+    n_images = 0
+    if len(tasks) > 0:
+        pool = Pool(num_threads) if use_processes else ThreadPool(num_threads)
+        try:
+            for i_task, status in enumerate(pool.imap_unordered(_write_shard, tasks)):
+                n_images += status['n_images']
+                errors.extend(status['errors'])
+                elapsed = time.time() - start_time
+                print('%s: Wrote %d images to %s in %.1f s (%.1f images/s), with %d errors; '
+                      '%d of %d shards done, %.1f images/s overall.' %
+                      (datetime.now(), status['n_images'], status['shard'], status['seconds'],
+                       status['n_images'] / max(status['seconds'], 1e-6), len(status['errors']),
+                       i_task + 1, len(tasks), n_images / max(elapsed, 1e-6)))
+                sys.stdout.flush()
+        finally:
+            pool.close()
+            pool.join()
 
-    # Wait for all the threads to terminate.
-    coord.join(threads)
     print('%s: Finished writing all %d images in data set.' %
           (datetime.now(), len(dataset)))
-
-    # Collect the errors
-    errors = []
-    while not error_queue.empty():
-        errors.append(error_queue.get())
     print ('%d examples failed.' % (len(errors),))
 
     return errors
@@ -437,6 +553,18 @@ def parse_args():
                         help='Store the images in the tfrecords.',
                         required=False, action='store_true', default=False)
 
+    parser.add_argument('--use_threads', dest='use_threads',
+                        help='Write shards in threads rather than processes.',
+                        required=False, action='store_true', default=False)
+
+    parser.add_argument('--resume', dest='resume',
+                        help='Keep shards completed by a previous run with the same arguments.',
+                        required=False, action='store_true', default=False)
+
+    parser.add_argument('--shuffle_seed', dest='shuffle_seed',
+                        help='Seed for shuffling the records (needed to resume a shuffled run).',
+                        type=int, required=False, default=None)
+
     parsed_args = parser.parse_args()
 
     return parsed_args
@@ -455,7 +583,10 @@ def main():
         num_shards=args.num_shards,
         num_threads=args.num_threads,
         shuffle=args.shuffle,
-        store_images=args.store_images
+        store_images=args.store_images,
+        use_processes=not args.use_threads,
+        resume=args.resume,
+        shuffle_seed=args.shuffle_seed
     )
 
     return errors
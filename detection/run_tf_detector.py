@@ -176,18 +176,20 @@ def generate_detections(detection_graph,images):
         
         with tf.Session(graph=detection_graph) as sess:
             
+            # Look up tensors once, rather than once per image
+            image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
+            box_tensor = detection_graph.get_tensor_by_name('detection_boxes:0')
+            score_tensor = detection_graph.get_tensor_by_name('detection_scores:0')
+            clss_tensor = detection_graph.get_tensor_by_name('detection_classes:0')
+            num_detections_tensor = detection_graph.get_tensor_by_name('num_detections:0')
+                
             for iImage,imageNP in tqdm(enumerate(images)): 
                 
                 imageNP_expanded = np.expand_dims(imageNP, axis=0)
-                image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-                box = detection_graph.get_tensor_by_name('detection_boxes:0')
-                score = detection_graph.get_tensor_by_name('detection_scores:0')
-                clss = detection_graph.get_tensor_by_name('detection_classes:0')
-                num_detections = detection_graph.get_tensor_by_name('num_detections:0')
                 
                 # Actual detection
                 (box, score, clss, num_detections) = sess.run(
-                        [box, score, clss, num_detections],
+                        [box_tensor, score_tensor, clss_tensor, num_detections_tensor],
                         feed_dict={image_tensor: imageNP_expanded})
 
                 boxes.append(box)
@@ -10,11 +10,31 @@
 # This enables the results to be used in our post-processing pipeline; see
 # postprocess_batch_results.py .
 #
-# This script has *somewhat* tested functionality to save results to checkpoints
-# intermittently, in case disaster strikes.  To enable this, set options.checkpointFrequency
-# to something > 0.  Checkpoints will be written to a temporary directory (not currently
-# ever cleaned up, but also not large), and if you want to resume from one, use 
-# options.resumeFromCheckpoint.
+# This script can log results to a checkpoint file as it goes, in case disaster strikes.
+# To enable this, set options.checkpointFrequency to something > 0.  The checkpoint is an
+# append-only JSON-lines file with one thresholded result per image, fsync'd every
+# options.checkpointFrequency images; it's written to options.checkpointPath, or to a 
+# temporary directory (not currently ever cleaned up) if that's None.  To resume, point
+# options.resumeFromCheckpoint at the checkpoint file; images that already appear in the 
+# checkpoint are skipped (by path, so the image list doesn't need to be enumerated in the
+# same order), and new results are appended to the same file.
+#
+# For large jobs, set options.nLoaderWorkers > 0 to run in "pipelined" mode, where a
+# pool of loader threads decodes and resizes images into a bounded queue, batches of
+# options.batchSize images are stacked into a single sess.run call, and a writer stage
+# collects results, so decoding overlaps with inference.
+#
+# The model is loaded once into a DetectionEngine (see detection_engine.py), which keeps
+# a warm session and cached tensor handles for the lifetime of the detector object; set
+# options.intraOpThreads/options.interOpThreads to limit TF's thread pools on CPU nodes.
+#
+# When writing .json output, results are streamed to the output file one image at a time
+# (see api_output_writer.py), so memory use doesn't grow with the number of images.  Set 
+# options.outputJsonLines to also write a JSON-lines sidecar.
+#
+# Images are resized to fit in a MAX_DIM x MIN_DIM canvas without changing their aspect
+# ratio (see image_preprocessing.py); set options.preserveAspectRatio to False to stretch
+# them to exactly MAX_DIM x MIN_DIM instead, as older versions of this script did.
 #
 # See the "command-line driver" cell for example invocation.
 #
@@ -28,22 +48,24 @@ import sys
 import argparse
 import os
 import json
-import pickle
 import inspect
 import tempfile
+import threading
+import queue
 import warnings
 from itertools import compress
 
 import tensorflow as tf
 import numpy as np
 import humanfriendly
-import PIL
 import pandas as pd
 from tqdm import tqdm
 
-from api.batch_processing.postprocessing import convert_output_format
 from api.batch_processing.postprocessing.load_api_results import write_api_results_csv
-from api.batch_processing.api_core.orchestrator_api.aml_scripts.tf_detector import TFDetector
+from api.batch_processing.postprocessing.api_output_writer import ApiOutputWriter, default_jsonl_path
+from data_management.annotations import annotation_constants
+from api.batch_processing.api_core.orchestrator_api.aml_scripts.tf_detector import TFDetector, detections_to_api_entries
+from api.batch_processing.api_core.orchestrator_api.aml_scripts import image_preprocessing
 
 DEFAULT_CONFIDENCE_THRESHOLD = 0.0
 
@@ -58,12 +80,19 @@ COORD_DIGITS = 4
 tf.logging.set_verbosity(tf.logging.ERROR)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-# Write results to a temporary file every N images, in case something crashes;
-# set to <= 0 to disable this feature.
+# Log results to a checkpoint file as we go, and flush that file to disk every N images,
+# in case something crashes; set to <= 0 to disable this feature.
 DEFAULT_CHECKPOINT_N_IMAGES = -1
 
 CHECKPOINT_SUBDIR = 'detector_batch'
 
+# Pipelined mode: number of loader threads (0 disables pipelining), number of images
+# stacked into each sess.run call, and the number of decoded images we'll hold in memory
+# waiting for inference (if <= 0, defaults to a few batches' worth).
+DEFAULT_N_LOADER_WORKERS = 0
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_QUEUE_SIZE = -1
+
 # ignoring all "PIL cannot read EXIF metainfo for the images" warnings
 warnings.filterwarnings('ignore', '(Possibly )?corrupt EXIF data', UserWarning)
 
@@ -85,6 +114,9 @@ class BatchDetectionOptions:
     recursive = False
     forceCpu = False
     checkpointFrequency = DEFAULT_CHECKPOINT_N_IMAGES
+    
+    # If None, checkpoints go to a new file in a temporary directory
+    checkpointPath = None
     resumeFromCheckpoint = None
     
     # Only meaningful if "imageFile" is a directory
@@ -93,10 +125,27 @@ class BatchDetectionOptions:
     # List of query/replacement pairs to apply to output filenames
     outputPathReplacements = {}
     
+    # Pipelined mode options; see DEFAULT_N_LOADER_WORKERS
+    nLoaderWorkers = DEFAULT_N_LOADER_WORKERS
+    batchSize = DEFAULT_BATCH_SIZE
+    queueSize = DEFAULT_QUEUE_SIZE
+    
+    # Also write a .jsonl file with one line per image, only meaningful for .json output
+    outputJsonLines = False
+    
+    # Letterbox images rather than stretching them to MAX_DIM x MIN_DIM
+    preserveAspectRatio = True
+    
+    # TF session thread pool sizes, 0 lets TF choose
+    intraOpThreads = 0
+    interOpThreads = 0
+    
 
-class CheckPointState:
+class DetectionState:
+    """
+    Per-image results accumulated by generate_detections when no result callback is supplied.
+    """
     
-    iImage = 0
     boxes = []
     scores = []
     classes = []
@@ -108,17 +157,463 @@ class CheckPointState:
         self.classes = [None] * nImages
         self.scores = [None] * nImages
         self.boxes = [None] * nImages
+
+
+class CheckpointLog:
+    """
+    Append-only checkpoint file, with one line per image containing that image's entry
+    in the 'images' array of our API output format, where 'file' is the path of the image
+    as it was passed to the detector.  Each line is flushed as it's written, and the file 
+    is fsync'd every [fsyncFrequency] images.
+    
+    Checkpointing cost is proportional to the number of new images, not to the number of 
+    images processed so far.
+    """
+    
+    def __init__(self,path,fsyncFrequency):
+        
+        self.path = path
+        self.fsyncFrequency = max(1,fsyncFrequency)
+        self.nSinceSync = 0
+        
+        if os.path.isfile(path):
+            CheckpointLog.truncate_partial_line(path)
+        self.f = open(path,'a')
+        
+    @staticmethod
+    def truncate_partial_line(path):
+        """
+        If we crashed in the middle of writing a line, drop that line, so we can append to
+        the file again.
+        """
+        
+        with open(path,'rb+') as f:
+            f.seek(0,os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size-1)
+            if f.read(1) == b'\n':
+                return
+            
+            # Walk backwards to the last complete line
+            pos = size
+            blockSize = 4096
+            while pos > 0:
+                readStart = max(0,pos-blockSize)
+                f.seek(readStart)
+                block = f.read(pos-readStart)
+                iNewline = block.rfind(b'\n')
+                if iNewline >= 0:
+                    pos = readStart + iNewline + 1
+                    break
+                pos = readStart
+            print('Warning: truncating partial line at the end of checkpoint {}'.format(path))
+            f.truncate(pos)
+            
+    @staticmethod
+    def load(path):
+        """
+        Read a checkpoint file, returning a dict mapping image paths to API output entries.
+        Skips a partially-written last line, if present.
+        """
+        
+        entries = {}
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print('Warning: skipping unreadable line in checkpoint {}'.format(path))
+                    continue
+                entries[entry['file']] = entry
+        return entries
+    
+    def append(self,entry):
+        
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+        self.nSinceSync += 1
+        if self.nSinceSync >= self.fsyncFrequency:
+            os.fsync(self.f.fileno())
+            self.nSinceSync = 0
+            
+    def close(self):
+        
+        if self.f is None:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
         
         
 #%% Core detection functions
 
-def generate_detections(detector,images,options):
+class PipelineStageStats:
+    """
+    Throughput accounting for one stage of the pipelined detector.  [busyTime] is summed
+    over all threads working on this stage.
+    """
+    
+    def __init__(self,name):
+        
+        self.name = name
+        self.nImages = 0
+        self.busyTime = 0.0
+        self.lock = threading.Lock()
+        
+    def add(self,nImages,elapsed):
+        
+        with self.lock:
+            self.nImages += nImages
+            self.busyTime += elapsed
+            
+    def __str__(self):
+        
+        if self.busyTime > 0:
+            rate = self.nImages / self.busyTime
+        else:
+            rate = 0.0
+        return '{}: {} images, {:.2f} images/sec/thread'.format(self.name,self.nImages,rate)
+    
+    
+def load_image_for_detector(image,options):
+    """
+    imageNP,imageExtent = load_image_for_detector(image,options)
+    
+    Load an image file as a uint8 nparray of size MIN_DIM x MAX_DIM x 3, ready to be 
+    stacked into a detector batch.  JPEGs are decoded at reduced resolution when possible.
+    
+    If options.preserveAspectRatio is set, the image is letterboxed, and [imageExtent] is the
+    fraction of the width and height it occupies (pass this to 
+    image_preprocessing.unletterbox_boxes); otherwise [imageExtent] is None.
+    """
+    
+    canvasSize = (MAX_DIM, MIN_DIM)
+    
+    if options.preserveAspectRatio:
+        pilImage = image_preprocessing.open_image(image,canvasSize)
+        return image_preprocessing.letterbox_image(pilImage,canvasSize)
+    
+    # Load the image as an nparray of size h,w,nChannels.  The image is stretched to the
+    # canvas, so decode JPEGs at the smallest DCT-scaled size that covers the canvas in both
+    # dimensions (not the aspect-preserving fit, which would be upsampled in one dimension).
+    height, width = MIN_DIM, MAX_DIM
+    pilImage = image_preprocessing.open_image(image)
+    pilImage.draft('RGB',(width, height))
+    imageNP = pilImage.convert("RGB").resize((width, height))
+
+    imageNP = np.asarray(imageNP, np.uint8)
+    # image = mpimg.imread(image)
+    
+    nChannels = imageNP.shape[2]
+    
+    # This shouldn't be necessary when loading with PIL and converting to RGB, 
+    # since by definition this leaves us with three channels.  But keeping it 
+    # here for future-proofing.
+    if nChannels > 3:
+        print('Warning: trimming channels from image')
+        imageNP = imageNP[:,:,0:3]
+        
+    return imageNP,None
+
+
+def map_boxes_to_image(box,imageExtent):
+    """
+    Map boxes from the (possibly letterboxed) detector input back to the original image.
+    """
+    
+    if imageExtent is None:
+        return box
+    return image_preprocessing.unletterbox_boxes(box,imageExtent)
+
+
+def store_results(state,indices,box,score,clss,resultCallback):
+    """
+    Hand the results for a batch of images (arrays with a leading axis of size len(indices))
+    to [resultCallback] if supplied, otherwise keep them in [state], one image at a time.
+    """
+    
+    if resultCallback is not None:
+        resultCallback(indices,box,score,clss)
+    else:
+        for iBatchImage,iImage in enumerate(indices):
+            # Keep a leading singleton axis for each image
+            state.boxes[iImage] = box[iBatchImage:iBatchImage+1]
+            state.scores[iImage] = score[iBatchImage:iBatchImage+1]
+            state.classes[iImage] = clss[iBatchImage:iBatchImage+1]
+        
+        
+def run_detector_serial(engine,images,state,options,resultCallback=None):
+    """
+    Run the detector one image at a time, storing results in [state].  Returns the
+    time at which the first image completed, or None.
+    """
+    
+    firstImageCompleteTime = None
+    
+    for iImage,image in tqdm(enumerate(images)): 
+        
+        assert isinstance(image,str)
+        
+        if not os.path.isfile(image):
+            print('Warning: can''t find file {}, skipping'.format(image))
+            state.bValidImage[iImage] = False
+            continue
+        
+        try:
+            
+            imageNP,imageExtent = load_image_for_detector(image,options)
+            imageNP_expanded = np.expand_dims(imageNP, axis=0)
+            
+            # Run inference on this image
+            (box, score, clss) = engine.run(imageNP_expanded)
+            box = map_boxes_to_image(box,imageExtent)
+
+            store_results(state,[iImage],box,score,clss,resultCallback)
+            
+        except (KeyboardInterrupt, SystemExit):
+            raise
+            
+        except Exception as e:
+            print('Error processing image {}: {}'.format(image,str(e)))
+            state.bValidImage[iImage] = False
+            continue
+        
+        if firstImageCompleteTime is None:
+            firstImageCompleteTime = time.time()
+                                    
+    # ...for each image
+    
+    return firstImageCompleteTime
+
+
+def run_detector_pipelined(engine,images,state,options,resultCallback=None):
+    """
+    Run the detector as a three-stage pipeline:
+        
+    * options.nLoaderWorkers threads decode/resize images into a bounded queue
+    * the calling thread stacks up to options.batchSize decoded images into each sess.run call
+    * a writer thread stores results in [state] or hands them to [resultCallback]
+    
+    Results are stored by image index, so the order in which images complete doesn't 
+    matter.  Returns the time at which the first image completed, or None.
+    """
+    
+    batchSize = max(1,options.batchSize)
+    nLoaderWorkers = max(1,options.nLoaderWorkers)
+    queueSize = options.queueSize
+    if queueSize <= 0:
+        queueSize = 4 * batchSize
+    
+    loadStats = PipelineStageStats('load')
+    inferenceStats = PipelineStageStats('inference')
+    writeStats = PipelineStageStats('write')
+    
+    indexQueue = queue.Queue()
+    for iImage in range(0,len(images)):
+        indexQueue.put(iImage)
+    for iWorker in range(0,nLoaderWorkers):
+        indexQueue.put(None)
+        
+    # Items are (iImage, imageNP, imageExtent), with imageNP = None for images we couldn't load; 
+    # None marks the end of one loader's work.
+    loadedQueue = queue.Queue(maxsize=queueSize)
+    
+    # Items are (indices, boxes, scores, classes); None marks the end of the job.
+    resultQueue = queue.Queue(maxsize=4)
+    
+    # Set by the inference stage if it dies, so loaders don't block forever on a full queue, 
+    # and by the writer if it fails, so we stop running batches
+    abortEvent = threading.Event()
+    
+    # The exception that stopped the writer, re-raised on the calling thread
+    writerError = [None]
+    
+    def loader():
+        
+        while True:
+            
+            iImage = indexQueue.get()
+            if iImage is None or abortEvent.is_set():
+                loadedQueue.put(None)
+                return
+            
+            image = images[iImage]
+            assert isinstance(image,str)
+            imageNP = None
+            imageExtent = None
+            t = time.time()
+            
+            if not os.path.isfile(image):
+                print('Warning: can''t find file {}, skipping'.format(image))
+            else:
+                try:
+                    imageNP,imageExtent = load_image_for_detector(image,options)
+                except Exception as e:
+                    print('Error loading image {}: {}'.format(image,str(e)))
+                    
+            loadStats.add(1,time.time() - t)
+            loadedQueue.put((iImage,imageNP,imageExtent))
+            
+    # ...def loader()
+    
+    firstImageCompleteTime = [None]
+    
+    def writer():
+        
+        while True:
+            
+            item = resultQueue.get()
+            if item is None:
+                return
+            
+            # After a failure, keep draining the queue so the inference stage never blocks on it
+            if writerError[0] is not None:
+                continue
+            
+            t = time.time()
+            indices,box,score,clss = item
+            
+            try:
+                store_results(state,indices,box,score,clss,resultCallback)
+            except BaseException as e:
+                print('Error writing results: {}'.format(str(e)))
+                writerError[0] = e
+                abortEvent.set()
+                continue
+            
+            if firstImageCompleteTime[0] is None:
+                firstImageCompleteTime[0] = time.time()
+            
+            writeStats.add(len(indices),time.time() - t)
+            
+    # ...def writer()
+    
+    def run_batch(batchIndices,batchImages,batchExtents):
+        
+        if writerError[0] is not None:
+            raise writerError[0]
+        
+        t = time.time()
+        try:
+            (box, score, clss) = engine.run(np.stack(batchImages,axis=0))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            print('Error processing batch starting with image {}: {}'.format(
+                images[batchIndices[0]],str(e)))
+            for iImage in batchIndices:
+                state.bValidImage[iImage] = False
+            return
+        for iBatchImage,imageExtent in enumerate(batchExtents):
+            if imageExtent is not None:
+                box[iBatchImage] = map_boxes_to_image(box[iBatchImage],imageExtent)
+        inferenceStats.add(len(batchIndices),time.time() - t)
+        if writerError[0] is not None:
+            raise writerError[0]
+        resultQueue.put((batchIndices,box,score,clss))
+        
+    loaderThreads = [threading.Thread(target=loader,daemon=True) for i in range(0,nLoaderWorkers)]
+    writerThread = threading.Thread(target=writer,daemon=True)
+    for thread in loaderThreads:
+        thread.start()
+    writerThread.start()
+    
+    startTime = time.time()
+    nLoadersRunning = nLoaderWorkers
+    batchIndices = []
+    batchImages = []
+    batchExtents = []
+    
+    try:
+        
+        with tqdm(total=len(images)) as pbar:
+            
+            while nLoadersRunning > 0:
+                
+                item = loadedQueue.get()
+                if item is None:
+                    nLoadersRunning -= 1
+                    continue
+                
+                iImage,imageNP,imageExtent = item
+                pbar.update(1)
+                if imageNP is None:
+                    state.bValidImage[iImage] = False
+                    continue
+                
+                batchIndices.append(iImage)
+                batchImages.append(imageNP)
+                batchExtents.append(imageExtent)
+                
+                if len(batchIndices) == batchSize:
+                    run_batch(batchIndices,batchImages,batchExtents)
+                    batchIndices = []
+                    batchImages = []
+                    batchExtents = []
+                    
+            # ...while we're still getting images
+            
+            if len(batchIndices) > 0:
+                run_batch(batchIndices,batchImages,batchExtents)
+                
+    except BaseException:
+        
+        # Unblock and drain the loaders before re-raising
+        abortEvent.set()
+        while nLoadersRunning > 0:
+            if loadedQueue.get() is None:
+                nLoadersRunning -= 1
+        raise
+        
+    finally:
+        
+        resultQueue.put(None)
+        writerThread.join()
+        
+    # The writer may have failed on the last batches
+    if writerError[0] is not None:
+        raise writerError[0]
+        
+    elapsed = time.time() - startTime
+    for stats in [loadStats,inferenceStats,writeStats]:
+        print(stats)
+    if elapsed > 0:
+        print('Overall: {:.2f} images/sec'.format(writeStats.nImages / elapsed))
+    
+    return firstImageCompleteTime[0]
+
+    
+def load_detector(options):
+    """
+    Load the model in options.detectorFile and warm it up on a batch of the size we'll
+    run inference with.
+    """
+    
+    if options.nLoaderWorkers > 0:
+        batchSize = max(1,options.batchSize)
+    else:
+        batchSize = 1
+    return TFDetector(options.detectorFile,batch_size=batchSize,
+                      intra_op_threads=options.intraOpThreads,
+                      inter_op_threads=options.interOpThreads)
+
+    
+def generate_detections(detector,images,options,resultCallback=None):
     """
     boxes,scores,classes,images = generate_detections(detection_graph,images)
 
     Run an already-loaded detector network on a set of images.
 
     [images] should be a list of filenames.
+    
+    If options.nLoaderWorkers > 0, runs in pipelined mode (see run_detector_pipelined),
+    otherwise processes images one at a time.
 
     Boxes are returned in relative coordinates as (top, left, bottom, right); 
     x,y origin is the upper-left.
@@ -129,119 +624,41 @@ def generate_detections(detector,images,options):
     
     [images] will be returned as a list of files that were actually processed, possibly a subset
     of the input parameter [images].
+    
+    If [resultCallback] is supplied, it's called as resultCallback(indices,boxes,scores,classes)
+    as each batch of images completes, where [indices] are indices into [images] and the arrays
+    have size len(indices) x nDetections (x 4 for boxes); results are not retained, and [boxes], 
+    [scores], and [classes] are returned as None.  Callbacks may arrive out of order, but never
+    concurrently.
     """
 
     if not isinstance(images,list):
         images = [images]
         
     nImages = len(images)
-    firstImage = 0
-    
-    if options.resumeFromCheckpoint is not None:
-        print('Loading state from checkpoint {}'.format(options.resumeFromCheckpoint))
-        cpState = pickle.load(open(options.resumeFromCheckpoint,'rb'))
-        
-        # "Wind back the clock" by one image, just to avoid edge effects like crashing during
-        # serialization.
-        firstImage = max(cpState.iImage - 1,0)
-        print('Resuming from image {}'.format(firstImage))
-    else:
-        cpState = CheckPointState(nImages)
+    state = DetectionState(nImages)
         
     print('Running detector...')    
     startTime = time.time()
-    firstImageCompleteTime = None
     
-    detection_graph = detector.detection_graph
+    # The detector's session is already open and warmed up
+    if options.nLoaderWorkers > 0:
+        firstImageCompleteTime = run_detector_pipelined(detector.engine,images,
+                                                        state,options,resultCallback)
+    else:
+        firstImageCompleteTime = run_detector_serial(detector.engine,images,
+                                                     state,options,resultCallback)
     
-    with detection_graph.as_default():
-        
-        with tf.Session(graph=detection_graph) as sess:
-            
-            for iImage,image in tqdm(enumerate(images)): 
-                
-                # Skip images we've loaded from a checkpoint or otherwise preprocessed
-                if iImage < firstImage:
-                    continue
-                
-                assert isinstance(image,str)
-                
-                if not os.path.isfile(image):
-                    print('Warning: can''t find file {}, skipping'.format(image))
-                    cpState.bValidImage[iImage] = False
-                    continue
-                
-                try:
-                    
-                    # Load the image as an nparray of size h,w,nChannels
-                    height, width = MIN_DIM, MAX_DIM
-                    imageNP = PIL.Image.open(image).convert("RGB").resize((width, height))
-
-                    imageNP = np.asarray(imageNP, np.uint8)
-                    # image = mpimg.imread(image)
-                    
-                    nChannels = imageNP.shape[2]
-                    
-                    # This shouldn't be necessary when loading with PIL and converting to RGB, 
-                    # since by definition this leaves us with three channels.  But keeping it 
-                    # here for future-proofing.
-                    if nChannels > 3:
-                        print('Warning: trimming channels from image')
-                        imageNP = imageNP[:,:,0:3]
-                    
-                    imageNP_expanded = np.expand_dims(imageNP, axis=0)
-                    image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-                    box = detection_graph.get_tensor_by_name('detection_boxes:0')
-                    score = detection_graph.get_tensor_by_name('detection_scores:0')
-                    clss = detection_graph.get_tensor_by_name('detection_classes:0')
-                    num_detections = detection_graph.get_tensor_by_name('num_detections:0')
-                    
-                    # Run inference on this image
-                    (box, score, clss, num_detections) = sess.run(
-                            [box, score, clss, num_detections],
-                            feed_dict={image_tensor: imageNP_expanded})
-    
-                    cpState.boxes[iImage] = box
-                    cpState.scores[iImage] = score
-                    cpState.classes[iImage] = clss
-                    
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                    
-                except Exception as e:
-                    print('Error processing image {}: {}'.format(image,str(e)))
-                    cpState.bValidImage[iImage] = False
-                    continue
-                
-                if firstImageCompleteTime is None:
-                    firstImageCompleteTime = time.time()
-                
-                if options.checkpointFrequency > 0:
-                    
-                    if (iImage % options.checkpointFrequency) == 0:
-                    
-                        tempDir = os.path.join(tempfile.gettempdir(),CHECKPOINT_SUBDIR)
-                        os.makedirs(tempDir,exist_ok=True)
-                        
-                        # jsonpickle.set_encoder_options('json', sort_keys=False, indent=0)
-                        # s = jsonpickle.encode(cp)
-                        f = tempfile.NamedTemporaryFile(dir=tempDir,delete=False)
-                        print('Checkpointing {} images to {}...'.format(iImage+1,f.name),end='')
-                        cpState.iImage = iImage
-                        pickle.dump(cpState,f)
-                        f.close()
-                        print('...done')
-                                            
-            # ...for each image                
-    
-        # ...with tf.Session
-
-    # ...with detection_graph.as_default()
-    
-    images = list(compress(images, cpState.bValidImage))
-    boxes = list(compress(cpState.boxes, cpState.bValidImage))
-    scores = list(compress(cpState.scores, cpState.bValidImage))
-    classes = list(compress(cpState.classes, cpState.bValidImage))
+    images = list(compress(images, state.bValidImage))
+    
+    if resultCallback is not None:
+        print('Finished running detector on {} images in {}'.format(len(images),
+              humanfriendly.format_timespan(time.time() - startTime)))
+        return None,None,None,images
+    
+    boxes = list(compress(state.boxes, state.bValidImage))
+    scores = list(compress(state.scores, state.bValidImage))
+    classes = list(compress(state.classes, state.bValidImage))
     
     nImages = len(images)
     
@@ -386,62 +803,84 @@ def options_to_images(options):
     return imageFileNames
 
 
-def detector_output_to_api_output(imageFileNames,options,boxes,scores,classes):
+def output_file_name(imageFileName,options):
+    """
+    Apply options.outputPathReplacements and options.outputRelativeFilenames to an image
+    file name.
     """
-    Converts the output of the TFODAPI detector to the format used by our batch
-    API, as a pandas table.    
-    """    
-    nRows = len(imageFileNames)
     
-    boxesOut = [[]] * nRows
-    confidences = [0] * nRows
-    # iRow = 0
-    for iRow in range(0,nRows):
-        
-        imageBoxes = boxes[iRow]
-        imageScores = scores[iRow]
-        imageClasses = classes[iRow]
-        
-        bScoreAboveThreshold = imageScores > options.threshold
-        
-        if not any(bScoreAboveThreshold):
-            continue
-        
-        imageScores = list(compress(imageScores, bScoreAboveThreshold))
-        imageBoxes = list(compress(imageBoxes, bScoreAboveThreshold))
-        imageClasses = list(compress(imageClasses, bScoreAboveThreshold))
-        
-        confidences[iRow] = max(imageScores)
-        
-        nImageBoxes = len(imageScores)
-        imageBoxesOut = []
-        
-        # Convert detections into 5-element lists, where the fifth element is a class    
-        #
-        # iBox = 0
-        for iBox in range(0,nImageBoxes):
-            box = list(imageBoxes[iBox])
+    if options.outputPathReplacements is not None:
+        for query in options.outputPathReplacements:
+            replacement = options.outputPathReplacements[query]
+            imageFileName = imageFileName.replace(query,replacement)
             
-            # convert from float32 to float
-            box = [round(float(x), COORD_DIGITS) for x in box]
-            # x/y/w/h/p/class
-            box.append(round(float(imageScores[iBox]), CONF_DIGITS))
-            box.append(int(imageClasses[iBox]))
-            imageBoxesOut.append(box)
+    if options.outputRelativeFilenames and os.path.isdir(options.imageFile):
+        imageFileName = os.path.relpath(imageFileName,options.imageFile)
         
-        boxesOut[iRow] = imageBoxesOut
+    return imageFileName
+
 
-    boxStrings = [json.dumps(x) for x in boxesOut]
+def detector_output_to_api_entries(imageFileNames,options,boxes,scores,classes):
+    """
+    Converts the TFODAPI detector output for a batch of images (nImages x nDetections x 4 
+    boxes as [top, left, bottom, right], nImages x nDetections scores and classes) to entries
+    in the 'images' array of our batch API output format, thresholding the whole batch at 
+    once.  'file' is taken from [imageFileNames], unmodified.
+    """
     
-    # Build the output table
-    df = pd.DataFrame(np.column_stack([imageFileNames,confidences,boxStrings]),
-                      columns=['image_path','max_confidence','detections'])
-    return df
+    return detections_to_api_entries(imageFileNames,boxes,scores,classes,options.threshold)
+
+
+def api_entries_to_csv_table(entries):
+    """
+    Converts a list of entries in the 'images' array of our batch API output format to 
+    the (deprecated) .csv format, as a pandas table.
+    """
+    
+    rows = []
+    for entry in entries:
+        
+        # Our .csv format was ymin/xmin/ymax/xmax/conf/class
+        detections = []
+        for d in entry['detections']:
+            x,y,w,h = d['bbox']
+            detections.append([y, x, round(y + h, COORD_DIGITS), round(x + w, COORD_DIGITS),
+                               d['conf'], int(d['category'])])
+        rows.append([entry['file'],entry['max_detection_conf'],json.dumps(detections)])
+        
+    return pd.DataFrame(rows,columns=['image_path','max_confidence','detections'])
 
 
 #%% Main function
 
+def checkpoint_path_for_options(options):
+    """
+    Figure out where checkpoints should go, or return None if we're not checkpointing.
+    """
+    
+    if options.resumeFromCheckpoint is not None:
+        return options.resumeFromCheckpoint
+    
+    if options.checkpointFrequency <= 0:
+        return None
+    
+    if options.checkpointPath is not None:
+        return options.checkpointPath
+    
+    tempDir = os.path.join(tempfile.gettempdir(),CHECKPOINT_SUBDIR)
+    os.makedirs(tempDir,exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=tempDir,prefix='checkpoint_',suffix='.jsonl',delete=False)
+    f.close()
+    return f.name
+
+
 def load_and_run_detector(options,detector=None):
+    """
+    Run the detector on the images specified by [options], writing results to 
+    options.outputFile.  Results are handled one image at a time and are not retained, so
+    [boxes], [scores], and [classes] are returned as None; [imageFileNames] is the list of 
+    images that were processed in this run or recovered from a checkpoint.
+    """
     
     imageFileNames = options_to_images(options)
     
@@ -455,45 +894,97 @@ def load_and_run_detector(options,detector=None):
         print('Warning: no files available')
         return
     
+    # Find images we've already processed
+    previousEntries = {}
+    if options.resumeFromCheckpoint is not None:
+        print('Loading results from checkpoint {}'.format(options.resumeFromCheckpoint))
+        previousEntries = CheckpointLog.load(options.resumeFromCheckpoint)
+        
+    imagesToProcess = [fn for fn in imageFileNames if fn not in previousEntries]
+    recoveredFileNames = [fn for fn in imageFileNames if fn in previousEntries]
+    if options.resumeFromCheckpoint is not None:
+        print('Recovered {} images from checkpoint, {} remaining'.format(
+            len(recoveredFileNames),len(imagesToProcess)))
+    
     # Load detector if necessary
-    if detector is None:
+    if detector is None and len(imagesToProcess) > 0:
         startTime = time.time()
         print('Loading model...')
-        detector = TFDetector(options.detectorFile)
+        detector = load_detector(options)
         elapsed = time.time() - startTime
         print("Loaded model in {}".format(humanfriendly.format_timespan(elapsed)))
     
-    # Run detector on target images
-    boxes,scores,classes,imageFileNames = generate_detections(detector,imageFileNames,options)
-    
-    assert len(boxes) == len(imageFileNames)
+    # Set up checkpointing
+    checkpointLog = None
+    checkpointPath = checkpoint_path_for_options(options)
+    if checkpointPath is not None:
+        print('Writing checkpoints to {}'.format(checkpointPath))
+        checkpointLog = CheckpointLog(checkpointPath,options.checkpointFrequency)
     
+    # Set up output; .json output is streamed to disk, .csv output is accumulated
+    csvEntries = None
+    writer = None
+    if options.outputFile.endswith('.csv'):
+        csvEntries = []
+    else:
+        info = {
+            'detector': os.path.basename(options.detectorFile) if options.detectorFile else 'unknown',
+            'detection_completion_time': 'unknown',
+            'classifier': 'unknown',
+            'classification_completion_time': 'unknown'
+        }
+        jsonlPath = None
+        if options.outputJsonLines:
+            jsonlPath = default_jsonl_path(options.outputFile)
+        writer = ApiOutputWriter(options.outputFile,info,
+                                 annotation_constants.bbox_category_id_to_name,
+                                 jsonl_path=jsonlPath)
+        
+    def emit(entry):
+        entry = dict(entry)
+        entry['file'] = output_file_name(entry['file'],options)
+        if writer is not None:
+            writer.write_image(entry)
+        else:
+            csvEntries.append(entry)
+            
+    def write_results(indices,boxes,scores,classes):
+        entries = detector_output_to_api_entries([imagesToProcess[i] for i in indices],options,
+                                                 boxes,scores,classes)
+        for entry in entries:
+            if checkpointLog is not None:
+                checkpointLog.append(entry)
+            emit(entry)
+        
+    try:
+        
+        for fn in recoveredFileNames:
+            emit(previousEntries[fn])
+            
+        processedFileNames = []
+        if len(imagesToProcess) > 0:
+            _,_,_,processedFileNames = generate_detections(detector,imagesToProcess,options,
+                                                           resultCallback=write_results)
+            
+    except BaseException:
+        
+        if writer is not None:
+            writer.abort()
+        raise
+        
+    finally:
+        
+        if checkpointLog is not None:
+            checkpointLog.close()
+            
     print('Writing output...')
     
-    df = detector_output_to_api_output(imageFileNames,options,boxes,scores,classes)
-    
-    # PERF: iterrows is the wrong way to do this for large files
-    if options.outputPathReplacements is not None:
-        for iRow,row in df.iterrows():
-            for query in options.outputPathReplacements:
-                replacement = options.outputPathReplacements[query]
-                row['image_path'] = row['image_path'].replace(query,replacement)
-    
-    if options.outputRelativeFilenames and os.path.isdir(options.imageFile):
-        for iRow,row in df.iterrows():
-            row['image_path'] = os.path.relpath(row['image_path'],options.imageFile)
-            
-    if options.outputFile.endswith('.csv'):
-        write_api_results_csv(df,options.outputFile)
+    if writer is not None:
+        writer.close()
     else:
-        # While we're in transition between formats, write out the old format and 
-        # convert to the new format if .json is requested
-        tempfilename = next(tempfile._get_candidate_names()) + '.csv'
-        write_api_results_csv(df,tempfilename)
-        convert_output_format.convert_csv_to_json(tempfilename,options.outputFile)
-        os.remove(tempfilename)
+        write_api_results_csv(api_entries_to_csv_table(csvEntries),options.outputFile)
 
-    return boxes,scores,classes,imageFileNames
+    return None,None,None,recoveredFileNames + processedFileNames
 
 
 #%% Interactive driver
@@ -513,10 +1004,10 @@ if False:
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
     print('Loading model...',end='')
-    detector = TFDetector(options.detectorFile)
+    detector = load_detector(options)
     print('...done')
     
-    boxes,scores,classes,imageFileNames = load_and_run_detector(options,detector)
+    _,_,_,imageFileNames = load_and_run_detector(options,detector)
     
     
     #%% Post-processing with process_batch_results... this can also be run from the command line.
@@ -565,11 +1056,27 @@ def main():
     parser.add_argument('--forceCpu', action='store_true', 
                         help='Force CPU detection, even if a GPU is available')
     parser.add_argument('--checkpointFrequency', type=int, default=DEFAULT_CHECKPOINT_N_IMAGES,
-                        help='Checkpoint results to allow restoration from crash points later')
+                        help='Log results to a checkpoint file, flushing to disk every N images, to allow restoration from crash points later')
+    parser.add_argument('--checkpointPath', type=str, default=None,
+                        help='Checkpoint file to write, defaults to a new file in a temporary directory')
     parser.add_argument('--resumeFromCheckpoint', type=str, default=None,
-                        help='Initiate inference from the specified checkpoint')
+                        help='Skip images that appear in the specified checkpoint file, and continue appending to it')
     parser.add_argument('--outputRelativeFilenames', action='store_true',
                         help='Output relative file names, only meaningful if --imageFile points to a directory')
+    parser.add_argument('--stretchImages', dest='preserveAspectRatio', action='store_false',
+                        help='Resize images to exactly {}x{} rather than preserving their aspect ratio'.format(MAX_DIM,MIN_DIM))
+    parser.add_argument('--outputJsonLines', action='store_true',
+                        help='Also write a .jsonl file with one line per image, only meaningful for .json output')
+    parser.add_argument('--nLoaderWorkers', type=int, default=DEFAULT_N_LOADER_WORKERS,
+                        help='Number of image loading threads; > 0 enables pipelined loading and batched inference')
+    parser.add_argument('--batchSize', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of images per inference call, only meaningful with --nLoaderWorkers > 0')
+    parser.add_argument('--queueSize', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Maximum number of decoded images waiting for inference, only meaningful with --nLoaderWorkers > 0')
+    parser.add_argument('--intraOpThreads', type=int, default=0,
+                        help='Number of threads TF uses within an op (0 lets TF choose)')
+    parser.add_argument('--interOpThreads', type=int, default=0,
+                        help='Number of ops TF runs in parallel (0 lets TF choose)')
     
     if len(sys.argv[1:])==0:
         parser.print_help()
@@ -0,0 +1,412 @@
+#####
+#
+# rendering_engine.py
+#
+# Renders previews of many images (e.g. the sample pages written by postprocess_batch_results.py),
+# each one resized and drawn on by a render function, and written to its own output file.
+#
+# Compared to opening, resizing, drawing on and saving each image in a loop, the engine:
+#
+# * Decodes JPEGs with PIL's draft mode, which uses DCT scaling to decode directly at 1/2, 1/4 or
+#   1/8 of the full resolution, as long as the result is still at least as large as the output size.
+#   For 12-20MP camera trap images this is several times faster than a full decode.
+#
+# * Optionally writes WebP or lower-quality JPEG output, which is smaller and faster to load in a
+#   browser.
+#
+# * Runs serially, on a thread pool, or on a process pool.  Opening, resizing, drawing and encoding
+#   with PIL mostly hold the GIL, so processes scale much better than threads.  To use the process
+#   pool, render functions and their arguments need to be picklable, i.e. render functions should be
+#   module-level functions like visualization_utils.render_detection_bounding_boxes.
+#
+# * Skips images whose output is up to date.  Each job has a cache key made of the source image's
+#   path, size and modification time, the render function and its arguments, and the rendering
+#   options; a manifest file next to the outputs records the key each output was rendered with.  An
+#   output whose key matches the key of another existing output (e.g. an image that moved from one
+#   page to another after a threshold change) is copied rather than re-rendered.
+#
+#####
+
+#%% Constants and imports
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
+from tqdm import tqdm
+
+import visualization.visualization_utils as vis_utils
+
+RENDERING_CACHE_VERSION = 1
+
+OUTPUT_FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp'}
+
+# Number of jobs sent to a worker process at a time
+PROCESS_POOL_CHUNK_SIZE = 8
+
+
+#%% Classes
+
+class RenderingOptions:
+
+    # Output size (width, height); set either dimension to -1 to preserve aspect ratio, or
+    # both to keep the original size
+    target_size = (800, -1)
+
+    # Decode JPEGs at the smallest DCT-scaled size that is still at least target_size
+    use_draft_mode = True
+
+    # None to write images in the format implied by their output file name, or 'jpeg' or 'webp'
+    # (which also changes the output file extension)
+    output_format = None
+
+    # JPEG/WebP quality (1-100), or None to use PIL's default
+    quality = None
+
+    # 'serial', 'threads' or 'processes'
+    parallelism = 'serial'
+
+    # Number of threads or processes; None to use one per core
+    n_workers = None
+
+    # Skip jobs whose output is up to date according to the manifest file
+    skip_up_to_date = True
+
+
+class RenderingJob:
+    """
+    One image to render: input_path is opened and resized, render_function(image=image, **render_kwargs)
+    draws on it in place, and the result is written to output_path.
+
+    If pass_original_size is True, the render function is also passed the size of the input image before
+    resizing, as original_size=(width, height) (e.g. for vis_utils.render_db_bounding_boxes, which takes
+    boxes in pixel coordinates).
+    """
+
+    def __init__(self, input_path, output_path, render_function=None, render_kwargs=None,
+                 pass_original_size=False):
+
+        self.input_path = input_path
+        self.output_path = output_path
+        self.render_function = render_function
+        self.render_kwargs = {} if render_kwargs is None else render_kwargs
+        self.pass_original_size = pass_original_size
+
+
+#%% Rendering functions (these run in worker processes)
+
+def resized_size(image_size, target_size):
+    """
+    Computes the size that vis_utils.resize_image(image, target_size[0], target_size[1]) will
+    resize an image of size image_size (width, height) to.
+    """
+
+    target_width, target_height = target_size
+    if target_width == -1 and target_height == -1:
+        return image_size
+
+    aspect_ratio = image_size[0] / image_size[1]
+    if target_height == -1:
+        target_height = int(target_width / aspect_ratio)
+    elif target_width == -1:
+        target_width = int(aspect_ratio * target_height)
+    return target_width, target_height
+
+
+def open_image(input_path, target_size=None, use_draft_mode=True, return_original_size=False):
+    """
+    Opens an image, decoding JPEGs at reduced resolution if that is still large enough to be resized
+    to target_size, resizes it to target_size, and converts it to RGB.
+
+    If return_original_size is True, returns (image, (width, height) of the input image).
+    """
+
+    image = Image.open(input_path)
+    original_size = image.size
+    if target_size is not None:
+        output_size = resized_size(image.size, target_size)
+        if use_draft_mode and output_size[0] < image.width and output_size[1] < image.height:
+            # draft() is a no-op for formats other than JPEG
+            image.draft('RGB', output_size)
+        if image.mode != 'RGB':
+            image = image.convert(mode='RGB')
+        if output_size != image.size:
+            image = vis_utils.resize_image(image, output_size[0], output_size[1])
+    elif image.mode != 'RGB':
+        image = image.convert(mode='RGB')
+    if return_original_size:
+        return image, original_size
+    return image
+
+
+def save_image(image, output_path, output_format=None, quality=None):
+    """
+    Saves an image.  If the path is too long for the file system, writes it to a file named after the
+    hash of its file name in the same folder instead.
+
+    Returns: the path the image was written to
+    """
+
+    save_kwargs = {}
+    if output_format is not None:
+        save_kwargs['format'] = output_format
+    if quality is not None:
+        save_kwargs['quality'] = quality
+
+    try:
+        image.save(output_path, **save_kwargs)
+    except OSError as e:
+        # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so
+        # we awkwardly check against a hard-coded limit
+        if (e.errno == errno.ENAMETOOLONG) or (len(output_path) >= 259):
+            output_dir, output_file_name = os.path.split(output_path)
+            extension = os.path.splitext(output_file_name)[1]
+            output_path = os.path.join(output_dir,
+                                       hashlib.sha1(output_file_name.encode('utf-8')).hexdigest() + extension)
+            image.save(output_path, **save_kwargs)
+        else:
+            raise
+    return output_path
+
+
+def render_job(job, options, output_path):
+    """
+    Renders a single job to output_path.
+
+    Returns: the path the image was written to, or None if the image could not be opened
+    """
+
+    try:
+        image, original_size = open_image(job.input_path, options.target_size, options.use_draft_mode,
+                                          return_original_size=True)
+    except Exception as e:
+        print('Warning: could not open image file {}: {}'.format(job.input_path, e))
+        return None
+
+    if job.render_function is not None:
+        if job.pass_original_size:
+            job.render_function(image=image, original_size=original_size, **job.render_kwargs)
+        else:
+            job.render_function(image=image, **job.render_kwargs)
+
+    return save_image(image, output_path, options.output_format, options.quality)
+
+
+def _render_job_args(args):
+    return render_job(*args)
+
+
+#%% Cache keys
+
+def job_output_path(job, options):
+    """
+    Returns the path a job will be written to, which has a different extension than job.output_path
+    if options.output_format is set.
+    """
+
+    if options.output_format is None:
+        return job.output_path
+    return os.path.splitext(job.output_path)[0] + OUTPUT_FORMAT_EXTENSIONS[options.output_format.lower()]
+
+
+def job_cache_key(job, options):
+    """
+    Computes the cache key of a job, or returns None if the input image doesn't exist.
+    """
+
+    try:
+        st = os.stat(job.input_path)
+    except OSError:
+        return None
+
+    render_function_name = None
+    if job.render_function is not None:
+        render_function_name = job.render_function.__module__ + '.' + job.render_function.__qualname__
+
+    key_fields = [RENDERING_CACHE_VERSION, os.path.abspath(job.input_path), st.st_size, st.st_mtime_ns,
+                  render_function_name, job.render_kwargs, job.pass_original_size,
+                  list(options.target_size), options.use_draft_mode, options.output_format, options.quality]
+    key_string = json.dumps(key_fields, sort_keys=True, default=str)
+    return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+
+#%% Engine
+
+class RenderingEngine:
+
+    # Default name of the manifest file, in the folder that outputs are written to
+    MANIFEST_FILE_NAME = '.rendering_cache.json'
+
+    def __init__(self, options=None, manifest_file=None):
+        """
+        If manifest_file is None, every job is rendered.
+        """
+
+        if options is None:
+            options = RenderingOptions()
+        self.options = options
+        self.manifest_file = manifest_file
+
+    def _load_manifest(self):
+        """
+        Returns a dict mapping output paths, relative to the manifest's folder, to {'key','file'} dicts,
+        where 'file' is where the output was actually written (see save_image()).
+        """
+
+        if self.manifest_file is None or not os.path.isfile(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        except ValueError:
+            print('Warning: ignoring unreadable rendering cache {}'.format(self.manifest_file))
+            return {}
+        if manifest.get('version') != RENDERING_CACHE_VERSION:
+            return {}
+        return manifest['outputs']
+
+    def _save_manifest(self, outputs):
+
+        temp_file = self.manifest_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'version': RENDERING_CACHE_VERSION, 'outputs': outputs}, f)
+        os.replace(temp_file, self.manifest_file)
+
+    def _relative_path(self, path):
+
+        return os.path.relpath(path, os.path.dirname(os.path.abspath(self.manifest_file)))
+
+    def _absolute_path(self, relative_path):
+
+        return os.path.join(os.path.dirname(os.path.abspath(self.manifest_file)), relative_path)
+
+    def _map(self, function, args_list, desc):
+        """
+        Applies function to each element of args_list with the configured parallelism, returning
+        results in order.
+        """
+
+        parallelism = self.options.parallelism
+        if parallelism == 'serial' or len(args_list) <= 1:
+            return [function(args) for args in tqdm(args_list, desc=desc)]
+
+        if parallelism == 'threads':
+            pool = ThreadPool(self.options.n_workers)
+            chunk_size = 1
+        elif parallelism == 'processes':
+            pool = Pool(self.options.n_workers)
+            chunk_size = PROCESS_POOL_CHUNK_SIZE
+        else:
+            raise ValueError('Unknown parallelism {}'.format(parallelism))
+
+        try:
+            return list(tqdm(pool.imap(function, args_list, chunksize=chunk_size), total=len(args_list), desc=desc))
+        finally:
+            pool.close()
+            pool.join()
+
+    def render(self, jobs):
+        """
+        Renders a list of RenderingJobs.
+
+        Returns: a list with, for each job, the path its output was written to, or None if the input
+        image could not be found or opened
+        """
+
+        options = self.options
+        use_cache = self.manifest_file is not None
+        output_paths = [job_output_path(job, options) for job in jobs]
+
+        # Checking that the input exists is a by-product of computing cache keys, which only need a
+        # stat() per image; threads are enough for that.
+        if use_cache:
+            if options.parallelism == 'serial':
+                keys = [job_cache_key(job, options) for job in jobs]
+            else:
+                pool = ThreadPool(options.n_workers)
+                try:
+                    keys = pool.starmap(job_cache_key, [(job, options) for job in jobs])
+                finally:
+                    pool.close()
+                    pool.join()
+            manifest = self._load_manifest()
+        else:
+            # isfile() is slow when mounting remote directories; missing images will show up as
+            # images that can't be opened instead.
+            keys = [''] * len(jobs)
+            manifest = {}
+
+        key_to_file = {}
+        for entry in manifest.values():
+            key_to_file[entry['key']] = entry['file']
+
+        results = [None] * len(jobs)
+        jobs_to_render = []
+        n_missing = 0
+        n_up_to_date = 0
+        n_copied = 0
+
+        for i_job, (job, output_path, key) in enumerate(zip(jobs, output_paths, keys)):
+
+            if key is None:
+                print('Warning: could not find image file {}'.format(job.input_path))
+                n_missing += 1
+                continue
+
+            if use_cache and options.skip_up_to_date:
+
+                entry = manifest.get(self._relative_path(output_path))
+                if entry is not None and entry['key'] == key:
+                    existing_path = self._absolute_path(entry['file'])
+                    if os.path.isfile(existing_path):
+                        results[i_job] = existing_path
+                        n_up_to_date += 1
+                        continue
+
+                if key in key_to_file:
+                    existing_path = self._absolute_path(key_to_file[key])
+                    try:
+                        shutil.copyfile(existing_path, output_path)
+                        results[i_job] = output_path
+                        n_copied += 1
+                        continue
+                    except OSError:
+                        # the output has been deleted, or output_path is too long; just render it
+                        pass
+
+            jobs_to_render.append(i_job)
+
+        print('Rendering {} of {} images ({} up to date, {} copied, {} missing)'.format(
+            len(jobs_to_render), len(jobs), n_up_to_date, n_copied, n_missing))
+
+        rendered_paths = self._map(_render_job_args,
+                                   [(jobs[i_job], options, output_paths[i_job]) for i_job in jobs_to_render],
+                                   desc='Rendering')
+        for i_job, rendered_path in zip(jobs_to_render, rendered_paths):
+            results[i_job] = rendered_path
+
+        if use_cache:
+            for output_path, key, result in zip(output_paths, keys, results):
+                relative_path = self._relative_path(output_path)
+                if result is None:
+                    manifest.pop(relative_path, None)
+                else:
+                    manifest[relative_path] = {'key': key, 'file': self._relative_path(result)}
+            self._save_manifest(manifest)
+
+        return results
+
+    # ...def render(self, jobs)
+
+
+def render_images(jobs, options=None, manifest_file=None):
+    """
+    Convenience wrapper: renders a list of RenderingJobs with a new RenderingEngine.
+    """
+
+    return RenderingEngine(options, manifest_file).render(jobs)
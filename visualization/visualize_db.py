@@ -5,6 +5,10 @@
 # Outputs an HTML page visualizing annotations (class labels and/or bounding boxes)
 # on a sample of images in a database in the COCO Camera Traps format
 #
+# Rendering goes through visualization/rendering_engine.py, so JPEGs are decoded at
+# reduced resolution when that's enough for viz_size, rendering can run on processes,
+# and thumbnails that are already up to date from a previous run are reused.
+#
 ########
 
 #%% Imports
@@ -16,8 +20,8 @@ import math
 import os
 import sys
 import time
+from collections import defaultdict
 from itertools import compress
-from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 from tqdm import tqdm
@@ -29,6 +33,7 @@ from write_html_image_list import write_html_image_list
 # Assumes the cameratraps repo root is on the path
 import visualization.visualization_utils as vis_utils
 from data_management.cct_json_utils import IndexedJsonDb
+from visualization.rendering_engine import RenderingEngine, RenderingJob, RenderingOptions
 
 
 #%% Settings
@@ -55,6 +60,18 @@ class DbVizOptions:
     parallelize_rendering_n_cores = 100
     parallelize_rendering = False
     
+    # Render on processes rather than threads (if parallelize_rendering is True); rendering
+    # mostly holds the GIL, so this is much faster on many-core machines.  The number of 
+    # processes is capped at the number of cores.
+    parallelize_rendering_with_processes = False
+    
+    # Decode JPEGs at reduced resolution when that's still at least viz_size
+    rendered_image_draft_mode = True
+    
+    # Reuse rendered images from a previous run if the image, its boxes and the rendering 
+    # settings haven't changed
+    skip_up_to_date_renderings = True
+    
 
 #%% Helper functions
 
@@ -67,6 +84,30 @@ def image_filename_to_path(image_file_name, image_base_dir, pathsep_replacement=
     return os.path.join(image_base_dir, image_file_name)
 
 
+def rendering_options(options):
+    """
+    Translates the rendering settings in a DbVizOptions object to RenderingOptions.
+    """
+    
+    r_options = RenderingOptions()
+    r_options.target_size = tuple(options.viz_size)
+    r_options.use_draft_mode = options.rendered_image_draft_mode
+    r_options.skip_up_to_date = options.skip_up_to_date_renderings
+    
+    if not options.parallelize_rendering:
+        r_options.parallelism = 'serial'
+    elif options.parallelize_rendering_with_processes:
+        r_options.parallelism = 'processes'
+        r_options.n_workers = options.parallelize_rendering_n_cores
+        if r_options.n_workers is not None:
+            r_options.n_workers = min(r_options.n_workers, os.cpu_count())
+    else:
+        r_options.parallelism = 'threads'
+        r_options.n_workers = options.parallelize_rendering_n_cores
+        
+    return r_options
+
+
 #%% Core functions
 
 def process_images(db_path,output_dir,image_base_dir,options=None):
@@ -141,9 +182,13 @@ def process_images(db_path,output_dir,image_base_dir,options=None):
         imagesWithValidClasses = list(compress(images, bValidClass))
         images = imagesWithValidClasses    
     
-    # Put the annotations in a dataframe so we can select all annotations for a given image
-    print('Creating data frames')
-    df_anno = pd.DataFrame(annotations)
+    # Index annotations by image ID, so we can look up all annotations for a given image
+    print('Indexing annotations')
+    image_id_to_annotations = defaultdict(list)
+    for ann in annotations:
+        image_id_to_annotations[ann['image_id']].append(ann)
+    
+    # Put the images in a dataframe so we can sample them
     df_img = pd.DataFrame(images)
     
     # Construct label map
@@ -157,20 +202,17 @@ def process_images(db_path,output_dir,image_base_dir,options=None):
     
     images_html = []
     
-    # Set of dicts representing inputs to render_db_bounding_boxes:
-    #
-    # bboxes, boxClasses, image_path
-    rendering_info = []
+    # RenderingJobs for render_db_bounding_boxes
+    rendering_jobs = []
+    rendered_images_dir = os.path.join(output_dir, 'rendered_images')
     
     print('Preparing rendering list')
-    # iImage = 0
-    for iImage in tqdm(range(len(df_img))):
+    # img_id = df_img['id'].iloc[0]; img_relative_path = df_img['file_name'].iloc[0]
+    for img_id, img_relative_path in tqdm(zip(df_img['id'], df_img['file_name']), total=len(df_img)):
         
-        img_id = df_img.iloc[iImage]['id']
-        img_relative_path = df_img.iloc[iImage]['file_name']
         img_path = os.path.join(image_base_dir, image_filename_to_path(img_relative_path, image_base_dir))
     
-        annos_i = df_anno.loc[df_anno['image_id'] == img_id, :]  # all annotations on this image
+        annos_i = image_id_to_annotations.get(img_id, [])  # all annotations on this image
     
         bboxes = []
         boxClasses = []
@@ -181,8 +223,8 @@ def process_images(db_path,output_dir,image_base_dir,options=None):
         annotationLevelForImage = ''
         
         # Iterate over annotations for this image
-        # iAnn = 0; anno = annos_i.iloc[iAnn]
-        for iAnn,anno in annos_i.iterrows():
+        # anno = annos_i[0]
+        for anno in annos_i:
         
             if 'sequence_level_annotation' in anno:
                 bSequenceLevelAnnotation = anno['sequence_level_annotation']
@@ -215,8 +257,11 @@ def process_images(db_path,output_dir,image_base_dir,options=None):
         file_name = '{}_gtbbox.jpg'.format(img_id.lower().split('.jpg')[0])
         file_name = file_name.replace('/', '~')
         
-        rendering_info.append({'bboxes':bboxes, 'boxClasses':boxClasses, 'img_path':img_path,
-                               'output_file_name':file_name})
+        rendering_jobs.append(RenderingJob(
+            img_path, os.path.join(rendered_images_dir, file_name),
+            render_function=vis_utils.render_db_bounding_boxes,
+            render_kwargs={'boxes': bboxes, 'classes': boxClasses, 'label_map': label_map},
+            pass_original_size=True))
                 
         labelLevelString = ''
         if len(annotationLevelForImage) > 0:
@@ -235,47 +280,16 @@ def process_images(db_path,output_dir,image_base_dir,options=None):
     
     # ...for each image
 
-    def render_image_info(rendering_info):
-        
-        img_path = rendering_info['img_path']
-        bboxes = rendering_info['bboxes']
-        bboxClasses = rendering_info['boxClasses']
-        output_file_name = rendering_info['output_file_name']
-        
-        if not os.path.exists(img_path):
-            print('Image {} cannot be found'.format(img_path))
-            return
-            
-        try:
-            original_image = vis_utils.open_image(img_path)
-            original_size = original_image.size
-            image = vis_utils.resize_image(original_image, options.viz_size[0], options.viz_size[1])
-        except Exception as e:
-            print('Image {} failed to open. Error: {}'.format(img_path, e))
-            return
-            
-        vis_utils.render_db_bounding_boxes(boxes=bboxes, classes=bboxClasses,
-                                           image=image, original_size=original_size,
-                                           label_map=label_map)
-        image.save(os.path.join(output_dir, 'rendered_images', output_file_name))
-    
-    # ...def render_image_info
-    
     print('Rendering images')
     start_time = time.time()
-    if options.parallelize_rendering:
-        if options.parallelize_rendering_n_cores is None:
-            pool = ThreadPool()
-        else:
-            print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-            pool = ThreadPool(options.parallelize_rendering_n_cores)
-        tqdm(pool.imap(render_image_info, rendering_info), total=len(rendering_info))
-    else:
-        for file_info in tqdm(rendering_info):        
-            render_image_info(file_info)
+    manifest_file = None
+    if options.skip_up_to_date_renderings:
+        manifest_file = os.path.join(rendered_images_dir, RenderingEngine.MANIFEST_FILE_NAME)
+    engine = RenderingEngine(rendering_options(options), manifest_file)
+    engine.render(rendering_jobs)
     elapsed = time.time() - start_time
     
-    print('Rendered {} images in {}'.format(len(rendering_info),humanfriendly.format_timespan(elapsed)))
+    print('Rendered {} images in {}'.format(len(rendering_jobs),humanfriendly.format_timespan(elapsed)))
         
     if options.sort_by_filename:    
         images_html = sorted(images_html, key=lambda x: x['filename'])
@@ -331,6 +345,10 @@ def main():
                         help='Random seed for image selection')
     parser.add_argument('--pathsep_replacement', action='store', type=str, default='',
                         help='Replace path separators in relative filenames with another character (frequently ~)')
+    parser.add_argument('--parallelize_rendering_with_processes', action='store_true',
+                        help='Render images on a pool of processes, one per core')
+    parser.add_argument('--rerender_all_images', action='store_true',
+                        help='Render all images, even if they are up to date from a previous run')
     
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -343,6 +361,10 @@ def main():
     args_to_object(args, options)
     if options.random_sort:
         options.sort_by_filename = False
+    options.skip_up_to_date_renderings = not options.rerender_all_images
+    options.parallelize_rendering = options.parallelize_rendering_with_processes
+    if options.parallelize_rendering_with_processes:
+        options.parallelize_rendering_n_cores = None
         
     process_images(options.db_path,options.output_dir,options.image_base_dir,options) 
 